@@ -1,63 +1,28 @@
 import sys
 import os
 from pathlib import Path
-import re
 import json
-import csv
-from datetime import datetime
-from time import time
+from time import time, sleep
 import random
 import threading
-from collections import deque
 
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QLabel, QLineEdit,
     QPushButton, QVBoxLayout, QHBoxLayout, QGridLayout, QGroupBox,
     QMessageBox, QFileDialog, QInputDialog, QTextEdit,
-    QTreeWidget, QTreeWidgetItem, QMenu, QAction, QHeaderView,
+    QTreeWidget, QTreeWidgetItem, QTreeView, QTableView, QMenu, QAction, QHeaderView,
     QCheckBox, QScrollArea, QMenuBar,
     QDialog, QSpacerItem, QSizePolicy, QComboBox,
-    QDialogButtonBox, QFrame, QTableWidget, QTableWidgetItem, QAbstractItemView,
-    QProgressBar, QProgressDialog
+    QDialogButtonBox, QFrame, QAbstractItemView,
+    QProgressBar, QProgressDialog, QStyledItemDelegate, QListWidget, QPlainTextEdit
 )
 from PyQt5.QtGui import QIcon, QFont, QClipboard, QColor, QBrush, QPalette, QIntValidator
-from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer, QEvent, QSettings, QPoint, QPropertyAnimation, QEasingCurve, QThread
-
-import openpyxl
-from openpyxl.styles import Alignment, Font, PatternFill, Border, Side
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer, QEvent, QSettings, QPoint, QPropertyAnimation, QEasingCurve, QThread, QAbstractItemModel, QAbstractTableModel, QModelIndex, QPersistentModelIndex, QSortFilterProxyModel
 
 import pyzbar.pyzbar as pyzbar
 import pyperclip
 
-
-class UndoManager:
-    def __init__(self, max_size=10):
-        self.undo_stack = deque(maxlen=max_size)
-        self.redo_stack = deque(maxlen=max_size)
-        
-    def add_action(self, action):
-        self.undo_stack.append(action)
-        self.redo_stack.clear()
-        
-    def can_undo(self):
-        return len(self.undo_stack) > 0
-        
-    def can_redo(self):
-        return len(self.redo_stack) > 0
-        
-    def undo(self):
-        if not self.undo_stack:
-            return None
-        action = self.undo_stack.pop()
-        self.redo_stack.append(action)
-        return action
-        
-    def redo(self):
-        if not self.redo_stack:
-            return None
-        action = self.redo_stack.pop()
-        self.undo_stack.append(action)
-        return action
+from scan_session import ScanSession, ScanError, SessionObserver, TYPE_BOX, TYPE_ITEM
 
 
 class ToolTip(QObject):
@@ -107,48 +72,85 @@ class ToolTip(QObject):
 
 
 class ScanNotification(QLabel):
+    """Всплывающее уведомление. Сообщения копятся и показываются не чаще раза в SHOW_INTERVAL_MS:
+    идущие подряд сканы товаров сворачиваются в «Сканов: +N», остальные сообщения показываются
+    по одному. Предупреждения идут первыми, по очереди, и каждое держится WARNING_HOLD_MS"""
+    SHOW_INTERVAL_MS = 300
+    WARNING_HOLD_MS = 1500
+    STYLE = """
+        QLabel {
+            background-color: %s;
+            color: white;
+            font-size: 14px;
+            font-weight: bold;
+            padding: 10px 20px;
+            border-radius: 5px;
+            border: 2px solid %s;
+        }
+    """
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.setStyleSheet("""
-            QLabel {
-                background-color: #27ae60;
-                color: white;
-                font-size: 14px;
-                font-weight: bold;
-                padding: 10px 20px;
-                border-radius: 5px;
-                border: 2px solid #2ecc71;
-            }
-        """)
+        self.is_warning = None
+        self._set_warning(False)
         self.setAlignment(Qt.AlignCenter)
         self.hide()
-        
-    def show_notification(self, text, is_warning=False):
+
+        self.warnings = []
+        # Обычные сообщения по порядку: [текст, число сканов]; 0 — сообщение не о скане товара
+        self.messages = []
+        # Моменты (time()), до которых новое сообщение только копится: до next_show
+        # и до конца показа предупреждения
+        self.next_show = 0.0
+        self.warning_until = 0.0
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.timeout.connect(self.flush)
+
+        self.animation = QPropertyAnimation(self, b"windowOpacity", self)
+        self.animation.setDuration(2000)
+        self.animation.setStartValue(1.0)
+        self.animation.setEndValue(0.0)
+        self.animation.setEasingCurve(QEasingCurve.OutCubic)
+        self.animation.finished.connect(self.hide)
+
+    def _set_warning(self, is_warning):
+        # Стиль пересчитывается только при смене вида
+        if is_warning == self.is_warning:
+            return
+        self.is_warning = is_warning
+        self.setStyleSheet(self.STYLE % (("#e74c3c", "#c0392b") if is_warning else ("#27ae60", "#2ecc71")))
+
+    def show_notification(self, text, is_warning=False, is_scan=False):
         if is_warning:
-            self.setStyleSheet("""
-                QLabel {
-                    background-color: #e74c3c;
-                    color: white;
-                    font-size: 14px;
-                    font-weight: bold;
-                    padding: 10px 20px;
-                    border-radius: 5px;
-                    border: 2px solid #c0392b;
-                }
-            """)
+            self.warnings.append(text)
+        elif is_scan and self.messages and self.messages[-1][1]:
+            self.messages[-1][0] = text
+            self.messages[-1][1] += 1
         else:
-            self.setStyleSheet("""
-                QLabel {
-                    background-color: #27ae60;
-                    color: white;
-                    font-size: 14px;
-                    font-weight: bold;
-                    padding: 10px 20px;
-                    border-radius: 5px;
-                    border: 2px solid #2ecc71;
-                }
-            """)
-        
+            self.messages.append([text, 1 if is_scan else 0])
+        if not self.flush_timer.isActive():
+            self.flush_timer.start(self._delay_ms())
+
+    def _delay_ms(self):
+        until = max(self.next_show, self.warning_until)
+        return max(0, int((until - time()) * 1000))
+
+    def flush(self):
+        if self.warnings:
+            self._display(self.warnings.pop(0), True)
+            self.warning_until = time() + self.WARNING_HOLD_MS / 1000
+        elif self.messages:
+            text, scan_count = self.messages.pop(0)
+            if scan_count > 1:
+                text = f"Сканов: +{scan_count}, последний: {(text.splitlines() or [''])[0]}"
+            self._display(text, False)
+        # Следующее сообщение — после интервала и после показа предупреждения
+        if self.warnings or self.messages:
+            self.flush_timer.start(self._delay_ms())
+
+    def _display(self, text, is_warning):
+        self._set_warning(is_warning)
         self.setText(text)
         self.adjustSize()
         
@@ -159,13 +161,9 @@ class ScanNotification(QLabel):
         
         self.show()
         self.raise_()
-        
-        self.animation = QPropertyAnimation(self, b"windowOpacity")
-        self.animation.setDuration(2000)
-        self.animation.setStartValue(1.0)
-        self.animation.setEndValue(0.0)
-        self.animation.setEasingCurve(QEasingCurve.OutCubic)
-        self.animation.finished.connect(self.hide)
+
+        self.next_show = time() + self.SHOW_INTERVAL_MS / 1000
+        self.animation.stop()
         self.animation.start()
 
 
@@ -351,41 +349,63 @@ class LoaderThread(QThread):
 
 
 class InvoiceViewDialog(QDialog):
-    def __init__(self, invoice_data, filename, parent=None):
+    """Накладная поверх InvoiceModel: окно не модальное и обновляется по ходу сборки"""
+    def __init__(self, session, parent=None):
         super().__init__(parent)
-        self.setWindowTitle(f"📋 Накладная: {filename}")
-        self.setGeometry(200, 200, 600, 500)
-        self.setModal(True)
+        self.setWindowTitle(f"📋 Накладная: {session.invoice_file_name}")
+        self.setGeometry(200, 200, 700, 500)
+        self.setModal(False)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.session = session
         
         layout = QVBoxLayout(self)
         
-        total_items = len(invoice_data)
-        total_quantity = sum(invoice_data.values())
-        info_label = QLabel(f"Позиций: {total_items} | Всего товаров: {total_quantity} шт")
-        info_label.setStyleSheet("font-weight: bold; color: #3498db;")
-        layout.addWidget(info_label)
-        
-        self.table = QTableWidget()
-        self.table.setColumnCount(2)
-        self.table.setHorizontalHeaderLabels(["Штрихкод", "Количество"])
+        self.info_label = QLabel()
+        self.info_label.setStyleSheet("font-weight: bold; color: #3498db;")
+        layout.addWidget(self.info_label)
+
+        self.filter_entry = QLineEdit()
+        self.filter_entry.setPlaceholderText("🔍 Фильтр по штрихкоду")
+        self.filter_entry.textChanged.connect(self.apply_filter)
+        layout.addWidget(self.filter_entry)
+        
+        self.model = InvoiceModel(session, self)
+        self.model.dataChanged.connect(self.update_info)
+        self.model.modelReset.connect(self.update_info)
+        self.finished.connect(self.on_finished)
+
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        # Высота строк фиксированная, а ширины не подбираются по содержимому — иначе таблица обходит все строки
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
         self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
-        self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeToContents)
+        for column in range(1, len(InvoiceModel.HEADERS)):
+            self.table.setColumnWidth(column, 90)
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.table.setSortingEnabled(True)
         self.table.setAlternatingRowColors(True)
         self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
-        
-        self.table.setRowCount(len(invoice_data))
-        for row, (barcode, count) in enumerate(invoice_data.items()):
-            self.table.setItem(row, 0, QTableWidgetItem(barcode))
-            count_item = QTableWidgetItem(str(count))
-            count_item.setTextAlignment(Qt.AlignCenter)
-            self.table.setItem(row, 1, count_item)
-        
         layout.addWidget(self.table)
         
         close_button = QPushButton("Закрыть")
         close_button.clicked.connect(self.accept)
         layout.addWidget(close_button)
+        self.update_info()
+
+    def apply_filter(self, text):
+        self.model.set_filter(text)
+
+    def update_info(self):
+        stats = self.session.scan_index.reconciliation
+        self.info_label.setText(f"Позиций: {len(self.model.planned)} | Всего товаров: {stats.planned_total} шт"
+                                f" | Собрано по плану: {stats.scanned_planned} шт")
+
+    def on_finished(self):
+        if self.model in self.session.observers:
+            self.session.observers.remove(self.model)
 
 
 class ReportDialog(QDialog):
@@ -408,240 +428,6 @@ class ReportDialog(QDialog):
         layout.addWidget(buttons)
 
 
-class EditCountDialog(QDialog):
-    def __init__(self, barcode, current_count, planned=None, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("✏️ Изменить количество")
-        self.setModal(True)
-        self.setMinimumWidth(350)
-        self.setMaximumHeight(400)
-        self.setWindowFlags(Qt.Dialog | Qt.WindowCloseButtonHint | Qt.WindowStaysOnTopHint)
-        
-        layout = QVBoxLayout(self)
-        layout.setSpacing(8)
-        layout.setContentsMargins(12, 12, 12, 12)
-        
-        # Информация в одну строку (компактно)
-        info_widget = QWidget()
-        info_layout = QHBoxLayout(info_widget)
-        info_layout.setContentsMargins(0, 0, 0, 0)
-        info_layout.setSpacing(10)
-        
-        # Штрихкод
-        barcode_container = QWidget()
-        barcode_container.setStyleSheet("background-color: #f0f0f0; border-radius: 4px;")
-        barcode_layout = QHBoxLayout(barcode_container)
-        barcode_layout.setContentsMargins(8, 4, 8, 4)
-        
-        barcode_icon = QLabel("📦")
-        barcode_layout.addWidget(barcode_icon)
-        
-        self.barcode_value = QLabel(barcode)
-        self.barcode_value.setStyleSheet("font-family: 'Courier New'; font-weight: bold;")
-        barcode_layout.addWidget(self.barcode_value)
-        
-        info_layout.addWidget(barcode_container)
-        
-        # Текущее количество
-        current_container = QWidget()
-        current_container.setStyleSheet("background-color: #e8f5e9; border-radius: 4px;")
-        current_layout = QHBoxLayout(current_container)
-        current_layout.setContentsMargins(8, 4, 8, 4)
-        
-        current_icon = QLabel("📊")
-        current_layout.addWidget(current_icon)
-        
-        self.current_value = QLabel(str(current_count))
-        self.current_value.setStyleSheet("font-weight: bold; color: #2e7d32;")
-        current_layout.addWidget(self.current_value)
-        
-        info_layout.addWidget(current_container)
-        
-        # План (если есть)
-        if planned is not None:
-            planned_container = QWidget()
-            planned_container.setStyleSheet("background-color: #fff3e0; border-radius: 4px;")
-            planned_layout = QHBoxLayout(planned_container)
-            planned_layout.setContentsMargins(8, 4, 8, 4)
-            
-            planned_icon = QLabel("📋")
-            planned_layout.addWidget(planned_icon)
-            
-            self.planned_value = QLabel(str(planned))
-            self.planned_value.setStyleSheet("font-weight: bold; color: #e65100;")
-            planned_layout.addWidget(self.planned_value)
-            
-            info_layout.addWidget(planned_container)
-        
-        layout.addWidget(info_widget)
-        
-        # Поле ввода (крупное, чтобы было удобно тыкать)
-        self.count_edit = QLineEdit(str(current_count))
-        self.count_edit.setAlignment(Qt.AlignCenter)
-        self.count_edit.setMinimumHeight(60)
-        self.count_edit.setStyleSheet("""
-            QLineEdit {
-                font-size: 24pt;
-                font-weight: bold;
-                border: 2px solid #2196f3;
-                border-radius: 6px;
-                margin: 5px 0;
-            }
-            QLineEdit:focus {
-                border-color: #ff9800;
-            }
-        """)
-        layout.addWidget(self.count_edit)
-        
-        # Кнопки +/- крупные
-        steps_widget = QWidget()
-        steps_layout = QHBoxLayout(steps_widget)
-        steps_layout.setContentsMargins(0, 0, 0, 0)
-        steps_layout.setSpacing(5)
-        
-        self.minus_button = QPushButton("−")
-        self.minus_button.setFixedHeight(50)
-        self.minus_button.setStyleSheet("""
-            QPushButton {
-                font-size: 20pt;
-                background-color: #ffebee;
-                color: #c62828;
-                border: none;
-                border-radius: 4px;
-            }
-            QPushButton:hover {
-                background-color: #ffcdd2;
-            }
-        """)
-        self.minus_button.clicked.connect(self.decrement_value)
-        steps_layout.addWidget(self.minus_button)
-        
-        self.plus_button = QPushButton("+")
-        self.plus_button.setFixedHeight(50)
-        self.plus_button.setStyleSheet("""
-            QPushButton {
-                font-size: 20pt;
-                background-color: #e8f5e9;
-                color: #2e7d32;
-                border: none;
-                border-radius: 4px;
-            }
-            QPushButton:hover {
-                background-color: #c8e6c9;
-            }
-        """)
-        self.plus_button.clicked.connect(self.increment_value)
-        steps_layout.addWidget(self.plus_button)
-        
-        layout.addWidget(steps_widget)
-        
-        # Кнопки быстрого изменения (в виде полосы)
-        quick_widget = QWidget()
-        quick_layout = QHBoxLayout(quick_widget)
-        quick_layout.setContentsMargins(0, 0, 0, 0)
-        quick_layout.setSpacing(3)
-        
-        for value in [1, 5, 10, 50, 100]:
-            btn = QPushButton(f"{value:+d}")
-            btn.setFixedHeight(35)
-            btn.setStyleSheet("""
-                QPushButton {
-                    background-color: #e3f2fd;
-                    color: #1565c0;
-                    border: none;
-                    border-radius: 3px;
-                    font-weight: bold;
-                    font-size: 9pt;
-                }
-                QPushButton:hover {
-                    background-color: #bbdefb;
-                }
-            """)
-            btn.clicked.connect(lambda checked, v=value: self.add_value(v))
-            quick_layout.addWidget(btn)
-        
-        layout.addWidget(quick_widget)
-        
-        # Кнопки действий
-        buttons_widget = QWidget()
-        buttons_layout = QHBoxLayout(buttons_widget)
-        buttons_layout.setContentsMargins(0, 5, 0, 0)
-        buttons_layout.setSpacing(5)
-        
-        self.ok_button = QPushButton("✅ Применить")
-        self.ok_button.setFixedHeight(40)
-        self.ok_button.setStyleSheet("""
-            QPushButton {
-                background-color: #2ecc71;
-                color: white;
-                font-weight: bold;
-                border: none;
-                border-radius: 4px;
-                font-size: 11pt;
-            }
-            QPushButton:hover {
-                background-color: #27ae60;
-            }
-        """)
-        self.ok_button.clicked.connect(self.accept)
-        buttons_layout.addWidget(self.ok_button)
-        
-        self.cancel_button = QPushButton("✕ Отмена")
-        self.cancel_button.setFixedHeight(40)
-        self.cancel_button.setStyleSheet("""
-            QPushButton {
-                background-color: #e74c3c;
-                color: white;
-                font-weight: bold;
-                border: none;
-                border-radius: 4px;
-                font-size: 11pt;
-            }
-            QPushButton:hover {
-                background-color: #c0392b;
-            }
-        """)
-        self.cancel_button.clicked.connect(self.reject)
-        buttons_layout.addWidget(self.cancel_button)
-        
-        layout.addWidget(buttons_widget)
-        
-        # Настройки ввода
-        self.count_edit.setFocus()
-        self.count_edit.selectAll()
-        self.count_edit.setValidator(QIntValidator(0, 999999))
-        self.count_edit.returnPressed.connect(self.accept)
-        
-    def increment_value(self):
-        try:
-            current = int(self.count_edit.text())
-            self.count_edit.setText(str(current + 1))
-        except:
-            self.count_edit.setText("1")
-            
-    def decrement_value(self):
-        try:
-            current = int(self.count_edit.text())
-            if current > 0:
-                self.count_edit.setText(str(current - 1))
-        except:
-            pass
-            
-    def add_value(self, delta):
-        try:
-            current = int(self.count_edit.text())
-            new_value = max(0, current + delta)
-            self.count_edit.setText(str(new_value))
-        except:
-            self.count_edit.setText(str(max(0, delta)))
-    
-    def get_value(self):
-        try:
-            return int(self.count_edit.text())
-        except:
-            return 0
-
-
 class ConfirmationDialog(QDialog):
     def __init__(self, title, message, icon_type="question", parent=None):
         super().__init__(parent)
@@ -735,6 +521,1250 @@ class ConfirmationDialog(QDialog):
         layout.addWidget(buttons_widget)
 
 
+def _sorted_row(count, key_at, sort_key, order, skip=-1):
+    """Место для ключа среди count упорядоченных строк (ключ строки — key_at(row));
+    строка skip (переносимая) не учитывается"""
+    descending = order == Qt.DescendingOrder
+    low, high = 0, count - (skip >= 0)
+    while low < high:
+        middle = (low + high) // 2
+        other = key_at(middle + (0 <= skip <= middle))
+        if (sort_key < other) if descending else (other < sort_key):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class StatusDelegate(QStyledItemDelegate):
+    """Оформляет строку по статусу из STATUS_ROLE. Шрифт и кисти создаются один раз
+    на делегат, модели отдают только статус"""
+    STATUS_ROLE = Qt.UserRole + 1
+    # статус -> (жирный, цвет текста, цвет фона)
+    STYLES = {
+        'group': (True, None, None),
+        '❓': (False, "#e67e22", "#fff3e0"),
+        'scan': (False, "#2ecc71", None),
+        'final': (False, "#2ecc71", None),
+        'edit': (False, "#e67e22", None),
+        'undo': (False, "#9b59b6", None),
+    }
+
+    def __init__(self, parent=None, default=None):
+        super().__init__(parent)
+        self.palette = {}
+        for status, (bold, foreground, background) in self.STYLES.items():
+            self.palette[status] = (bold,
+                                    QBrush(QColor(foreground)) if foreground else None,
+                                    QBrush(QColor(background)) if background else None)
+        # Оформление для статусов, которых нет в STYLES (например, типы действий из старых CSV)
+        self.default = self.palette.get(default)
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        style = self.palette.get(index.data(self.STATUS_ROLE), self.default)
+        if style is None:
+            return
+        bold, foreground, background = style
+        if bold:
+            option.font.setBold(True)
+        if foreground is not None:
+            option.palette.setBrush(QPalette.Text, foreground)
+        if background is not None:
+            option.backgroundBrush = background
+
+
+class ItemsDelegate(StatusDelegate):
+    """Делегат дерева товаров с правкой прямо в ячейке. Редактор для столбца создаётся
+    один раз: после правки представление его только прячет"""
+    # Высота многострочного редактора комментария в строках таблицы
+    COMMENT_LINES = 4
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.editors = {}
+
+    def createEditor(self, parent, option, index):
+        column = index.column()
+        editor = self.editors.get(column)
+        if editor is None:
+            if column == 5:
+                # Комментарий может быть многострочным: Enter переносит строку,
+                # правка сохраняется при уходе фокуса (или Tab), Esc — отмена
+                editor = QPlainTextEdit(parent)
+                editor.setTabChangesFocus(True)
+            else:
+                editor = QLineEdit(parent)
+                editor.setFrame(False)
+                editor.setAlignment(Qt.AlignCenter)
+                if column == 3:
+                    editor.setValidator(QIntValidator(0, 999999, editor))
+            self.editors[column] = editor
+        return editor
+
+    def setEditorData(self, editor, index):
+        if isinstance(editor, QPlainTextEdit):
+            editor.setPlainText(index.data(Qt.EditRole) or "")
+        else:
+            super().setEditorData(editor, index)
+
+    def setModelData(self, editor, model, index):
+        if isinstance(editor, QPlainTextEdit):
+            model.setData(index, editor.toPlainText(), Qt.EditRole)
+        else:
+            super().setModelData(editor, model, index)
+
+    def updateEditorGeometry(self, editor, option, index):
+        rect = option.rect
+        if isinstance(editor, QPlainTextEdit):
+            rect.setHeight(rect.height() * self.COMMENT_LINES)
+        editor.setGeometry(rect)
+
+    def destroyEditor(self, editor, index):
+        # Не удаляем — редактор понадобится при следующей правке
+        editor.hide()
+
+
+class ItemsModel(QAbstractItemModel, SessionObserver):
+    """Дерево коробов и товаров поверх ScanSession. Строки не пересоздаются:
+    сессия сообщает об изменениях, модель отправляет точечные сигналы.
+    Товары короба подгружаются при первом раскрытии (canFetchMore/fetchMore).
+    При сортировке строки вставляются и переносятся на своё место по одной, весь список не пересортировывается"""
+    HEADERS = ["Статус", "📦 Короб", "🏷 Товар", "🛒 Собрано", "📋 План", "💬 Комментарий"]
+    BOX_FLAGS = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+    # Товар никогда не имеет детей — представление не спрашивает у него rowCount при раскладке
+    ITEM_FLAGS = BOX_FLAGS | Qt.ItemNeverHasChildren
+    # Правка в ячейке: у короба — комментарий, у товара — штрихкод, количество и комментарий
+    BOX_EDIT_COLUMNS = (5,)
+    ITEM_EDIT_COLUMNS = (2, 3, 5)
+    # Столбцы, по которым сортируются и сами короба; по остальным короба остаются в порядке сессии
+    BOX_SORT_COLUMNS = (1, 3, 5)
+
+    # Сессия изменена правкой в ячейке (номер столбца)
+    edited = pyqtSignal(int)
+    # Правка отклонена сессией (текст ошибки)
+    edit_failed = pyqtSignal(str)
+    # Количество 0 — это удаление товара: решает окно, с подтверждением (короб, товар)
+    delete_requested = pyqtSignal(str, str)
+
+    def __init__(self, session, parent=None):
+        super().__init__(parent)
+        self.session = session
+        # -1 — порядок сессии (порядок сканирования)
+        self.sort_column = -1
+        self.sort_order = Qt.AscendingOrder
+        self._rebuild()
+        session.observers.append(self)
+
+    # Ключ короба не меняется при переименовании, поэтому индексы товаров (internalId) остаются верными
+    def _rebuild(self):
+        self.next_key = 1
+        self.keys = []
+        self.key_rows = {}
+        self.box_of = {}
+        self.key_of = {}
+        self.children = {}
+        self.child_rows = {}
+        # Короба, чьи товары ещё не переданы представлению; сигналы по их строкам не отправляются
+        self.unfetched = set()
+        for box_id in self.session.boxes:
+            self._append_box(box_id)
+        if self.sort_column in self.BOX_SORT_COLUMNS:
+            self.keys.sort(key=self._box_sort_key, reverse=self.sort_order == Qt.DescendingOrder)
+            self._reindex_boxes(0)
+
+    def _append_box(self, box_id):
+        key = self.next_key
+        self.next_key += 1
+        self.key_rows[key] = len(self.keys)
+        self.keys.append(key)
+        self.box_of[key] = box_id
+        self.key_of[box_id] = key
+        self.children[key] = []
+        self.child_rows[key] = {}
+        if len(self.session.boxes[box_id]):
+            self.unfetched.add(key)
+        return key
+
+    def _reindex_boxes(self, start, stop=None):
+        for row in range(start, len(self.keys) if stop is None else stop):
+            self.key_rows[self.keys[row]] = row
+
+    def _reindex_children(self, key, start, stop=None):
+        children = self.children[key]
+        rows = self.child_rows[key]
+        for row in range(start, len(children) if stop is None else stop):
+            rows[children[row]] = row
+
+    # --- Сортировка ---
+
+    # Ключи считаются по текущему состоянию сессии и не хранятся: при скане меняется ключ одной строки,
+    # остальные строки остаются упорядоченными, и её место находится двоичным поиском
+    def _item_sort_key(self, box_id, item_id):
+        session = self.session
+        column = self.sort_column
+        item_barcode = session.barcodes.names[item_id]
+        if column == 0:
+            # По возрастанию — сначала самая большая недостача
+            if not session.invoice_loaded:
+                return (0, item_barcode)
+            return (session.scan_index.total(item_id) - session.invoice_data.get(item_barcode, 0), item_barcode)
+        if column == 2:
+            return (item_barcode,)
+        if column == 3:
+            return (session.boxes[box_id].count(item_id), item_barcode)
+        if column == 4:
+            return (session.invoice_data.get(item_barcode, 0), item_barcode)
+        if column == 5:
+            return (session.get_comment(session.barcodes.names[box_id], item_barcode), item_barcode)
+        return (session.boxes[box_id].positions[item_id],)
+
+    def _box_sort_key(self, key):
+        column = self.sort_column
+        box_id = self.box_of[key]
+        box_barcode = self.session.barcodes.names[box_id]
+        if column == 1:
+            return (box_barcode,)
+        if column == 3:
+            return (self.session.scan_index.box_total(box_id), box_barcode)
+        return (self.session.get_comment(box_barcode), box_barcode)
+
+    def _sorted_children(self, key, item_ids):
+        if self.sort_column < 0:
+            return list(item_ids)
+        box_id = self.box_of[key]
+        return sorted(item_ids, key=lambda item_id: self._item_sort_key(box_id, item_id),
+                      reverse=self.sort_order == Qt.DescendingOrder)
+
+    def _resort_item(self, key, item_id):
+        """Переносит строку товара на место по ключу; возвращает её номер"""
+        row = self.child_rows[key][item_id]
+        if self.sort_column < 0:
+            return row
+        box_id = self.box_of[key]
+        children = self.children[key]
+        target = _sorted_row(len(children), lambda other: self._item_sort_key(box_id, children[other]),
+                             self._item_sort_key(box_id, item_id), self.sort_order, row)
+        if target == row:
+            return row
+        parent = self.createIndex(self.key_rows[key], 0, 0)
+        self.beginMoveRows(parent, row, row, parent, target + 1 if target > row else target)
+        del children[row]
+        children.insert(target, item_id)
+        self._reindex_children(key, min(row, target), max(row, target) + 1)
+        self.endMoveRows()
+        return target
+
+    def _resort_box(self, key):
+        row = self.key_rows[key]
+        if self.sort_column not in self.BOX_SORT_COLUMNS:
+            return row
+        keys = self.keys
+        target = _sorted_row(len(keys), lambda other: self._box_sort_key(keys[other]), self._box_sort_key(key),
+                             self.sort_order, row)
+        if target == row:
+            return row
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), target + 1 if target > row else target)
+        del keys[row]
+        keys.insert(target, key)
+        self._reindex_boxes(min(row, target), max(row, target) + 1)
+        self.endMoveRows()
+        return target
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        old_keys = list(self.keys)
+        old_children = {key: list(children) for key, children in self.children.items()}
+        self.sort_column = column
+        self.sort_order = order
+        if column in self.BOX_SORT_COLUMNS:
+            self.keys.sort(key=self._box_sort_key, reverse=order == Qt.DescendingOrder)
+        else:
+            self.keys = [self.key_of[box_id] for box_id in self.session.boxes]
+        self._reindex_boxes(0)
+        for key in self.keys:
+            if key not in self.unfetched:
+                self.children[key] = self._sorted_children(key, self.session.boxes[self.box_of[key]].item_ids)
+                self._reindex_children(key, 0)
+        # Раскрытие, выделение и скрытые строки представления держатся на постоянных индексах
+        old_indexes = self.persistentIndexList()
+        new_indexes = []
+        for index in old_indexes:
+            key = index.internalId()
+            if key == 0:
+                row = self.key_rows[old_keys[index.row()]]
+            else:
+                row = self.child_rows[key][old_children[key][index.row()]]
+            new_indexes.append(self.createIndex(row, index.column(), key))
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
+
+    # --- QAbstractItemModel ---
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not parent.isValid():
+            if 0 <= row < len(self.keys):
+                return self.createIndex(row, column, 0)
+            return QModelIndex()
+        if parent.internalId() != 0:
+            return QModelIndex()
+        key = self.keys[parent.row()]
+        if 0 <= row < len(self.children[key]):
+            return self.createIndex(row, column, key)
+        return QModelIndex()
+
+    def parent(self, index):
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(self.key_rows[index.internalId()], 0, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.keys)
+        if parent.internalId() == 0 and parent.column() == 0:
+            return len(self.children[self.keys[parent.row()]])
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return bool(self.keys)
+        if parent.internalId() != 0 or parent.column() != 0:
+            return False
+        key = self.keys[parent.row()]
+        return key in self.unfetched or bool(self.children[key])
+
+    def canFetchMore(self, parent):
+        return parent.isValid() and parent.internalId() == 0 and self.keys[parent.row()] in self.unfetched
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        key = self.keys[parent.row()]
+        self.unfetched.discard(key)
+        item_ids = self.session.boxes[self.box_of[key]].item_ids
+        if not item_ids:
+            return
+        self.beginInsertRows(parent, 0, len(item_ids) - 1)
+        self.children[key] = self._sorted_children(key, item_ids)
+        self.child_rows[key] = {item_id: row for row, item_id in enumerate(self.children[key])}
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal:
+            if role == Qt.DisplayRole:
+                return self.HEADERS[section]
+            if role == Qt.TextAlignmentRole:
+                return Qt.AlignCenter
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if index.internalId() == 0:
+            if index.column() in self.BOX_EDIT_COLUMNS:
+                return self.BOX_FLAGS | Qt.ItemIsEditable
+            return self.BOX_FLAGS
+        if index.column() in self.ITEM_EDIT_COLUMNS:
+            return self.ITEM_FLAGS | Qt.ItemIsEditable
+        return self.ITEM_FLAGS
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        column = index.column()
+        names = self.session.barcodes.names
+        key = index.internalId()
+        if key == 0:
+            box_barcode = names[self.box_of[self.keys[index.row()]]]
+            if role in (Qt.DisplayRole, Qt.EditRole):
+                if column == 1:
+                    return box_barcode
+                if column == 5:
+                    return self.session.get_comment(box_barcode)
+                return ""
+            if role == StatusDelegate.STATUS_ROLE:
+                return 'group'
+            return None
+
+        box_id = self.box_of[key]
+        item_id = self.children[key][index.row()]
+        item_barcode = names[item_id]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if column == 0:
+                return self.session.get_item_status(item_barcode)[0]
+            if column == 2:
+                return item_barcode
+            if column == 3:
+                return str(self.session.boxes[box_id].count(item_id))
+            if column == 4:
+                return self.session.get_item_status(item_barcode)[1]
+            if column == 5:
+                return self.session.get_comment(names[box_id], item_barcode)
+            return ""
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignCenter if column > 0 else None
+        if role == StatusDelegate.STATUS_ROLE:
+            return self.session.get_item_status(item_barcode)[0]
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        """Правка в ячейке — один вызов сессии (и одна запись отмены).
+        Строки обновляются по сигналам сессии, как при сканировании"""
+        if role != Qt.EditRole or not (self.flags(index) & Qt.ItemIsEditable):
+            return False
+        column = index.column()
+        box_barcode = self.box_barcode(index)
+        item_barcode = self.item_barcode(index)
+        text = str(value).strip()
+        try:
+            if column == 5:
+                if not self.session.set_comment(box_barcode, item_barcode, text):
+                    return False
+            elif column == 3:
+                if not text.isdigit() or int(text) == self.session.get_count(box_barcode, item_barcode):
+                    return False
+                if int(text) == 0:
+                    self.delete_requested.emit(box_barcode, item_barcode)
+                    return False
+                self.session.set_item_count(box_barcode, item_barcode, int(text))
+            else:
+                if not text or text == item_barcode:
+                    return False
+                self.session.rename_item(box_barcode, item_barcode, text)
+        except ScanError as e:
+            self.edit_failed.emit(str(e))
+            return False
+        self.edited.emit(column)
+        return True
+
+    # --- Доступ для окна ---
+
+    def is_box(self, index):
+        return index.isValid() and index.internalId() == 0
+
+    def box_barcode(self, index):
+        if not index.isValid():
+            return ""
+        key = index.internalId() or self.keys[index.row()]
+        return self.session.barcodes.names[self.box_of[key]]
+
+    def item_barcode(self, index):
+        if not index.isValid() or index.internalId() == 0:
+            return ""
+        return self.session.barcodes.names[self.children[index.internalId()][index.row()]]
+
+    def box_index(self, box_barcode):
+        key = self.key_of.get(self.session.barcodes.get(box_barcode))
+        return self.createIndex(self.key_rows[key], 0, 0) if key is not None else QModelIndex()
+
+    def line_ids(self, index):
+        key = index.internalId()
+        return self.box_of[key], self.children[key][index.row()]
+
+    def line_index(self, box_id, item_id):
+        key = self.key_of.get(box_id)
+        row = self.child_rows[key].get(item_id) if key is not None else None
+        return self.createIndex(row, 0, key) if row is not None else QModelIndex()
+
+    def line_indexes(self, barcode_ids=None):
+        """Строки товаров; с barcode_ids — только те, где короб или товар из этого набора"""
+        if barcode_ids is None:
+            for key in self.keys:
+                for row in range(len(self.children[key])):
+                    yield self.createIndex(row, 0, key)
+            return
+        for barcode_id in barcode_ids:
+            key = self.key_of.get(barcode_id)
+            if key is not None:
+                for row in range(len(self.children[key])):
+                    yield self.createIndex(row, 0, key)
+            for box_id in self.session.scan_index.boxes_with(barcode_id):
+                index = self.line_index(box_id, barcode_id)
+                if index.isValid():
+                    yield index
+
+    def row_values(self, index):
+        return [self.data(index.sibling(index.row(), column)) or "" for column in range(len(self.HEADERS))]
+
+    # --- SessionObserver ---
+
+    def _emit_row(self, key, row, first_column=0, last_column=5):
+        self.dataChanged.emit(self.createIndex(row, first_column, key), self.createIndex(row, last_column, key))
+
+    def box_added(self, box_id):
+        row = len(self.keys)
+        self.beginInsertRows(QModelIndex(), row, row)
+        key = self._append_box(box_id)
+        self.endInsertRows()
+        self._resort_box(key)
+
+    def box_removed(self, box_id):
+        key = self.key_of.pop(box_id)
+        row = self.key_rows[key]
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.key_rows[key]
+        del self.keys[row]
+        del self.box_of[key]
+        del self.children[key]
+        del self.child_rows[key]
+        self.unfetched.discard(key)
+        self._reindex_boxes(row)
+        self.endRemoveRows()
+        # Суммы всех товаров короба уже изменились разом — по одному их место не найти двоичным поиском
+        if self.sort_column == 0:
+            self.sort(self.sort_column, self.sort_order)
+
+    def box_renamed(self, old_id, new_id):
+        # Если короба не сортируются, переименованный уходит в конец списка, как и в самой сессии
+        key = self.key_of.pop(old_id)
+        row = self.key_rows[key]
+        last = len(self.keys)
+        if self.sort_column not in self.BOX_SORT_COLUMNS and row != last - 1:
+            self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), last)
+            del self.keys[row]
+            self.keys.append(key)
+            self._reindex_boxes(row)
+            self.endMoveRows()
+        self.box_of[key] = new_id
+        self.key_of[new_id] = key
+        self._emit_row(0, self._resort_box(key))
+
+    def line_added(self, box_id, item_id):
+        key = self.key_of[box_id]
+        self._resort_box(key)
+        if key in self.unfetched:
+            return
+        children = self.children[key]
+        row = len(children)
+        if self.sort_column >= 0:
+            row = _sorted_row(row, lambda other: self._item_sort_key(box_id, children[other]),
+                              self._item_sort_key(box_id, item_id), self.sort_order)
+        self.beginInsertRows(self.createIndex(self.key_rows[key], 0, 0), row, row)
+        children.insert(row, item_id)
+        self._reindex_children(key, row)
+        self.endInsertRows()
+
+    def line_changed(self, box_id, item_id):
+        key = self.key_of[box_id]
+        self._resort_box(key)
+        if item_id in self.child_rows[key]:
+            self._emit_row(key, self._resort_item(key, item_id), 3, 3)
+
+    def line_removed(self, box_id, item_id):
+        key = self.key_of[box_id]
+        self._resort_box(key)
+        if key in self.unfetched:
+            if not len(self.session.boxes[box_id]):
+                self.unfetched.discard(key)
+            return
+        rows = self.child_rows[key]
+        row = rows.get(item_id)
+        if row is None:
+            return
+        children = self.children[key]
+        self.beginRemoveRows(self.createIndex(self.key_rows[key], 0, 0), row, row)
+        del rows[item_id]
+        del children[row]
+        for i in range(row, len(children)):
+            rows[children[i]] = i
+        self.endRemoveRows()
+
+    def _status_rank(self, item_id, total):
+        planned = self.session.invoice_data.get(self.session.barcodes.names[item_id])
+        if planned is None:
+            return None
+        return (total > planned) - (total < planned)
+
+    def item_total_changed(self, item_id, old_total):
+        # Статус товара зависит от суммы по всем коробам. Обычный скан его не меняет —
+        # тогда обновляется только строка с количеством; строки в других коробах трогаем при смене статуса
+        # При сортировке по недостаче строка товара переносится во всех коробах, где он есть
+        if not self.session.invoice_loaded:
+            return
+        status_changed = self._status_rank(item_id, old_total) != self._status_rank(item_id, self.session.scan_index.total(item_id))
+        if not status_changed and self.sort_column != 0:
+            return
+        for box_id in self.session.scan_index.boxes_with(item_id):
+            key = self.key_of.get(box_id)
+            if key is None or item_id not in self.child_rows[key]:
+                continue
+            row = self._resort_item(key, item_id)
+            if status_changed:
+                self._emit_row(key, row, 0, 0)
+
+    def comment_changed(self, box_barcode, item_barcode):
+        key = self.key_of.get(self.session.barcodes.get(box_barcode))
+        if key is None:
+            return
+        if not item_barcode:
+            self._emit_row(0, self._resort_box(key), 5, 5)
+            return
+        item_id = self.session.barcodes.get(item_barcode)
+        if item_id in self.child_rows[key]:
+            self._emit_row(key, self._resort_item(key, item_id), 5, 5)
+
+    def invoice_changed(self):
+        if self.sort_column in (0, 4):
+            self.sort(self.sort_column, self.sort_order)
+        for key in self.keys:
+            if self.children[key]:
+                self.dataChanged.emit(self.createIndex(0, 0, key), self.createIndex(len(self.children[key]) - 1, 5, key))
+
+    def boxes_reset(self):
+        self.beginResetModel()
+        self._rebuild()
+        self.endResetModel()
+
+
+class ItemsFilter(SessionObserver):
+    """Поиск по дереву товаров: строки скрываются в представлении, модель не перестраивается.
+    Совпадения берутся из индекса штрихкодов сессии, при наборе запрос применяется после паузы"""
+    DELAY_MS = 250
+
+    def __init__(self, session, model, view):
+        self.session = session
+        self.model = model
+        self.view = view
+        self.query = ""
+        self.pending = ""
+        # None — фильтр выключен; иначе номера подходящих штрихкодов
+        self.matches = None
+        # Штрихкоды с номером не меньше indexed появились после поиска и проверяются напрямую
+        self.indexed = 0
+        self.timer = QTimer(view)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.DELAY_MS)
+        self.timer.timeout.connect(self.apply)
+        # Строки товаров появляются и при сканировании, и при подгрузке короба — проверяем их при вставке
+        model.rowsInserted.connect(self.on_rows_inserted)
+        session.observers.append(self)
+
+    def schedule(self, query):
+        self.pending = query
+        self.timer.start()
+
+    def apply(self):
+        self.timer.stop()
+        query = self.pending.lower()
+        if query == self.query:
+            return
+        old_matches = self.matches
+        self.query = query
+        self._search()
+        if old_matches is None or self.matches is None:
+            self._update(self.model.line_indexes())
+        else:
+            # Видимость меняется только у строк, где короб или товар вошёл в совпадения или выпал из них
+            self._update(self.model.line_indexes(old_matches ^ self.matches))
+
+    def _search(self):
+        if self.query:
+            self.matches = self.session.search_barcodes(self.query)
+            self.indexed = len(self.session.barcodes)
+        else:
+            self.matches = None
+
+    def _match(self, barcode_id):
+        if barcode_id in self.matches:
+            return True
+        if barcode_id < self.indexed or self.query not in self.session.barcodes.names[barcode_id].lower():
+            return False
+        self.matches.add(barcode_id)
+        return True
+
+    def _update(self, indexes):
+        view = self.view
+        for index in indexes:
+            box_id, item_id = self.model.line_ids(index)
+            hidden = self.matches is not None and not (self._match(box_id) or self._match(item_id))
+            parent = index.parent()
+            if view.isRowHidden(index.row(), parent) != hidden:
+                view.setRowHidden(index.row(), parent, hidden)
+
+    def on_rows_inserted(self, parent, first, last):
+        if self.matches is not None and parent.isValid():
+            self._update(self.model.index(row, 0, parent) for row in range(first, last + 1))
+
+    # --- SessionObserver: модель уже получила изменение ---
+
+    def box_renamed(self, old_id, new_id):
+        if self.matches is not None:
+            self._update(self.model.line_indexes([new_id]))
+
+    def boxes_reset(self):
+        # После сброса номера штрихкодов могли смениться, совпадения ищутся заново
+        if self.matches is not None:
+            self._search()
+            self._update(self.model.line_indexes())
+
+
+class HistoryModel(QAbstractItemModel, SessionObserver):
+    """История сканирования деревом короб -> товар -> запись поверх ScanHistory.
+    Товары и записи подгружаются при раскрытии, новые записи добавляются строками без перестроения"""
+    HEADERS = ["📦 Короб", "🏷 Товар", "📦 Кол-во", "⚡ Действие", "📝 Детали", "📅 Время"]
+    BOX_PREFIX = "📦 "
+    ACTION_TYPE_ICONS = {'undo': "↩️", 'edit': "✏️"}
+
+    def __init__(self, session, parent=None):
+        super().__init__(parent)
+        self.session = session
+        self.filter_text = ""
+        self._rebuild()
+        session.observers.append(self)
+
+    # internalId: 0 — короб, 2 * строка короба + 1 — товар, 2 * номер узла товара + 2 — запись.
+    # Строки только дописываются в конец, поэтому номера не меняются до полного сброса
+    def _rebuild(self):
+        self.history = self.session.scan_history
+        self.box_entries, self.item_entries = self.history.groups()
+        self.box_ids = []
+        self.box_rows = {}
+        # По строке короба: номера товаров (None — ещё не подгружены), их строки и номера узлов
+        self.items = []
+        self.item_rows = []
+        self.item_keys = []
+        # Узлы товаров: (строка короба, строка товара) и сколько записей передано представлению
+        self.nodes = []
+        self.entry_counts = []
+        for box_id in self.box_entries:
+            self._append_box(box_id)
+        self._refilter()
+
+    def _append_box(self, box_id):
+        self.box_rows[box_id] = len(self.box_ids)
+        self.box_ids.append(box_id)
+        self.items.append(None if box_id in self.item_entries else [])
+        self.item_rows.append({})
+        self.item_keys.append([])
+
+    def _append_item(self, box_row, item_id):
+        item_row = len(self.items[box_row])
+        self.items[box_row].append(item_id)
+        self.item_rows[box_row][item_id] = item_row
+        self.item_keys[box_row].append(len(self.nodes))
+        self.nodes.append((box_row, item_row))
+        self.entry_counts.append(None)
+
+    def _entries(self, key):
+        box_row, item_row = self.nodes[key]
+        return self.item_entries[self.box_ids[box_row]][self.items[box_row][item_row]]
+
+    # --- QAbstractItemModel ---
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, 0)
+        parent_id = parent.internalId()
+        if parent_id == 0:
+            return self.createIndex(row, column, 2 * parent.row() + 1)
+        key = self.item_keys[(parent_id - 1) // 2][parent.row()]
+        return self.createIndex(row, column, 2 * key + 2)
+
+    def parent(self, index):
+        internal_id = index.internalId() if index.isValid() else 0
+        if internal_id == 0:
+            return QModelIndex()
+        if internal_id % 2:
+            return self.createIndex((internal_id - 1) // 2, 0, 0)
+        box_row, item_row = self.nodes[(internal_id - 2) // 2]
+        return self.createIndex(item_row, 0, 2 * box_row + 1)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.box_ids)
+        if parent.column() != 0:
+            return 0
+        parent_id = parent.internalId()
+        if parent_id == 0:
+            return len(self.items[parent.row()] or ())
+        if parent_id % 2:
+            return self.entry_counts[self.item_keys[(parent_id - 1) // 2][parent.row()]] or 0
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return bool(self.box_ids)
+        if parent.column() != 0:
+            return False
+        parent_id = parent.internalId()
+        if parent_id == 0:
+            return self.items[parent.row()] != []
+        # У товара в истории всегда есть хотя бы одна запись
+        return parent_id % 2 == 1
+
+    def canFetchMore(self, parent):
+        if not parent.isValid() or parent.column() != 0:
+            return False
+        parent_id = parent.internalId()
+        if parent_id == 0:
+            return self.items[parent.row()] is None
+        if parent_id % 2:
+            return self.entry_counts[self.item_keys[(parent_id - 1) // 2][parent.row()]] is None
+        return False
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        parent_id = parent.internalId()
+        if parent_id == 0:
+            box_row = parent.row()
+            item_ids = list(self.item_entries[self.box_ids[box_row]])
+            # Узел помечается подгруженным до beginInsertRows: прокси и представление могут спросить canFetchMore повторно
+            self.items[box_row] = []
+            self.beginInsertRows(parent, 0, len(item_ids) - 1)
+            for item_id in item_ids:
+                self._append_item(box_row, item_id)
+            self.endInsertRows()
+        else:
+            key = self.item_keys[(parent_id - 1) // 2][parent.row()]
+            count = len(self._entries(key))
+            self.entry_counts[key] = 0
+            self.beginInsertRows(parent, 0, count - 1)
+            self.entry_counts[key] = count
+            self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable if index.isValid() else Qt.NoItemFlags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        internal_id = index.internalId()
+        column = index.column()
+        history = self.history
+        names = self.session.barcodes.names
+        if internal_id == 0:
+            if role == StatusDelegate.STATUS_ROLE:
+                return 'group'
+            if role != Qt.DisplayRole:
+                return None
+            box_id = self.box_ids[index.row()]
+            entry = self.box_entries[box_id]
+            opened = history.action_type(entry) == 'scan'
+            if column == 0:
+                return self.BOX_PREFIX + names[box_id]
+            if column == 2:
+                return "📌" if opened else "✏️"
+            if column == 3:
+                return "Открытие короба" if opened else "Изменение короба"
+            if column == 4:
+                return history.details(entry)
+            if column == 5:
+                return history.time_text(entry)
+            return ""
+
+        if internal_id % 2:
+            if role == StatusDelegate.STATUS_ROLE:
+                return 'group'
+            if role != Qt.DisplayRole:
+                return None
+            box_row = (internal_id - 1) // 2
+            box_id = self.box_ids[box_row]
+            item_id = self.items[box_row][index.row()]
+            if column == 0:
+                return "  🏷"
+            if column == 1:
+                return names[item_id]
+            if column == 2:
+                # Актуальное количество товара в коробе, а не по истории
+                return f"📦 {self.session.get_count(names[box_id], names[item_id])}"
+            if column == 3:
+                return f"{len(self.item_entries[box_id][item_id])} операций"
+            return ""
+
+        entry = self._entries((internal_id - 2) // 2)[index.row()]
+        if role == StatusDelegate.STATUS_ROLE:
+            return history.action_type(entry)
+        if role != Qt.DisplayRole:
+            return None
+        if column == 0:
+            return "    •"
+        if column == 2:
+            return self.ACTION_TYPE_ICONS.get(history.action_type(entry), "📷")
+        if column == 3:
+            return history.action_text(entry)
+        if column == 4:
+            return history.details(entry)
+        if column == 5:
+            return history.time_text(entry)
+        return ""
+
+    # --- Фильтр ---
+
+    def set_filter(self, text):
+        self.filter_text = text.lower()
+        self._refilter()
+
+    def _refilter(self):
+        """Короб виден по штрихкоду или если виден его товар, товар — по штрихкоду или если видна его запись,
+        запись — по действию или деталям. Совпадения берутся из индексов истории и штрихкодов"""
+        # None — фильтр выключен; иначе видимые короба, пары (короб, товар) и номера записей
+        self.visible_boxes = None
+        text = self.filter_text
+        if not text:
+            return
+        self.visible_entries = entries = self.history.search(text, TYPE_ITEM)
+        self.visible_items = items = set()
+        barcode_matches = self.session.search_barcodes(text)
+        for box_id, box_items in self.item_entries.items():
+            if barcode_matches:
+                for item_id in box_items.keys() & barcode_matches:
+                    items.add((box_id, item_id))
+            if entries:
+                for item_id, item_entries in box_items.items():
+                    if not entries.isdisjoint(item_entries):
+                        items.add((box_id, item_id))
+        self.visible_boxes = {box_id for box_id, item_id in self.visible_items}
+        prefix = self.BOX_PREFIX
+        if text in prefix or any(prefix.endswith(text[:length]) for length in range(1, min(len(text), len(prefix)) + 1)):
+            # Запрос захватывает значок перед штрихкодом — такие короба проверяем по полному тексту
+            names = self.session.barcodes.names
+            self.visible_boxes.update(box_id for box_id in self.box_ids if text in (prefix + names[box_id]).lower())
+        else:
+            self.visible_boxes.update(box_id for box_id in barcode_matches if box_id in self.box_rows)
+
+    def _filter_box(self, box_id):
+        # Новый короб во время работы фильтра проверяется напрямую
+        text = self.filter_text
+        names = self.session.barcodes.names
+        box_visible = text in (self.BOX_PREFIX + names[box_id]).lower()
+        for item_id, entries in self.item_entries.get(box_id, {}).items():
+            item_visible = text in names[item_id].lower()
+            for entry in entries:
+                if self._entry_matches(entry):
+                    self.visible_entries.add(entry)
+                    item_visible = True
+            if item_visible:
+                self.visible_items.add((box_id, item_id))
+                box_visible = True
+        if box_visible:
+            self.visible_boxes.add(box_id)
+
+    def _entry_matches(self, entry):
+        return self.filter_text in self.history.action_text(entry).lower() or self.filter_text in self.history.details(entry).lower()
+
+    def accepts(self, row, parent):
+        if self.visible_boxes is None:
+            return True
+        if not parent.isValid():
+            return self.box_ids[row] in self.visible_boxes
+        parent_id = parent.internalId()
+        if parent_id == 0:
+            return (self.box_ids[parent.row()], self.items[parent.row()][row]) in self.visible_items
+        key = self.item_keys[(parent_id - 1) // 2][parent.row()]
+        return self._entries(key)[row] in self.visible_entries
+
+    # --- SessionObserver ---
+
+    def history_appended(self, index):
+        history = self.history
+        if history.types[index] == TYPE_BOX:
+            box_id = history.barcode_ids[index]
+            if box_id in self.box_rows:
+                return
+            row = len(self.box_ids)
+            if self.visible_boxes is not None:
+                self._filter_box(box_id)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self._append_box(box_id)
+            self.endInsertRows()
+            return
+
+        box_id = history.box_ids[index]
+        item_id = history.barcode_ids[index]
+        box_row = self.box_rows.get(box_id)
+        if box_row is None:
+            return
+        box_shown = True
+        if self.visible_boxes is not None:
+            # Новая запись может открыть скрытый фильтром товар и его короб
+            box_shown = box_id in self.visible_boxes
+            item_visible = (box_id, item_id) in self.visible_items or self.filter_text in self.session.barcodes.names[item_id].lower()
+            if self._entry_matches(index):
+                self.visible_entries.add(index)
+                item_visible = True
+            if item_visible:
+                self.visible_items.add((box_id, item_id))
+                self.visible_boxes.add(box_id)
+        if not box_shown and box_id in self.visible_boxes:
+            self._emit_row(self.createIndex(box_row, 0, 0))
+
+        items = self.items[box_row]
+        if items is None:
+            return
+        item_row = self.item_rows[box_row].get(item_id)
+        if item_row is None:
+            self.beginInsertRows(self.createIndex(box_row, 0, 0), len(items), len(items))
+            self._append_item(box_row, item_id)
+            self.endInsertRows()
+            return
+        item_index = self.createIndex(item_row, 0, 2 * box_row + 1)
+        self._emit_row(item_index)
+        key = self.item_keys[box_row][item_row]
+        count = self.entry_counts[key]
+        if count is not None:
+            self.beginInsertRows(item_index, count, count)
+            self.entry_counts[key] = count + 1
+            self.endInsertRows()
+
+    def _emit_row(self, index):
+        self.dataChanged.emit(index, index.sibling(index.row(), len(self.HEADERS) - 1))
+
+    def _emit_counts(self, box_id, item_id=None):
+        box_row = self.box_rows.get(box_id)
+        if box_row is None or not self.items[box_row]:
+            return
+        rows = self.item_rows[box_row]
+        for row in (rows.values() if item_id is None else [rows.get(item_id)]):
+            if row is not None:
+                index = self.createIndex(row, 2, 2 * box_row + 1)
+                self.dataChanged.emit(index, index)
+
+    def line_added(self, box_id, item_id):
+        self._emit_counts(box_id, item_id)
+
+    def line_changed(self, box_id, item_id):
+        self._emit_counts(box_id, item_id)
+
+    def line_removed(self, box_id, item_id):
+        self._emit_counts(box_id, item_id)
+
+    def box_removed(self, box_id):
+        self._emit_counts(box_id)
+
+    def box_renamed(self, old_id, new_id):
+        self._emit_counts(old_id)
+        self._emit_counts(new_id)
+
+    def boxes_reset(self):
+        # Сессия заменена целиком вместе с историей
+        self.beginResetModel()
+        self._rebuild()
+        self.endResetModel()
+
+
+class InvoiceModel(QAbstractTableModel, SessionObserver):
+    """Позиции накладной с живыми суммами из индекса сессии. Фильтр и сортировку модель делает сама
+    над списком номеров строк: прокси сравнивал бы строки через data() и пересчитывал фильтр при каждом переносе.
+    При скане обновляется и при сортировке переносится одна строка"""
+    HEADERS = ["Штрихкод", "План", "Собрано", "Осталось", "Статус"]
+    # Столбцы, значения которых меняются при сканировании
+    LIVE_COLUMNS = (2, 3, 4)
+
+    def __init__(self, session, parent=None):
+        super().__init__(parent)
+        self.session = session
+        self.filter_text = ""
+        self.sort_column = -1
+        self.sort_order = Qt.AscendingOrder
+        self._rebuild()
+        session.observers.append(self)
+
+    def _rebuild(self):
+        # Штрихкоды накладной заносятся в таблицу сессии при загрузке; без сортировки — порядок накладной
+        self.planned = self.session.scan_index.reconciliation.planned
+        matches = self.session.search_barcodes(self.filter_text) if self.filter_text else None
+        self.item_ids = [item_id for item_id in self.planned if matches is None or item_id in matches]
+        if self.sort_column >= 0:
+            self.item_ids.sort(key=self._sort_key, reverse=self.sort_order == Qt.DescendingOrder)
+        self._reindex(0)
+
+    def _reindex(self, start, stop=None):
+        if start == 0 and stop is None:
+            self.rows = {}
+        item_ids = self.item_ids
+        for row in range(start, len(item_ids) if stop is None else stop):
+            self.rows[item_ids[row]] = row
+
+    def _sort_key(self, item_id):
+        # По статусу по возрастанию первыми идут самые большие недостачи
+        barcode = self.session.barcodes.names[item_id]
+        column = self.sort_column
+        if column == 0:
+            return (barcode,)
+        planned = self.planned[item_id]
+        total = self.session.scan_index.total(item_id)
+        return ((planned, total, planned - total, total - planned)[column - 1], barcode)
+
+    def set_filter(self, text):
+        self.filter_text = text.strip()
+        self.beginResetModel()
+        self._rebuild()
+        self.endResetModel()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        old_ids = list(self.item_ids)
+        self.sort_column = column
+        self.sort_order = order
+        if column >= 0:
+            self.item_ids.sort(key=self._sort_key, reverse=order == Qt.DescendingOrder)
+        else:
+            order_of = {item_id: position for position, item_id in enumerate(self.planned)}
+            self.item_ids.sort(key=order_of.get)
+        self._reindex(0)
+        old_indexes = self.persistentIndexList()
+        self.changePersistentIndexList(old_indexes, [self.index(self.rows[old_ids[index.row()]], index.column())
+                                                     for index in old_indexes])
+        self.layoutChanged.emit()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.item_ids)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        column = index.column()
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignCenter if column > 0 else None
+        if role != Qt.DisplayRole:
+            return None
+        item_id = self.item_ids[index.row()]
+        if column == 0:
+            return self.session.barcodes.names[item_id]
+        planned = self.planned[item_id]
+        total = self.session.scan_index.total(item_id)
+        if column == 1:
+            return str(planned)
+        if column == 2:
+            return str(total)
+        if column == 3:
+            return str(max(planned - total, 0))
+        return "✅" if total == planned else "⚠️" if total < planned else "❗"
+
+    # --- SessionObserver ---
+
+    def item_total_changed(self, item_id, old_total):
+        row = self.rows.get(item_id)
+        if row is None:
+            return
+        if self.sort_column in self.LIVE_COLUMNS:
+            item_ids = self.item_ids
+            target = _sorted_row(len(item_ids), lambda other: self._sort_key(item_ids[other]),
+                                 self._sort_key(item_id), self.sort_order, row)
+            if target != row:
+                self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), target + 1 if target > row else target)
+                del item_ids[row]
+                item_ids.insert(target, item_id)
+                self._reindex(min(row, target), max(row, target) + 1)
+                self.endMoveRows()
+                row = target
+        self.dataChanged.emit(self.index(row, 2), self.index(row, 4))
+
+    def invoice_changed(self):
+        self.beginResetModel()
+        self._rebuild()
+        self.endResetModel()
+
+    def boxes_reset(self):
+        self.invoice_changed()
+
+
+class HistoryFilterProxy(QSortFilterProxyModel):
+    """Скрывает строки истории по фильтру HistoryModel; подгрузку и новые строки прокси передаёт как есть"""
+    def filterAcceptsRow(self, source_row, source_parent):
+        return self.sourceModel().accepts(source_row, source_parent)
+
+    def refilter(self):
+        self.invalidateFilter()
+
+
+class RefreshScheduler(QObject):
+    """Отложенное обновление окна. Обработчики событий только помечают области,
+    а обновление выполняется один раз в конце прохода цикла событий,
+    поэтому серия сканов подряд приводит к одной перерисовке и одному сохранению"""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # (область, обработчик) в порядке выполнения
+        self.handlers = []
+        self.dirty = set()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.flush)
+
+    def add(self, region, handler):
+        self.handlers.append((region, handler))
+
+    def mark(self, *regions):
+        self.dirty.update(regions)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        self.timer.stop()
+        dirty, self.dirty = self.dirty, set()
+        for region, handler in self.handlers:
+            if region in dirty:
+                handler()
+
+
+class SettingsBuffer(QObject):
+    """Настройки интерфейса с отложенной записью. Изменения копятся в памяти
+    и пишутся на диск одной пачкой, когда пользователь перестал их менять, и при выходе"""
+    IDLE_MS = 1000
+
+    def __init__(self, settings, parent=None):
+        super().__init__(parent)
+        self.settings = settings
+        self.pending = {}
+        # Отложенные сохранения (например, файла состояния) без повторов, в порядке добавления
+        self.writers = []
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.IDLE_MS)
+        self.timer.timeout.connect(self.flush)
+
+    def value(self, key, default=None, type=None):
+        if key in self.pending:
+            return self.pending[key]
+        if type is None:
+            return self.settings.value(key, default)
+        return self.settings.value(key, default, type=type)
+
+    def setValue(self, key, value):
+        self.pending[key] = value
+        # Каждое изменение откладывает запись: перетаскивание столбца пишется один раз
+        self.timer.start()
+
+    def defer(self, writer):
+        if writer not in self.writers:
+            self.writers.append(writer)
+        self.timer.start()
+
+    def flush(self):
+        self.timer.stop()
+        pending, self.pending = self.pending, {}
+        writers, self.writers = self.writers, []
+        for key, value in pending.items():
+            self.settings.setValue(key, value)
+        if pending:
+            self.settings.sync()
+        for writer in writers:
+            writer()
+
+
 class QBarcodeApp(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -749,18 +1779,9 @@ class QBarcodeApp(QMainWindow):
         self.log_dir = os.path.join(base_path, "logs")
         os.makedirs(self.log_dir, exist_ok=True)
 
-        self.all_boxes = {}
-        self.current_box_barcode = ""
+        # Вся логика сборки живёт в сессии, окно только отображает её состояние
+        self.session = ScanSession(undo_size=10)
         self.search_query = ""
-        self.packer_name = ""
-        
-        self.invoice_data = {}
-        self.invoice_loaded = False
-        self.invoice_file_name = ""
-        self.invoice_file_path = ""
-        
-        self.scan_history = []
-        self.undo_manager = UndoManager(max_size=10)
         
         self.start_time = None
         self.paused_time = None
@@ -769,20 +1790,38 @@ class QBarcodeApp(QMainWindow):
         self.total_scans = 0
         self.has_unsaved_changes = False
         self.first_scan_done = False
+        self.export_threads = []
         
         self.update_timer = QTimer()
         self.update_timer.timeout.connect(self.update_stats)
         self.update_timer.start(1000)
+
+        self.ui_refresh = RefreshScheduler(self)
+        self.ui_refresh.add('tree', self.update_items_view)
+        self.ui_refresh.add('summary', self.update_summary)
+        self.ui_refresh.add('stats', self.update_stats)
+        self.ui_refresh.add('stats', self.update_reconciliation_stats)
+        self.ui_refresh.add('undo', self.update_undo_button_state)
+        self.ui_refresh.add('persist', self.save_state)
+
+        # Подсветка поля после скана: один таймер на все поля, повторный скан только продлевает её
+        self.flash_entry = None
+        self.flash_timer = QTimer(self)
+        self.flash_timer.setSingleShot(True)
+        self.flash_timer.setInterval(200)
+        self.flash_timer.timeout.connect(self.end_highlight)
         
         self.state_file_dir = Path(os.path.expanduser("~")) / ".ScanBox"
         os.makedirs(self.state_file_dir, exist_ok=True)
         self.state_file = str(self.state_file_dir / "barcode_app_state.json")
         
         self.settings = QSettings("ScanBox", "ScanBox")
+        self.ui_settings = SettingsBuffer(self.settings, self)
 
+        self.invoice_window = None
         self.history_window = None
         self.history_tree = None
-        self.comments = {}
+        self.history_model = None
         self.history_filter_query = ""
 
         self.COLOR_BG = "#f8f9fa"
@@ -812,7 +1851,6 @@ class QBarcodeApp(QMainWindow):
         self.central_widget.setLayout(self.main_layout)
         self.main_layout.setContentsMargins(10, 10, 10, 10)
 
-        self.strict_validation_enabled = True
         self.loader_dialog = None
         self.loader_thread = None
 
@@ -876,10 +1914,7 @@ class QBarcodeApp(QMainWindow):
             if len(result) == 5:  # Excel результат
                 invoice_data, total_items, total_quantity, file_name, file_path = result
                 
-                self.invoice_data = invoice_data
-                self.invoice_loaded = True
-                self.invoice_file_name = file_name
-                self.invoice_file_path = file_path
+                self.session.load_invoice(invoice_data, file_name, file_path)
                 self.invoice_label.setText(f"📋 Накладная: {file_name} (позиций: {total_items}, всего: {total_quantity} шт)")
                 self.clear_invoice_button.setEnabled(True)
                 self.view_invoice_button.setEnabled(True)
@@ -899,28 +1934,19 @@ class QBarcodeApp(QMainWindow):
             elif len(result) == 7:  # CSV результат
                 all_boxes, comments, scan_history, packer_name, start_time, first_scan_done, file_name = result
                 
-                self.all_boxes = all_boxes
-                self.comments = comments
-                self.scan_history = scan_history
-                
-                # Создаем новый UndoManager
-                self.undo_manager = UndoManager(max_size=10)
+                self.session.apply_csv(all_boxes, comments, scan_history, packer_name)
                 
                 if packer_name:
-                    self.packer_name = packer_name
                     self.packer_combo.setCurrentText(packer_name)
                 self.start_time = start_time
                 self.first_scan_done = first_scan_done
                 self.has_unsaved_changes = False
                 
                 self.refresh_treeview()
-                if self.all_boxes:
+                if self.session.box_count():
                     self.update_status(f"✅ Данные загружены из {file_name}")
                     self.save_button.setEnabled(True)
                     self.status_bar.showMessage(f"✅ Файл {file_name} успешно загружен!", 5000)
-                    
-                    if self.history_window and self.history_window.isVisible():
-                        self.populate_history_tree()
         
         self.loader_thread = None
         
@@ -1034,12 +2060,12 @@ class QBarcodeApp(QMainWindow):
 
     def on_packer_changed(self, index):
         if index >= 0:
-            self.packer_name = self.packer_combo.itemData(index)
-            if self.packer_name is None:
-                self.packer_name = self.packer_combo.currentText().strip()
+            self.session.packer_name = self.packer_combo.itemData(index)
+            if self.session.packer_name is None:
+                self.session.packer_name = self.packer_combo.currentText().strip()
         else:
-            self.packer_name = self.packer_combo.currentText().strip()
-        self.save_state()
+            self.session.packer_name = self.packer_combo.currentText().strip()
+        self.ui_settings.defer(self.save_state)
 
     def create_drop_indicator(self):
         self.drop_indicator = QLabel(self.centralWidget())
@@ -1165,6 +2191,9 @@ class QBarcodeApp(QMainWindow):
                 border-radius: 2px;
                 padding: 2px;
             }}
+            QLineEdit[flash="true"] {{
+                background-color: #c8e6c9;
+            }}
             QPushButton {{
                 font: bold 10pt "Segoe UI Semibold";
                 background-color: {self.COLOR_BUTTON_BG};
@@ -1212,7 +2241,7 @@ class QBarcodeApp(QMainWindow):
             QMenu::item:selected {{
                 background-color: #bbdefb;
             }}
-            QTreeWidget {{
+            QTreeView {{
                 font: 9pt "Segoe UI";
                 background-color: white;
                 alternate-background-color: #f0f0f0;
@@ -1226,7 +2255,7 @@ class QBarcodeApp(QMainWindow):
                 padding: 4px;
                 qproperty-alignment: AlignCenter;
             }}
-            QTreeWidget::item:selected {{
+            QTreeView::item:selected {{
                 background-color: #bbdefb;
                 color: black;
             }}
@@ -1330,7 +2359,7 @@ class QBarcodeApp(QMainWindow):
                 border: 1px solid #dee2e6;
                 font-weight: bold;
             }}
-            QTableWidget {{
+            QTableView {{
                 font: 9pt "Segoe UI";
                 background-color: white;
                 alternate-background-color: #f8f9fa;
@@ -1345,6 +2374,9 @@ class QBarcodeApp(QMainWindow):
                 background-color: #3498db;
                 border-radius: 2px;
             }}
+            QProgressBar[overage="true"]::chunk {{
+                background-color: #e74c3c;
+            }}
         """
 
     def create_menu_bar(self):
@@ -1448,92 +2480,23 @@ class QBarcodeApp(QMainWindow):
             else:
                 event.ignore()
 
+        if event.isAccepted():
+            # Отложенные обновления (в том числе сохранение состояния) и настройки записываем до выхода
+            self.ui_refresh.flush()
+            self.ui_settings.flush()
+            # Дожидаемся фоновых сохранений, иначе файл оборвётся при выходе
+            for thread in list(self.export_threads):
+                thread.wait()
+
     def export_report(self):
-        if not self.all_boxes:
+        if not self.session.box_count():
             self.show_warning("Нет данных для отчёта!")
             return
             
-        report_lines = []
-        report_lines.append("=" * 80)
-        report_lines.append("ОТЧЁТ О СБОРКЕ".center(80))
-        report_lines.append("=" * 80)
-        report_lines.append(f"Дата: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}")
-        report_lines.append(f"Сборщик: {self.packer_name if self.packer_name else 'не указан'}")
-        if self.invoice_loaded:
-            total_planned = sum(self.invoice_data.values())
-            report_lines.append(f"Накладная: {self.invoice_file_name} (позиций: {len(self.invoice_data)}, всего: {total_planned} шт)")
-        report_lines.append("")
+        report_text = self.session.build_report()
         
-        total_scanned = 0
-        match_count = 0
-        shortage_count = 0
-        excess_count = 0
-        extra_count = 0
-        
-        shortage_units = 0
-        excess_units = 0
-        extra_units = 0
-        
-        for box_barcode, items in self.all_boxes.items():
-            box_comment = self.comments.get((box_barcode, ""), "")
-            report_lines.append(f"\n📦 КОРОБ: {box_barcode}")
-            if box_comment:
-                report_lines.append(f"   Комментарий: {box_comment}")
-            
-            for item_barcode, count in items.items():
-                item_comment = self.comments.get((box_barcode, item_barcode), "")
-                total_scanned += count
-                
-                status = ""
-                if self.invoice_loaded:
-                    if item_barcode in self.invoice_data:
-                        planned = self.invoice_data[item_barcode]
-                        total_for_item = self.get_total_scanned_for_item(item_barcode)
-                        if total_for_item == planned:
-                            status = "✅ СОВПАДАЕТ"
-                            match_count += 1
-                        elif total_for_item < planned:
-                            diff = planned - total_for_item
-                            status = f"⚠️ НЕДОБОР (план: {planned}, всего: {total_for_item}, не хватает: {diff})"
-                            shortage_count += 1
-                            shortage_units += diff
-                        else:
-                            diff = total_for_item - planned
-                            status = f"❗ ПЕРЕБОР (план: {planned}, всего: {total_for_item}, лишних: {diff})"
-                            excess_count += 1
-                            excess_units += diff
-                    else:
-                        status = "❓ ЛИШНИЙ"
-                        extra_count += 1
-                        extra_units += count
-                
-                line = f"   • {item_barcode} - {count} шт."
-                if status:
-                    line += f" [{status}]"
-                if item_comment:
-                    line += f" ({item_comment})"
-                report_lines.append(line)
-        
-        report_lines.append("")
-        report_lines.append("-" * 80)
-        report_lines.append("ИТОГИ:")
-        report_lines.append(f"📦 Коробов: {len(self.all_boxes)}")
-        report_lines.append(f"📦 Всего товаров: {total_scanned} шт.")
-        
-        if self.invoice_loaded:
-            total_planned = sum(self.invoice_data.values())
-            report_lines.append(f"📋 План: {total_planned} шт.")
-            report_lines.append(f"✅ Совпадает: {match_count} позиций")
-            report_lines.append(f"⚠️ Недобор: {shortage_count} позиций (всего -{shortage_units} шт)")
-            report_lines.append(f"❗ Перебор: {excess_count} позиций (всего +{excess_units} шт)")
-            report_lines.append(f"❓ Лишние: {extra_count} позиций (всего +{extra_units} шт)")
-        
-        report_lines.append("=" * 80)
-        
-        report_text = "\n".join(report_lines)
-        
-        dialog = ReportDialog(report_text, self)
-        dialog.exec_()
+        dialog = ReportDialog(report_text, self)
+        dialog.exec_()
         
         dialog = ConfirmationDialog(
             "💾 Сохранить отчёт",
@@ -1586,7 +2549,7 @@ class QBarcodeApp(QMainWindow):
         validation_layout.addStretch()
         
         self.strict_validation_checkbox = QCheckBox()
-        self.strict_validation_checkbox.setChecked(self.strict_validation_enabled)
+        self.strict_validation_checkbox.setChecked(self.session.strict_validation_enabled)
         self.strict_validation_checkbox.setStyleSheet("""
             QCheckBox::indicator {
                 width: 20px;
@@ -1668,7 +2631,7 @@ class QBarcodeApp(QMainWindow):
         dialog.exec_()
 
     def save_settings(self, dialog):
-        self.strict_validation_enabled = self.strict_validation_checkbox.isChecked()
+        self.session.strict_validation_enabled = self.strict_validation_checkbox.isChecked()
         self.save_state()
         dialog.accept()
         
@@ -1695,6 +2658,12 @@ class QBarcodeApp(QMainWindow):
         tooltip_search_entry = ToolTip(self.search_entry)
         tooltip_search_entry.setToolTip("Введите текст для фильтрации списка товаров")
 
+        self.focus_checkbox = QCheckBox("🎯 Только текущий короб")
+        search_layout.addWidget(self.focus_checkbox)
+
+        tooltip_focus = ToolTip(self.focus_checkbox)
+        tooltip_focus.setToolTip("Показывать только текущий короб и недавние короба; снимите флажок, чтобы увидеть все короба")
+
         spacer = QSpacerItem(40, 20, QSizePolicy.Expanding, QSizePolicy.Minimum)
         search_layout.addItem(spacer)
 
@@ -1762,19 +2731,68 @@ class QBarcodeApp(QMainWindow):
         items_layout = QVBoxLayout()
         self.items_frame.setLayout(items_layout)
 
-        self.items_tree = QTreeWidget()
+        # Режим фокуса: итоги короба и недавние короба над деревом, само дерево — только товары короба
+        self.focus_frame = QWidget()
+        items_layout.addWidget(self.focus_frame)
+        focus_layout = QHBoxLayout(self.focus_frame)
+        focus_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.focus_box_label = QLabel()
+        self.focus_box_label.setStyleSheet("font-weight: bold;")
+        focus_layout.addWidget(self.focus_box_label)
+        focus_layout.addStretch()
+
+        focus_layout.addWidget(QLabel("🕘 Недавние:"))
+        self.recent_boxes_list = QListWidget()
+        self.recent_boxes_list.setFlow(QListWidget.LeftToRight)
+        self.recent_boxes_list.setFixedHeight(28)
+        self.recent_boxes_list.setMaximumWidth(600)
+        self.recent_boxes_list.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.recent_boxes_list.itemClicked.connect(self.show_recent_box)
+        focus_layout.addWidget(self.recent_boxes_list)
+        self.focus_frame.hide()
+
+        self.focus_mode = False
+        self.focus_box = ""
+        self.focus_current = ""
+        self.recent_boxes = []
+        self.recent_boxes_limit = 8
+        self.shown_recent_boxes = None
+
+        self.items_model = ItemsModel(self.session, self)
+        self.items_tree = QTreeView()
         items_layout.addWidget(self.items_tree)
-        self.items_tree.setColumnCount(6)
-        self.items_tree.setHeaderLabels(["Статус", "📦 Короб", "🏷 Товар", "🛒 Собрано", "📋 План", "💬 Комментарий"])
+        self.items_tree.setModel(self.items_model)
+        self.items_tree.setItemDelegate(ItemsDelegate(self.items_tree))
+        # Количество, штрихкод товара и комментарии правятся прямо в ячейке
+        self.items_tree.setEditTriggers(QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
+        self.items_model.edited.connect(self.on_item_edited)
+        # Ошибку показываем после закрытия редактора, а не изнутри setData
+        self.items_model.edit_failed.connect(self.show_error, Qt.QueuedConnection)
+        self.items_model.delete_requested.connect(self.on_zero_count_edited, Qt.QueuedConnection)
+        self.items_filter = ItemsFilter(self.session, self.items_model, self.items_tree)
+        self.items_tree.setUniformRowHeights(True)
         self.items_tree.header().setSectionResizeMode(QHeaderView.Interactive)
         self.items_tree.setAlternatingRowColors(True)
-        self.items_tree.itemClicked.connect(self.clear_selection)
+        self.items_tree.clicked.connect(self.clear_selection)
         self.items_tree.customContextMenuRequested.connect(self.show_context_menu)
         self.items_tree.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.items_tree.itemDoubleClicked.connect(self.on_double_click)
         self.items_tree.header().sectionResized.connect(self.save_column_settings)
-        for i in range(self.items_tree.columnCount()):
-            self.items_tree.headerItem().setTextAlignment(i, Qt.AlignCenter)
+        # Сортировка по клику на заголовок; пока столбец не выбран — порядок сканирования
+        self.items_tree.header().setSortIndicator(-1, Qt.AscendingOrder)
+        self.items_tree.setSortingEnabled(True)
+        self.items_tree.header().setContextMenuPolicy(Qt.CustomContextMenu)
+        self.items_tree.header().customContextMenuRequested.connect(self.show_items_header_menu)
+        # Сам раскрывается только текущий короб; раскрытые вручную переживают сброс модели
+        self.current_box_row = QPersistentModelIndex()
+        self.current_box_expanded = False
+        self.expanded_boxes = []
+        self.items_model.modelAboutToBeReset.connect(self.remember_expanded_boxes)
+        self.items_model.modelReset.connect(self.restore_expanded_boxes)
+        # Удалённый короб-корень превращает дерево в полное — переключаемся сразу, не дожидаясь обновления
+        self.items_model.rowsRemoved.connect(lambda parent: self.focus_mode and not parent.isValid() and self.update_box_focus())
+        self.focus_checkbox.toggled.connect(self.toggle_focus_mode)
+        self.focus_checkbox.setChecked(self.ui_settings.value("focus_mode", False, type=bool))
         self.items_tree.setColumnWidth(0, 80)
         self.items_tree.setColumnWidth(1, 180)
         self.items_tree.setColumnWidth(2, 180)
@@ -1836,7 +2854,7 @@ class QBarcodeApp(QMainWindow):
         stats_layout.addLayout(status_layout, 2, 0, 1, 2)
 
     def toggle_pause(self):
-        if not self.invoice_loaded:
+        if not self.session.invoice_loaded:
             return
             
         self.is_paused = not self.is_paused
@@ -1851,7 +2869,8 @@ class QBarcodeApp(QMainWindow):
                 paused_duration = time() - self.pause_start
                 self.start_time += paused_duration
             self.pause_start = None
-        self.save_state()
+            self.ui_refresh.mark('stats')
+        self.ui_refresh.mark('persist')
 
     def create_control_frame(self):
         self.control_frame = QWidget()
@@ -1907,20 +2926,13 @@ class QBarcodeApp(QMainWindow):
         self.status_bar.setStyleSheet(f"QStatusBar{{background-color: {self.COLOR_HEADER_BG}; border-top: 1px solid #ced4da;}}")
         self.status_bar.showMessage("💡 Перетащите CSV или Excel файл в окно для быстрого импорта")
 
-    def get_total_scanned_for_item(self, item_barcode, exclude_box=None):
-        total = 0
-        for box_barcode, items in self.all_boxes.items():
-            if exclude_box and box_barcode == exclude_box:
-                continue
-            if item_barcode in items:
-                total += items[item_barcode]
-        return total
-
     def update_stats(self):
-        if not self.invoice_loaded:
+        # Вызывается таймером каждую секунду, поэтому обновляет только время и скорость
+        if not self.session.invoice_loaded:
             self.time_label.setText("⏱️ Время: 00:00:00")
             self.speed_label.setText("⚡ Скорость: 0/мин")
             self.progress_bar.setValue(0)
+            self.set_style_state(self.progress_bar, "overage", False)
             return
             
         if not self.first_scan_done or self.is_paused:
@@ -1938,263 +2950,84 @@ class QBarcodeApp(QMainWindow):
             if elapsed > 0:
                 speed = (self.total_scans * 60) / elapsed
                 self.speed_label.setText(f"⚡ Скорость: {speed:.1f}/мин")
-        
-        if self.invoice_loaded:
-            total_planned = sum(self.invoice_data.values())
-            total_scanned_planned = 0
-            total_scanned_all = 0
-            
-            for item_barcode, planned in self.invoice_data.items():
-                scanned = self.get_total_scanned_for_item(item_barcode)
-                total_scanned_planned += min(scanned, planned)
-                total_scanned_all += scanned
-            
-            for box_barcode, items in self.all_boxes.items():
-                for item_barcode, count in items.items():
-                    if item_barcode not in self.invoice_data:
-                        total_scanned_all += count
-            
-            match_count = 0
-            shortage_count = 0
-            excess_count = 0
-            extra_count = 0
-            
-            shortage_units = 0
-            excess_units = 0
-            extra_units = 0
-            
-            for item_barcode, planned in self.invoice_data.items():
-                scanned = self.get_total_scanned_for_item(item_barcode)
-                
-                if scanned == planned:
-                    match_count += 1
-                elif scanned < planned:
-                    shortage_count += 1
-                    shortage_units += planned - scanned
-                else:
-                    excess_count += 1
-                    excess_units += scanned - planned
-            
-            for box_barcode, items in self.all_boxes.items():
-                for item_barcode, count in items.items():
-                    if item_barcode not in self.invoice_data:
-                        extra_count += 1
-                        extra_units += count
-            
-            if total_planned > 0:
-                progress = min(100, int((total_scanned_planned / total_planned) * 100))
-                self.progress_bar.setValue(progress)
-                self.progress_bar.setFormat(f"%p% ({total_scanned_planned}/{total_planned})")
-                
-                if total_scanned_all > total_planned:
-                    self.progress_bar.setStyleSheet("QProgressBar::chunk { background-color: #e74c3c; }")
-                else:
-                    self.progress_bar.setStyleSheet("QProgressBar::chunk { background-color: #3498db; }")
-            
-            self.match_label.setText(f"✅ {match_count}")
-            self.shortage_label.setText(f"⚠️ {shortage_count} (-{shortage_units})")
-            self.excess_label.setText(f"❗ {excess_count} (+{excess_units})")
-            self.extra_label.setText(f"❓ {extra_count} (+{extra_units})")
-
-    def convert_ru_to_en_layout_box(self, barcode):
-        if len(barcode) >= 3 and barcode.lower().startswith('ца'):
-            barcode = 'wb' + barcode[2:]
-        elif len(barcode) >= 4 and barcode.lower().startswith('ци_'):
-            barcode = 'WB_' + barcode[3:]
-        return barcode
-
-    def convert_ru_to_en_layout_item(self, barcode):
-        if len(barcode) >= 4 and barcode.lower().startswith('щят'):
-            barcode = 'OZN' + barcode[3:]
-        return barcode
-
-    def is_valid_barcode(self, barcode, barcode_type):
-        if not self.strict_validation_enabled:
-            return bool(re.match(r"^[\w\-\./]+$", barcode)) and 4 <= len(barcode) <= 50
-        
-        patterns = {
-            'box': [
-                r'^WB_[\w\-]+$',
-                r'^\d{8,}$',
-                r'^[A-Z]{2}\d{6,}$',
-                r'^[A-Z0-9]{10,}$'
-            ],
-            'item': [
-                r'^\d{8}$',
-                r'^\d{12}$',
-                r'^\d{13}$',
-                r'^OZN\d+$',
-                r'^ozn\d+$',
-                r'^[A-Z]{2}\d{9}[A-Z]{2}$',
-                r'^[0-9]{8,14}$'
-            ]
-        }
-        
-        for pattern in patterns.get(barcode_type, patterns['item']):
-            if re.match(pattern, barcode, re.IGNORECASE):
-                return 4 <= len(barcode) <= 50
-        return False
 
-    def check_duplicate_item(self, barcode, current_box):
-        """Проверка дубликатов с учетом плана"""
-        if not self.invoice_loaded:
-            return []  # Без накладной не предупреждаем
+    def update_reconciliation_stats(self):
+        if not self.session.invoice_loaded or not self.first_scan_done or self.is_paused:
+            return
+
+        stats = self.session.scan_index.reconciliation
+        if stats.planned_total > 0:
+            progress = min(100, int((stats.scanned_planned / stats.planned_total) * 100))
+            self.progress_bar.setValue(progress)
+            self.progress_bar.setFormat(f"%p% ({stats.scanned_planned}/{stats.planned_total})")
             
-        total_scanned = self.get_total_scanned_for_item(barcode)
-        planned = self.invoice_data.get(barcode, 0)
+            self.set_style_state(self.progress_bar, "overage", self.session.scan_index.grand_total > stats.planned_total)
         
-        # Если план есть и общее количество не превышает план - ок
-        if planned > 0 and total_scanned < planned:
-            return []
-            
-        # Ищем в каких коробах уже есть этот товар
-        duplicate_boxes = []
-        for box_barcode, items in self.all_boxes.items():
-            if box_barcode != current_box and barcode in items:
-                duplicate_boxes.append(box_barcode)
-        return duplicate_boxes
+        self.match_label.setText(f"✅ {stats.match_count}")
+        self.shortage_label.setText(f"⚠️ {stats.shortage_count} (-{stats.shortage_units})")
+        self.excess_label.setText(f"❗ {stats.excess_count} (+{stats.excess_units})")
+        self.extra_label.setText(f"❓ {stats.extra_count} (+{stats.extra_units})")
 
     def update_undo_button_state(self):
-        self.undo_button.setEnabled(self.undo_manager.can_undo())
+        self.undo_button.setEnabled(self.session.undo_manager.can_undo())
 
     def undo_last_action(self):
-        if not self.undo_manager.can_undo():
-            return
-            
-        action = self.undo_manager.undo()
-        if not action:
+        if not self.session.undo_manager.can_undo():
             return
             
-        action_type = action.get('type')
-        
-        if action_type == 'scan':
-            box = action['box_barcode']
+        action = self.session.undo()
+        if action and action.get('type') == 'scan':
             item = action['barcode']
-            
-            if box in self.all_boxes and item in self.all_boxes[box]:
-                old_count = self.all_boxes[box][item]
-                
-                if self.all_boxes[box][item] <= 1:
-                    del self.all_boxes[box][item]
-                    if not self.all_boxes[box]:
-                        del self.all_boxes[box]
-                        if self.current_box_barcode == box:
-                            self.current_box_barcode = ""
-                            self.box_entry.setEnabled(True)
-                            self.item_scan_entry.setEnabled(False)
-                else:
-                    self.all_boxes[box][item] -= 1
-                
-                self.scan_history.append({
-                    'timestamp': datetime.now().isoformat(),
-                    'type': 'item',
-                    'barcode': item,
-                    'box_barcode': box,
-                    'action': 'undo',
-                    'action_type': 'undo',
-                    'details': f'↩️ Отмена сканирования (было {old_count} → {old_count - 1})'
-                })
-                
-                self.total_scans = max(0, self.total_scans - 1)
-                self.update_status(f"↩️ Отменён товар: {item}")
-                self.scan_notification.show_notification(f"↩️ Отмена: {item}")
-                
-        elif action_type == 'edit_count':
-            box = action['box_barcode']
-            item = action['barcode']
-            old_count = action['old_value']
-            new_count = action['new_value']
-            
-            if box in self.all_boxes:
-                if old_count == 0:
-                    # Было удаление - восстанавливаем
-                    self.all_boxes[box][item] = new_count
-                else:
-                    self.all_boxes[box][item] = old_count
-                    
-            self.scan_history.append({
-                'timestamp': datetime.now().isoformat(),
-                'type': 'item',
-                'barcode': item,
-                'box_barcode': box,
-                'action': 'undo',
-                'action_type': 'undo',
-                'details': f'↩️ Отмена изменения количества: {new_count} → {old_count}'
-            })
-            
-        elif action_type == 'edit_barcode':
-            box = action['box_barcode']
-            old_barcode = action['old_value']
-            new_barcode = action['new_value']
-            count = action['count']
-            
-            if box in self.all_boxes and new_barcode in self.all_boxes[box]:
-                del self.all_boxes[box][new_barcode]
-                self.all_boxes[box][old_barcode] = count
+            if not self.session.current_box_barcode:
+                self.box_entry.setEnabled(True)
+                self.item_scan_entry.setEnabled(False)
                 
-            self.scan_history.append({
-                'timestamp': datetime.now().isoformat(),
-                'type': 'item',
-                'barcode': old_barcode,
-                'box_barcode': box,
-                'action': 'undo',
-                'action_type': 'undo',
-                'details': f'↩️ Отмена изменения штрихкода: {new_barcode} → {old_barcode}'
-            })
+            self.total_scans = max(0, self.total_scans - 1)
+            self.update_status(f"↩️ Отменён товар: {item}")
+            self.scan_notification.show_notification(f"↩️ Отмена: {item}")
             
         self.has_unsaved_changes = True
         self.refresh_treeview()
-        self.update_undo_button_state()
+        self.ui_refresh.mark('undo')
 
     def process_box_barcode(self):
         barcode_input = self.box_entry.text().strip()
-        barcode = self.convert_ru_to_en_layout_box(barcode_input)
+        barcode = self.session.convert_ru_to_en_layout_box(barcode_input)
         
         if not barcode:
             self.show_warning("Введите штрихкод короба!")
             return
 
-        if not self.is_valid_barcode(barcode, barcode_type='box'):
-            self.show_error("Неверный штрихкод короба!")
+        try:
+            self.session.scan_box(barcode)
+        except ScanError as e:
+            self.show_error(str(e))
             self.box_entry.clear()
             return
 
-        if barcode not in self.all_boxes:
-            self.all_boxes[barcode] = {}
-
-        self.current_box_barcode = barcode
         self.box_entry.setEnabled(False)
         self.item_scan_entry.setEnabled(True)
         self.item_scan_entry.setFocus()
         self.save_button.setEnabled(True)
         
-        if self.invoice_loaded and not self.first_scan_done and not self.start_time:
+        if self.session.invoice_loaded and not self.first_scan_done and not self.start_time:
             self.start_time = time()
             self.first_scan_done = True
             self.pause_button.show()
             
         self.has_unsaved_changes = True
-        self.update_status(f"✅ Текущий короб: {self.current_box_barcode}")
+        self.update_status(f"✅ Текущий короб: {self.session.current_box_barcode}")
         self.refresh_treeview()
         
-        self.scan_history.append({
-            'timestamp': datetime.now().isoformat(),
-            'type': 'box',
-            'barcode': barcode,
-            'action': 'scan',
-            'action_type': 'scan',
-            'details': ''
-        })
-        
         self.highlight_entry(self.box_entry)
         self.scan_notification.show_notification(f"📦 Короб: {barcode}")
-        self.update_undo_button_state()
+        self.ui_refresh.mark('undo')
 
     def process_item_barcode(self):
         barcode_input = self.item_scan_entry.text().strip()
-        barcode = self.convert_ru_to_en_layout_item(barcode_input)
+        barcode = self.session.convert_ru_to_en_layout_item(barcode_input)
 
-        if not self.current_box_barcode:
+        if not self.session.current_box_barcode:
             self.show_warning("Сначала отсканируйте штрихкод короба!")
             self.item_scan_entry.clear()
             self.box_entry.setFocus()
@@ -2202,18 +3035,18 @@ class QBarcodeApp(QMainWindow):
         if not barcode:
             self.show_warning("Введите штрихкод товара!")
             return
-        if not self.is_valid_barcode(barcode, barcode_type='item'):
+        if not self.session.is_valid_barcode(barcode, barcode_type='item'):
             self.show_error("Неверный штрихкод товара!")
             self.item_scan_entry.clear()
             return
-        if self.current_box_barcode not in self.all_boxes:
+        if not self.session.has_box(self.session.current_box_barcode):
             QMessageBox.critical(self, "Ошибка", "Текущий короб не найден!")
             return
         
-        duplicate_boxes = self.check_duplicate_item(barcode, self.current_box_barcode)
+        duplicate_boxes = self.session.check_duplicate_item(barcode, self.session.current_box_barcode)
         if duplicate_boxes:
-            total_scanned = self.get_total_scanned_for_item(barcode)
-            planned = self.invoice_data.get(barcode, 0)
+            total_scanned = self.session.get_total_scanned_for_item(barcode)
+            planned = self.session.invoice_data.get(barcode, 0)
             
             msg = f"⚠️ Товар {barcode} уже есть в короб(ах):\n"
             for box in duplicate_boxes:
@@ -2241,55 +3074,40 @@ class QBarcodeApp(QMainWindow):
                 self.item_scan_entry.clear()
                 return
             
-        self.add_item(barcode)
+        self.session.scan_item(barcode)
+        # Скан возвращает режим фокуса от просматриваемого короба к текущему
+        self.focus_box = self.session.current_box_barcode
+        self.refresh_treeview()
         
         self.total_scans += 1
         self.has_unsaved_changes = True
         
-        if self.invoice_loaded and not self.first_scan_done and not self.start_time:
+        if self.session.invoice_loaded and not self.first_scan_done and not self.start_time:
             self.start_time = time()
             self.first_scan_done = True
             self.pause_button.show()
         
-        # Добавляем действие в стек отмены
-        self.undo_manager.add_action({
-            'type': 'scan',
-            'barcode': barcode,
-            'box_barcode': self.current_box_barcode
-        })
-        
-        self.scan_history.append({
-            'timestamp': datetime.now().isoformat(),
-            'type': 'item',
-            'barcode': barcode,
-            'box_barcode': self.current_box_barcode,
-            'action': 'scan',
-            'action_type': 'scan',
-            'details': f'📷 Сканирование товара'
-        })
-        
-        if self.invoice_loaded:
-            if barcode not in self.invoice_data:
+        if self.session.invoice_loaded:
+            if barcode not in self.session.invoice_data:
                 self.scan_notification.show_notification(f"⚠️ Товар {barcode}\nотсутствует в накладной!", True)
                 QApplication.beep()
             else:
-                total_scanned = self.get_total_scanned_for_item(barcode)
-                planned = self.invoice_data[barcode]
+                total_scanned = self.session.get_total_scanned_for_item(barcode)
+                planned = self.session.invoice_data[barcode]
                 
                 if total_scanned > planned:
                     self.scan_notification.show_notification(f"❗ ПЕРЕБОР: {barcode}\nплан: {planned}, всего: {total_scanned}", True)
                     QApplication.beep()
                 elif total_scanned == planned:
-                    self.scan_notification.show_notification(f"✅ План выполнен: {barcode}")
+                    self.scan_notification.show_notification(f"✅ План выполнен: {barcode}", is_scan=True)
                 else:
                     remaining = planned - total_scanned
-                    self.scan_notification.show_notification(f"✅ {barcode}\nосталось: {remaining}")
+                    self.scan_notification.show_notification(f"✅ {barcode}\nосталось: {remaining}", is_scan=True)
         
         if self.autoclear_item_entry.isChecked():
             self.item_scan_entry.clear()
         self.highlight_entry(self.item_scan_entry)
-        self.save_state()
-        self.update_undo_button_state()
+        self.ui_refresh.mark('persist', 'undo')
 
     def show_history(self):
         if self.history_window and self.history_window.isVisible():
@@ -2311,18 +3129,31 @@ class QBarcodeApp(QMainWindow):
 
         self.history_filter_entry = QLineEdit()
         filter_layout.addWidget(self.history_filter_entry)
-        self.history_filter_entry.textChanged.connect(self.filter_history)
+        # Фильтр применяется после паузы в наборе, как и поиск в основном окне
+        self.history_filter_timer = QTimer(self.history_window)
+        self.history_filter_timer.setSingleShot(True)
+        self.history_filter_timer.setInterval(ItemsFilter.DELAY_MS)
+        self.history_filter_timer.timeout.connect(self.filter_history)
+        self.history_filter_entry.textChanged.connect(lambda: self.history_filter_timer.start())
         
         filter_layout.addStretch()
         
-        info_label = QLabel(f"👤 Сборщик: {self.packer_name if self.packer_name else 'не указан'}")
+        info_label = QLabel(f"👤 Сборщик: {self.session.packer_name if self.session.packer_name else 'не указан'}")
         info_label.setStyleSheet("color: #3498db; font-weight: bold;")
         filter_layout.addWidget(info_label)
 
-        self.history_tree = QTreeWidget()
+        # Модель истории следит за сессией, пока окно открыто
+        self.history_model = HistoryModel(self.session, self.history_window)
+        self.history_proxy = HistoryFilterProxy(self.history_window)
+        self.history_proxy.setSourceModel(self.history_model)
+        self.history_window.finished.connect(self.on_history_closed)
+
+        self.history_tree = QTreeView()
         layout.addWidget(self.history_tree)
-        self.history_tree.setColumnCount(6)
-        self.history_tree.setHeaderLabels(["📦 Короб", "🏷 Товар", "📦 Кол-во", "⚡ Действие", "📝 Детали", "📅 Время"])
+        self.history_tree.setModel(self.history_proxy)
+        # Прочие типы действий, как и раньше, зелёные
+        self.history_tree.setItemDelegate(StatusDelegate(self.history_tree, default='scan'))
+        self.history_tree.setUniformRowHeights(True)
         self.history_tree.header().setSectionResizeMode(QHeaderView.Stretch)
         self.history_tree.header().setSectionResizeMode(0, QHeaderView.Interactive)
         self.history_tree.header().setSectionResizeMode(1, QHeaderView.Interactive)
@@ -2337,253 +3168,160 @@ class QBarcodeApp(QMainWindow):
         self.history_tree.setColumnWidth(4, 300)
         self.history_tree.setAlternatingRowColors(True)
 
-        self.populate_history_tree()
         self.history_window.show()
 
-    def populate_history_tree(self):
-        self.history_tree.clear()
-        
-        boxes_data = {}
-        
-        for entry in self.scan_history:
-            if entry['type'] == 'box':
-                box_barcode = entry['barcode']
-                if box_barcode not in boxes_data:
-                    boxes_data[box_barcode] = {
-                        'timestamp': entry['timestamp'],
-                        'action': entry.get('action', 'scan'),
-                        'action_type': entry.get('action_type', 'scan'),
-                        'details': entry.get('details', ''),
-                        'items': {}
-                    }
-        
-        for entry in self.scan_history:
-            if entry['type'] == 'item':
-                box_barcode = entry.get('box_barcode')
-                if box_barcode in boxes_data:
-                    item_barcode = entry['barcode']
-                    if item_barcode not in boxes_data[box_barcode]['items']:
-                        boxes_data[box_barcode]['items'][item_barcode] = []
-                    boxes_data[box_barcode]['items'][item_barcode].append(entry)
-
-        for box_barcode, box_data in boxes_data.items():
-            try:
-                dt = datetime.fromisoformat(box_data['timestamp'])
-                box_time = dt.strftime("%d.%m.%Y %H:%M:%S")
-            except:
-                box_time = box_data['timestamp']
-            
-            action_type_display = "📌" if box_data['action_type'] == 'scan' else "✏️"
-            action_display = "Открытие короба" if box_data['action_type'] == 'scan' else "Изменение короба"
-            
-            box_item = QTreeWidgetItem(self.history_tree)
-            box_item.setText(0, f"📦 {box_barcode}")
-            box_item.setText(1, "")
-            box_item.setText(2, action_type_display)
-            box_item.setText(3, action_display)
-            box_item.setText(4, box_data['details'])
-            box_item.setText(5, box_time)
-            
-            font = QFont()
-            font.setBold(True)
-            for i in range(6):
-                box_item.setFont(i, font)
-            
-            for item_barcode, entries in box_data['items'].items():
-                # Получаем актуальное количество товара в коробе
-                actual_count = self.all_boxes.get(box_barcode, {}).get(item_barcode, 0)
-                
-                item_main = QTreeWidgetItem(box_item)
-                item_main.setText(0, "  🏷")
-                item_main.setText(1, item_barcode)
-                item_main.setText(2, f"📦 {actual_count}")
-                item_main.setText(3, f"{len(entries)} операций")
-                item_main.setText(4, "")
-                item_main.setText(5, "")
-                
-                font = QFont()
-                font.setBold(True)
-                for i in range(6):
-                    item_main.setFont(i, font)
-                
-                for entry in entries:
-                    try:
-                        dt = datetime.fromisoformat(entry['timestamp'])
-                        item_time = dt.strftime("%d.%m.%Y %H:%M:%S")
-                    except:
-                        item_time = entry['timestamp']
-                    
-                    action_type = entry.get('action_type', 'scan')
-                    action = entry.get('action', 'scan')
-                    details = entry.get('details', '')
-                    
-                    if action_type == 'undo':
-                        action_type_icon = "↩️"
-                    elif action_type == 'edit':
-                        action_type_icon = "✏️"
-                    else:
-                        action_type_icon = "📷"
-                    
-                    if action == 'scan':
-                        action_text = "Сканирование"
-                    elif action == 'edit_count':
-                        action_text = "Изменение количества"
-                    elif action == 'edit_barcode':
-                        action_text = "Изменение штрихкода"
-                    elif action == 'edit_comment':
-                        action_text = "Изменение комментария"
-                    elif action == 'delete':
-                        action_text = "Удаление"
-                    elif action == 'undo':
-                        action_text = "↩️ Отмена"
-                    else:
-                        action_text = action
-                    
-                    entry_item = QTreeWidgetItem(item_main)
-                    entry_item.setText(0, "    •")
-                    entry_item.setText(1, "")
-                    entry_item.setText(2, action_type_icon)
-                    entry_item.setText(3, action_text)
-                    entry_item.setText(4, details)
-                    entry_item.setText(5, item_time)
-                    
-                    if action_type == 'edit':
-                        for i in range(6):
-                            entry_item.setForeground(i, QColor("#e67e22"))
-                    elif action_type == 'undo':
-                        for i in range(6):
-                            entry_item.setForeground(i, QColor("#9b59b6"))
-                    else:
-                        for i in range(6):
-                            entry_item.setForeground(i, QColor("#2ecc71"))
-                
-                item_main.setExpanded(False)
-            
-            box_item.setExpanded(False)
+    def on_history_closed(self):
+        if self.history_model in self.session.observers:
+            self.session.observers.remove(self.history_model)
+        self.history_tree = None
 
     def filter_history(self):
         if not self.history_tree:
             return
-            
-        filter_text = self.history_filter_entry.text().lower()
-        
-        for i in range(self.history_tree.topLevelItemCount()):
-            box_item = self.history_tree.topLevelItem(i)
-            box_visible = False
-            
-            if filter_text in box_item.text(0).lower():
-                box_visible = True
-            
-            for j in range(box_item.childCount()):
-                item_main = box_item.child(j)
-                item_visible = False
-                
-                if filter_text in item_main.text(1).lower():
-                    item_visible = True
-                    box_visible = True
-                
-                for k in range(item_main.childCount()):
-                    entry_item = item_main.child(k)
-                    entry_visible = False
-                    
-                    if (filter_text in entry_item.text(3).lower() or 
-                        filter_text in entry_item.text(4).lower()):
-                        entry_visible = True
-                        item_visible = True
-                        box_visible = True
-                    
-                    entry_item.setHidden(not entry_visible)
-                
-                item_main.setHidden(not item_visible)
-            
-            box_item.setHidden(not box_visible)
+        self.history_model.set_filter(self.history_filter_entry.text())
+        self.history_proxy.refilter()
+
+    def set_style_state(self, widget, name, value):
+        # Оформление состояний — в общем get_stylesheet по динамическим свойствам;
+        # виджет перерисовывается стилем только когда состояние действительно сменилось
+        if widget.property(name) == value:
+            return
+        widget.setProperty(name, value)
+        widget.style().unpolish(widget)
+        widget.style().polish(widget)
 
     def highlight_entry(self, entry):
-        entry.setStyleSheet("QLineEdit { background-color: #c8e6c9; }")
-        QTimer.singleShot(200, lambda: entry.setStyleSheet(""))
+        if self.flash_entry is not None and self.flash_entry is not entry:
+            self.set_style_state(self.flash_entry, "flash", False)
+        self.flash_entry = entry
+        self.set_style_state(entry, "flash", True)
+        self.flash_timer.start()
 
-    def add_item(self, item_barcode):
-        if item_barcode in self.all_boxes[self.current_box_barcode]:
-            self.all_boxes[self.current_box_barcode][item_barcode] += 1
-        else:
-            self.all_boxes[self.current_box_barcode][item_barcode] = 1
-        self.refresh_treeview()
+    def end_highlight(self):
+        if self.flash_entry is not None:
+            self.set_style_state(self.flash_entry, "flash", False)
+            self.flash_entry = None
 
     def refresh_treeview(self):
-        self.items_tree.clear()
-        for box_barcode, items in self.all_boxes.items():
-            box_comment = self.comments.get((box_barcode, ""), "")
-            box_item = QTreeWidgetItem(self.items_tree, ["", box_barcode, "", "", "", box_comment])
-            box_item.setFlags(box_item.flags() | Qt.ItemIsTristate)
-            
-            font = QFont()
-            font.setBold(True)
-            for i in range(6):
-                box_item.setFont(i, font)
-            
-            self.items_tree.expandItem(box_item)
+        # Строки дерева обновляет ItemsModel по сигналам сессии; итоги пересчитываются один раз за проход цикла событий
+        self.ui_refresh.mark('tree', 'summary', 'stats')
+
+    def show_items_header_menu(self, point):
+        header = self.items_tree.header()
+        menu = QMenu(self)
+        shortage_action = QAction("⚠️ Сначала недостача", self)
+        shortage_action.triggered.connect(lambda: header.setSortIndicator(0, Qt.AscendingOrder))
+        menu.addAction(shortage_action)
+        scan_order_action = QAction("🕘 Порядок сканирования", self)
+        scan_order_action.triggered.connect(lambda: header.setSortIndicator(-1, Qt.AscendingOrder))
+        menu.addAction(scan_order_action)
+        menu.popup(header.mapToGlobal(point))
+
+    def update_items_view(self):
+        self.track_recent_boxes()
+        if self.focus_mode:
+            self.update_box_focus()
+        else:
+            self.expand_current_box()
 
-            for item_barcode, count in items.items():
-                item_comment = self.comments.get((box_barcode, item_barcode), "")
-                if not self.search_query or self.search_query.lower() in box_barcode.lower() or self.search_query.lower() in item_barcode.lower():
-                    status_icon = ""
-                    planned = ""
-                    
-                    if self.invoice_loaded:
-                        if item_barcode in self.invoice_data:
-                            planned = str(self.invoice_data[item_barcode])
-                            total_scanned = self.get_total_scanned_for_item(item_barcode)
-                            planned_int = self.invoice_data[item_barcode]
-                            
-                            if total_scanned == planned_int:
-                                status_icon = "✅"
-                            elif total_scanned < planned_int:
-                                status_icon = "⚠️"
-                            else:
-                                status_icon = "❗"
-                        else:
-                            status_icon = "❓"
-                            planned = "0"
-                    
-                    item = QTreeWidgetItem(box_item, [status_icon, "", item_barcode, str(count), planned, item_comment])
-                    for i in range(1, 6):
-                        item.setTextAlignment(i, Qt.AlignCenter)
-                    
-                    if status_icon == "❓":
-                        for i in range(6):
-                            item.setForeground(i, QBrush(QColor("#e67e22")))
-                            item.setBackground(i, QBrush(QColor("#fff3e0")))
-        self.update_summary()
-        self.update_stats()
+    def track_recent_boxes(self):
+        # Список ведётся и без режима фокуса, чтобы при включении он был уже заполнен
+        current = self.session.current_box_barcode
+        if current == self.focus_current:
+            return
+        self.focus_current = current
+        self.focus_box = current
+        if current:
+            recent = [current] + [box for box in self.recent_boxes if box != current]
+            self.recent_boxes = recent[:self.recent_boxes_limit]
+
+    def update_box_focus(self):
+        # Корень дерева — короб, поэтому представление раскладывает только его товары,
+        # сколько бы коробов ни было в сессии
+        recent = [box for box in self.recent_boxes if self.session.has_box(box)]
+        if recent != self.shown_recent_boxes:
+            self.recent_boxes_list.clear()
+            self.recent_boxes_list.addItems(recent)
+            self.shown_recent_boxes = recent
+
+        if not self.session.has_box(self.focus_box):
+            self.focus_box = self.session.current_box_barcode if self.session.has_box(self.session.current_box_barcode) else ""
+        index = self.items_model.box_index(self.focus_box)
+        if not index.isValid():
+            self.focus_box_label.setText("📦 Короб не выбран — отсканируйте штрихкод короба")
+            self.items_tree.hide()
+            return
+
+        if self.items_model.canFetchMore(index):
+            self.items_model.fetchMore(index)
+        if self.items_tree.rootIndex() != index:
+            self.items_tree.setRootIndex(index)
+        self.items_tree.show()
+        viewed = "" if self.focus_box == self.session.current_box_barcode else " (просмотр)"
+        self.focus_box_label.setText(f"📦 {self.focus_box}{viewed} | Позиций: {len(self.session.box_items(self.focus_box))}"
+                                     f" | Штук: {self.session.box_total(self.focus_box)}")
+
+    def show_recent_box(self, list_item):
+        self.focus_box = list_item.text()
+        self.update_box_focus()
+
+    def toggle_focus_mode(self, checked):
+        self.focus_mode = checked
+        self.ui_settings.setValue("focus_mode", checked)
+        self.focus_frame.setVisible(checked)
+        self.shown_recent_boxes = None
+        if checked:
+            self.update_items_view()
+            return
+        self.items_tree.setRootIndex(QModelIndex())
+        self.items_tree.show()
+        self.current_box_row = QPersistentModelIndex()
+        self.current_box_expanded = False
+        self.expand_current_box()
+
+    def expand_current_box(self):
+        index = self.items_model.box_index(self.session.current_box_barcode)
+        if index == QModelIndex(self.current_box_row):
+            return
+        # Предыдущий текущий короб сворачиваем, только если раскрывали его сами
+        previous = QModelIndex(self.current_box_row)
+        if previous.isValid() and self.current_box_expanded:
+            self.items_tree.collapse(previous)
+        self.current_box_row = QPersistentModelIndex(index)
+        self.current_box_expanded = index.isValid() and not self.items_tree.isExpanded(index)
+        if self.current_box_expanded:
+            self.items_tree.expand(index)
+
+    def remember_expanded_boxes(self):
+        # Текущий короб, раскрытый автоматически, после сброса снова раскроет expand_current_box
+        model = self.items_model
+        auto_row = self.current_box_row.row() if self.current_box_expanded else -1
+        self.expanded_boxes = [model.box_barcode(model.index(row, 0)) for row in range(model.rowCount())
+                               if row != auto_row and self.items_tree.isExpanded(model.index(row, 0))]
+
+    def restore_expanded_boxes(self):
+        for box_barcode in self.expanded_boxes:
+            index = self.items_model.box_index(box_barcode)
+            if index.isValid():
+                self.items_tree.expand(index)
+        self.expanded_boxes = []
+        self.update_items_view()
 
     def filter_items(self):
+        # Сканер вводит штрихкод посимвольно — фильтр применяется один раз после паузы
         self.search_query = self.search_entry.text()
-        self.refresh_treeview()
+        self.items_filter.schedule(self.search_query)
 
     def show_context_menu(self, point):
         try:
-            item = self.items_tree.itemAt(point)
-            if item is None:
+            index = self.items_tree.indexAt(point)
+            if not index.isValid():
                 return
 
-            self.items_tree.setCurrentItem(item)
-            column_index = -1
-
-            header = self.items_tree.header()
-            x_click = point.x()
-
-            for i in range(self.items_tree.columnCount()):
-                section_pos = header.sectionViewportPosition(i)
-                section_width = header.sectionSize(i)
-                if x_click >= section_pos and x_click < section_pos + section_width:
-                    column_index = i
-                    break
-
-            values = [item.text(i) for i in range(self.items_tree.columnCount())]
-        
-            # Проверяем что values достаточно
-            if len(values) < 6:
-                return
+            self.items_tree.setCurrentIndex(index)
+            column_index = index.column()
+            values = self.items_model.row_values(index)
+            box_barcode = self.items_model.box_barcode(index)
 
             context_menu = QMenu(self)
             context_menu.setStyleSheet("""
@@ -2619,13 +3357,7 @@ class QBarcodeApp(QMainWindow):
                 }
             """)
 
-            # Проверяем короб ли это (все поля кроме статуса и комментария пустые)
-            is_box = (len(values) == 6 and 
-                     values[2] == "" and 
-                     values[3] == "" and 
-                     values[4] == "")
-
-            if is_box:
+            if self.items_model.is_box(index):
                 # Для короба
                 if column_index == 1:
                     action_copy_box_barcode = QAction("📋 Копировать штрихкод короба", self)
@@ -2633,34 +3365,27 @@ class QBarcodeApp(QMainWindow):
                     context_menu.addAction(action_copy_box_barcode)
                 elif column_index == 5:
                     action_edit_comment = QAction("✏️ Изменить комментарий к коробу", self)
-                    action_edit_comment.triggered.connect(lambda: self.edit_comment(item))
+                    action_edit_comment.triggered.connect(lambda: self.edit_in_place(index, 5))
                     context_menu.addAction(action_edit_comment)
 
                 # Эти пункты показываем всегда для короба
                 context_menu.addSeparator()
 
                 action_edit_box_barcode = QAction("✏️ Изменить штрихкод короба", self)
-                action_edit_box_barcode.triggered.connect(lambda: self.edit_box_barcode(item))
+                action_edit_box_barcode.triggered.connect(lambda: self.edit_box_barcode(box_barcode))
                 context_menu.addAction(action_edit_box_barcode)
 
                 context_menu.addSeparator()
 
                 action_delete_box = QAction("🗑️ Удалить короб", self)
-                action_delete_box.triggered.connect(lambda: self.delete_box(item))
+                action_delete_box.triggered.connect(lambda: self.delete_box(box_barcode))
                 context_menu.addAction(action_delete_box)
 
             else:
                 # Для товара
-                parent_item = item.parent()
-                if parent_item is None:
-                    return
-                
-                box_barcode = parent_item.text(1) if parent_item else ""
-            
-                # Проверяем что значения существуют
-                item_barcode = values[2] if len(values) > 2 else ""
-                count = values[3] if len(values) > 3 else ""
-                planned = values[4] if len(values) > 4 else ""
+                item_barcode = values[2]
+                count = values[3]
+                planned = values[4]
 
                 # Группа копирования
                 copy_menu = context_menu.addMenu("📋 Копировать")
@@ -2691,7 +3416,7 @@ class QBarcodeApp(QMainWindow):
                     copy_menu.addAction(action_copy_count)
             
                 # Копировать план (если есть накладная)
-                if self.invoice_loaded and planned:
+                if self.session.invoice_loaded and planned:
                     action_copy_planned = QAction("📋 План", self)
                     action_copy_planned.triggered.connect(lambda checked, p=planned: self.clipboard.setText(p))
                     copy_menu.addAction(action_copy_planned)
@@ -2701,24 +3426,24 @@ class QBarcodeApp(QMainWindow):
                 # Группа редактирования
                 if column_index == 5:
                     action_edit_comment = QAction("✏️ Изменить комментарий", self)
-                    action_edit_comment.triggered.connect(lambda: self.edit_comment(item))
+                    action_edit_comment.triggered.connect(lambda: self.edit_in_place(index, 5))
                     context_menu.addAction(action_edit_comment)
 
                 if column_index in (2, 3):
                     action_edit_count = QAction("✏️ Изменить количество", self)
-                    action_edit_count.triggered.connect(lambda: self.edit_item_count(item))
+                    action_edit_count.triggered.connect(lambda: self.edit_in_place(index, 3))
                     context_menu.addAction(action_edit_count)
             
                 if column_index == 2:
                     action_edit_item_barcode = QAction("✏️ Изменить штрихкод товара", self)
-                    action_edit_item_barcode.triggered.connect(lambda: self.edit_item_barcode(item))
+                    action_edit_item_barcode.triggered.connect(lambda: self.edit_in_place(index, 2))
                     context_menu.addAction(action_edit_item_barcode)
 
                 context_menu.addSeparator()
 
                 # Удаление
                 action_delete_item = QAction("🗑️ Удалить товар", self)
-                action_delete_item.triggered.connect(lambda: self.delete_item(item))
+                action_delete_item.triggered.connect(lambda: self.delete_item(box_barcode, item_barcode))
                 context_menu.addAction(action_delete_item)
 
             context_menu.popup(self.items_tree.viewport().mapToGlobal(point))
@@ -2728,92 +3453,35 @@ class QBarcodeApp(QMainWindow):
             import traceback
             traceback.print_exc()
 
-    def collapse_box_items(self, box_item):
-        for i in range(box_item.childCount()):
-            box_item.child(i).setExpanded(False)
+    def collapse_box_items(self, box_index):
+        for row in range(self.items_model.rowCount(box_index)):
+            self.items_tree.setExpanded(self.items_model.index(row, 0, box_index), False)
 
-    def expand_box_items(self, box_item):
-        for i in range(box_item.childCount()):
-            box_item.child(i).setExpanded(True)
+    def expand_box_items(self, box_index):
+        for row in range(self.items_model.rowCount(box_index)):
+            self.items_tree.setExpanded(self.items_model.index(row, 0, box_index), True)
 
-    def clear_selection(self, item, column):
-        if not item.isSelected():
+    def clear_selection(self, index):
+        if not self.items_tree.selectionModel().isSelected(index):
             self.items_tree.clearSelection()
 
-    def edit_item_count(self, selected_item):
-        parent_item = selected_item.parent()
-        box_barcode = parent_item.text(1) if parent_item else ""
-        current_count = selected_item.text(3)
-        barcode = selected_item.text(2)
+    def edit_in_place(self, index, column):
+        self.items_tree.edit(index.sibling(index.row(), column))
 
-        # Получаем план если есть накладная
-        planned = None
-        if self.invoice_loaded and barcode in self.invoice_data:
-            planned = self.invoice_data[barcode]
+    def on_zero_count_edited(self, box_barcode, item_barcode):
+        # Как и раньше, это правка количества (с записью отмены), но с подтверждением удаления
+        if self.confirm_item_delete(box_barcode, item_barcode):
+            self.session.set_item_count(box_barcode, item_barcode, 0)
+            self.on_item_edited(3)
 
-        dialog = EditCountDialog(barcode, int(current_count), planned, self)
-        if dialog.exec_() == QDialog.Accepted:
-            new_count = dialog.get_value()
-            old_count = int(current_count)
-            
-            if str(box_barcode) in self.all_boxes:
-                if new_count == 0:
-                    if barcode in self.all_boxes[box_barcode]:
-                        # Добавляем в стек отмены
-                        self.undo_manager.add_action({
-                            'type': 'edit_count',
-                            'barcode': barcode,
-                            'box_barcode': box_barcode,
-                            'old_value': old_count,
-                            'new_value': 0
-                        })
-                        
-                        del self.all_boxes[box_barcode][barcode]
-                        if not self.all_boxes[box_barcode]:
-                            del self.all_boxes[box_barcode]
-                        
-                        self.scan_history.append({
-                            'timestamp': datetime.now().isoformat(),
-                            'type': 'item',
-                            'barcode': barcode,
-                            'box_barcode': box_barcode,
-                            'action': 'delete',
-                            'action_type': 'edit',
-                            'details': f'Удаление товара (было {old_count})'
-                        })
-                else:
-                    # Добавляем в стек отмены
-                    self.undo_manager.add_action({
-                        'type': 'edit_count',
-                        'barcode': barcode,
-                        'box_barcode': box_barcode,
-                        'old_value': old_count,
-                        'new_value': new_count
-                    })
-                    
-                    self.all_boxes[str(box_barcode)][barcode] = new_count
-                    
-                    change = new_count - old_count
-                    change_sign = "+" if change > 0 else ""
-                    
-                    self.scan_history.append({
-                        'timestamp': datetime.now().isoformat(),
-                        'type': 'item',
-                        'barcode': barcode,
-                        'box_barcode': box_barcode,
-                        'action': 'edit_count',
-                        'action_type': 'edit',
-                        'details': f'{old_count} → {new_count} ({change_sign}{change})'
-                    })
-            
-            self.has_unsaved_changes = True
-            self.refresh_treeview()
-            self.update_summary()
-            self.update_undo_button_state()
-            self.save_state()
+    def on_item_edited(self, column):
+        self.has_unsaved_changes = True
+        self.refresh_treeview()
+        self.ui_refresh.mark('undo', 'persist')
+        if column == 2:
+            self.scan_notification.show_notification("✅ Штрихкод изменён")
 
-    def edit_box_barcode(self, item):
-        old_barcode = item.text(1)
+    def edit_box_barcode(self, old_barcode):
         
         # Создаем кастомный диалог
         dialog = QDialog(self)
@@ -2923,208 +3591,20 @@ class QBarcodeApp(QMainWindow):
         if dialog.exec_() == QDialog.Accepted:
             new_barcode = barcode_edit.text().strip()
             if new_barcode and new_barcode != old_barcode:
-                if self.is_valid_barcode(new_barcode, barcode_type='box'):
-                    if new_barcode not in self.all_boxes:
-                        self.all_boxes[new_barcode] = self.all_boxes.pop(old_barcode)
-                        for key in list(self.comments.keys()):
-                            if key[0] == old_barcode:
-                                new_key = (new_barcode, key[1])
-                                self.comments[new_key] = self.comments.pop(key)
-    
-                        if self.current_box_barcode == old_barcode:
-                            self.current_box_barcode = new_barcode
-                            self.update_status(f"✅ Текущий короб: {self.current_box_barcode}")
-                        
-                        self.scan_history.append({
-                            'timestamp': datetime.now().isoformat(),
-                            'type': 'box',
-                            'barcode': new_barcode,
-                            'action': 'edit_barcode',
-                            'action_type': 'edit',
-                            'details': f'{old_barcode} → {new_barcode}'
-                        })
-                        
-                        self.has_unsaved_changes = True
-                        self.refresh_treeview()
-                        self.scan_notification.show_notification(f"✅ Штрихкод изменён")
-                    else:
-                        self.show_error("Короб с таким штрихкодом уже существует!")
-                else:
-                    self.show_error("Неверный штрихкод короба!")
-
-    def edit_item_barcode(self, item):
-        parent_item = item.parent()
-        box_barcode = parent_item.text(1) if parent_item else ""
-        old_barcode = item.text(2)
-        count = int(item.text(3))
-        
-        # Создаем кастомный диалог
-        dialog = QDialog(self)
-        dialog.setWindowTitle("✏️ Изменить штрихкод товара")
-        dialog.setModal(True)
-        dialog.setFixedSize(400, 300)
-        dialog.setWindowFlags(Qt.Dialog | Qt.WindowCloseButtonHint)
-        
-        layout = QVBoxLayout(dialog)
-        layout.setSpacing(15)
-        layout.setContentsMargins(20, 20, 20, 20)
-        
-        # Информация о коробе
-        box_info = QWidget()
-        box_info.setStyleSheet("""
-            QWidget {
-                background-color: #f1f5f9;
-                border-radius: 8px;
-            }
-        """)
-        box_layout = QHBoxLayout(box_info)
-        box_layout.setContentsMargins(12, 8, 12, 8)
-        
-        box_icon = QLabel("📦")
-        box_icon.setStyleSheet("font-size: 18px; background: transparent;")
-        box_layout.addWidget(box_icon)
-        
-        box_text = QLabel(f"Короб: {box_barcode}")
-        box_text.setStyleSheet("font-size: 12px; color: #334155; background: transparent;")
-        box_layout.addWidget(box_text)
-        
-        layout.addWidget(box_info)
-        
-        # Информация о товаре
-        item_info = QWidget()
-        item_info.setStyleSheet("""
-            QWidget {
-                background-color: #f8fafc;
-                border-radius: 8px;
-            }
-        """)
-        item_layout = QHBoxLayout(item_info)
-        item_layout.setContentsMargins(12, 8, 12, 8)
-        
-        item_icon = QLabel("🏷")
-        item_icon.setStyleSheet("font-size: 18px; background: transparent;")
-        item_layout.addWidget(item_icon)
-        
-        item_text = QLabel(f"Текущий штрихкод: {old_barcode}")
-        item_text.setStyleSheet("font-size: 12px; font-weight: bold; color: #1e293b; background: transparent;")
-        item_layout.addWidget(item_text)
-        
-        layout.addWidget(item_info)
-        
-        # Поле ввода
-        input_label = QLabel("Новый штрихкод товара:")
-        input_label.setStyleSheet("font-size: 12px; color: #475569; font-weight: bold; margin-top: 5px;")
-        layout.addWidget(input_label)
-        
-        barcode_edit = QLineEdit(old_barcode)
-        barcode_edit.setMinimumHeight(40)
-        barcode_edit.setStyleSheet("""
-            QLineEdit {
-                border: 2px solid #cbd5e1;
-                border-radius: 8px;
-                padding: 8px 12px;
-                font-size: 14px;
-                font-family: 'Courier New';
-            }
-            QLineEdit:focus {
-                border-color: #3b82f6;
-            }
-        """)
-        layout.addWidget(barcode_edit)
-        
-        layout.addStretch()
-        
-        # Кнопки
-        buttons_widget = QWidget()
-        buttons_layout = QHBoxLayout(buttons_widget)
-        buttons_layout.setContentsMargins(0, 0, 0, 0)
-        buttons_layout.setSpacing(10)
-        
-        buttons_layout.addStretch()
-        
-        ok_button = QPushButton("✅ Применить")
-        ok_button.setFixedSize(120, 40)
-        ok_button.setStyleSheet("""
-            QPushButton {
-                background-color: #2ecc71;
-                color: white;
-                border: none;
-                border-radius: 8px;
-                font-weight: bold;
-                font-size: 12px;
-            }
-            QPushButton:hover {
-                background-color: #27ae60;
-            }
-        """)
-        ok_button.clicked.connect(dialog.accept)
-        buttons_layout.addWidget(ok_button)
-        
-        cancel_button = QPushButton("✕ Отмена")
-        cancel_button.setFixedSize(120, 40)
-        cancel_button.setStyleSheet("""
-            QPushButton {
-               background-color: #e74c3c;
-               color: white;
-               border: none;
-               border-radius: 8px;
-               font-weight: bold;
-               font-size: 12px;
-            }
-            QPushButton:hover {
-                background-color: #c0392b;
-            }
-        """)
-        cancel_button.clicked.connect(dialog.reject)
-        buttons_layout.addWidget(cancel_button)
-        
-        layout.addWidget(buttons_widget)
-        
-        barcode_edit.setFocus()
-        barcode_edit.selectAll()
-        barcode_edit.returnPressed.connect(dialog.accept)
-        
-        if dialog.exec_() == QDialog.Accepted:
-            new_barcode = barcode_edit.text().strip()
-            if new_barcode and new_barcode != old_barcode:
-                if self.is_valid_barcode(new_barcode, barcode_type='item'):
-                    if new_barcode not in self.all_boxes[box_barcode]:
-                        self.undo_manager.add_action({
-                            'type': 'edit_barcode',
-                            'barcode': new_barcode,
-                            'box_barcode': box_barcode,
-                            'old_value': old_barcode,
-                            'new_value': new_barcode,
-                            'count': count
-                        })
-                        
-                        self.all_boxes[box_barcode].pop(old_barcode)
-                        self.all_boxes[box_barcode][new_barcode] = count
-                        
-                        if (box_barcode, old_barcode) in self.comments:
-                            self.comments[(box_barcode, new_barcode)] = self.comments.pop((box_barcode, old_barcode))
-                        
-                        self.scan_history.append({
-                            'timestamp': datetime.now().isoformat(),
-                            'type': 'item',
-                            'barcode': new_barcode,
-                            'box_barcode': box_barcode,
-                            'action': 'edit_barcode',
-                            'action_type': 'edit',
-                            'details': f'{old_barcode} → {new_barcode}'
-                        })
-                        
-                        self.has_unsaved_changes = True
-                        self.refresh_treeview()
-                        self.update_undo_button_state()
-                        self.scan_notification.show_notification(f"✅ Штрихкод изменён")
-                    else:
-                        self.show_error("Товар с таким штрихкодом уже есть в этом коробе!")
-                else:
-                    self.show_error("Неверный штрихкод товара!")
+                try:
+                    self.session.rename_box(old_barcode, new_barcode)
+                except ScanError as e:
+                    self.show_error(str(e))
+                    return
+                
+                if self.session.current_box_barcode == new_barcode:
+                    self.update_status(f"✅ Текущий короб: {self.session.current_box_barcode}")
+                
+                self.has_unsaved_changes = True
+                self.refresh_treeview()
+                self.scan_notification.show_notification(f"✅ Штрихкод изменён")
 
-    def delete_box(self, item):
-        box_barcode = item.text(1)
+    def delete_box(self, box_barcode):
         dialog = ConfirmationDialog(
             "🗑️ Подтверждение удаления",
             f"Вы уверены, что хотите удалить короб '{box_barcode}'?",
@@ -3132,303 +3612,35 @@ class QBarcodeApp(QMainWindow):
             self
         )
         if dialog.exec_() == QDialog.Accepted:
-            
-            self.scan_history.append({
-                'timestamp': datetime.now().isoformat(),
-                'type': 'box',
-                'barcode': box_barcode,
-                'action': 'delete',
-                'action_type': 'edit',
-                'details': f'Удаление короба'
-            })
-            
-            del self.all_boxes[box_barcode]
-            keys_to_delete = []
-            for key in self.comments:
-                if key[0] == box_barcode:
-                    keys_to_delete.append(key)
-            for key in keys_to_delete:
-                del self.comments[key]
-            if self.current_box_barcode == box_barcode:
-                self.current_box_barcode = ""
+            was_current = self.session.current_box_barcode == box_barcode
+            self.session.delete_box(box_barcode)
+            if was_current:
                 self.update_status("")
             
             self.has_unsaved_changes = True
             self.refresh_treeview()
 
-    def delete_item(self, item):
-        parent_item = item.parent()
-        box_barcode = parent_item.text(1) if parent_item else ""
-        item_barcode = item.text(2)
-
+    def confirm_item_delete(self, box_barcode, item_barcode):
         dialog = ConfirmationDialog(
             "🗑️ Подтверждение удаления",
             f"Вы уверены, что хотите удалить товар '{item_barcode}' из короба '{box_barcode}'?",
             "warning",
             self
         )
-        if dialog.exec_() == QDialog.Accepted:
-            
-            self.scan_history.append({
-                'timestamp': datetime.now().isoformat(),
-                'type': 'item',
-                'barcode': item_barcode,
-                'box_barcode': box_barcode,
-                'action': 'delete',
-                'action_type': 'edit',
-                'details': f'Удаление товара'
-            })
-            
-            del self.all_boxes[box_barcode][item_barcode]
-            if (box_barcode, item_barcode) in self.comments:
-                del self.comments[(box_barcode, item_barcode)]
-            if not self.all_boxes[box_barcode]:
-                del self.all_boxes[box_barcode]
-            if (box_barcode, "") in self.comments:
-                del self.comments[(box_barcode, "")]
-            if self.current_box_barcode == box_barcode:
-                self.current_box_barcode = ""
+        return dialog.exec_() == QDialog.Accepted
+
+    def delete_item(self, box_barcode, item_barcode):
+        if self.confirm_item_delete(box_barcode, item_barcode):
+            was_current = self.session.current_box_barcode == box_barcode
+            self.session.delete_item(box_barcode, item_barcode)
+            if was_current:
                 self.update_status("")
             
             self.has_unsaved_changes = True
             self.refresh_treeview()
 
-    def edit_comment(self, item):
-        values = [item.text(i) for i in range(self.items_tree.columnCount())]
-    
-        if len(values) == 6 and values[2] == "" and values[3] == "" and values[4] == "":
-            # Для короба
-            box_barcode = values[1]
-            current_comment = self.comments.get((box_barcode, ""), "")
-        
-            # Создаем свой диалог для короба
-            dialog = QDialog(self)
-            dialog.setWindowTitle("✏️ Комментарий для короба")
-            dialog.setModal(True)
-            dialog.setMinimumWidth(350)
-            dialog.setMaximumHeight(250)
-            dialog.setWindowFlags(Qt.Dialog | Qt.WindowCloseButtonHint)
-        
-            layout = QVBoxLayout(dialog)
-            layout.setSpacing(10)
-            layout.setContentsMargins(15, 15, 15, 15)
-        
-            # Информация о коробе
-            info_label = QLabel(f"Короб: {box_barcode}")
-            info_label.setStyleSheet("""
-                QLabel {
-                    background-color: #f0f0f0;
-                    padding: 8px;
-                    border-radius: 4px;
-                    font-weight: bold;
-                    color: #2c3e50;
-                }
-            """)
-            info_label.setWordWrap(True)
-            layout.addWidget(info_label)
-        
-            # Поле для ввода комментария
-            comment_edit = QTextEdit()
-            comment_edit.setPlainText(current_comment)
-            comment_edit.setMinimumHeight(100)
-            comment_edit.setStyleSheet("""
-                QTextEdit {
-                    border: 2px solid #3498db;
-                    border-radius: 4px;
-                    padding: 5px;
-                    font-size: 10pt;
-                }
-                QTextEdit:focus {
-                    border-color: #e67e22;
-                }
-            """)
-            layout.addWidget(comment_edit)
-        
-            # Кнопки OK/Отмена
-            buttons_layout = QHBoxLayout()
-            buttons_layout.setSpacing(10)
-        
-            ok_button = QPushButton("✅ Применить")
-            ok_button.setFixedHeight(35)
-            ok_button.setStyleSheet("""
-                QPushButton {
-                    background-color: #2ecc71;
-                    color: white;
-                    border: none;
-                    border-radius: 4px;
-                    font-weight: bold;
-                    font-size: 10pt;
-                    padding: 0 15px;
-                }
-                QPushButton:hover {
-                    background-color: #27ae60;
-                }
-            """)
-            ok_button.clicked.connect(dialog.accept)
-            buttons_layout.addWidget(ok_button)
-        
-            cancel_button = QPushButton("✕ Отмена")
-            cancel_button.setFixedHeight(35)
-            cancel_button.setStyleSheet("""
-                QPushButton {
-                    background-color: #e74c3c;
-                    color: white;
-                    border: none;
-                    border-radius: 4px;
-                    font-weight: bold;
-                    font-size: 10pt;
-                    padding: 0 15px;
-                }
-                QPushButton:hover {
-                    background-color: #c0392b;
-                }
-            """)
-            cancel_button.clicked.connect(dialog.reject)
-            buttons_layout.addWidget(cancel_button)
-        
-            layout.addLayout(buttons_layout)
-        
-            # Настройки
-            comment_edit.setFocus()
-        
-            if dialog.exec_() == QDialog.Accepted:
-                new_comment = comment_edit.toPlainText().strip()
-                if new_comment != current_comment:
-                    self.comments[(box_barcode, "")] = new_comment
-                
-                    self.scan_history.append({
-                        'timestamp': datetime.now().isoformat(),
-                        'type': 'box',
-                        'barcode': box_barcode,
-                        'action': 'edit_comment',
-                        'action_type': 'edit',
-                        'details': f'Комментарий: "{current_comment}" → "{new_comment}"'
-                    })
-                
-                    self.has_unsaved_changes = True
-                    self.refresh_treeview()
-    
-        else:
-            # Для товара
-            parent_item = item.parent()
-            box_barcode = parent_item.text(1) if parent_item else ""
-            item_barcode = values[2]
-            current_comment = self.comments.get((box_barcode, item_barcode), "")
-        
-            # Создаем свой диалог для товара
-            dialog = QDialog(self)
-            dialog.setWindowTitle("✏️ Комментарий для товара")
-            dialog.setModal(True)
-            dialog.setMinimumWidth(350)
-            dialog.setMaximumHeight(250)
-            dialog.setWindowFlags(Qt.Dialog | Qt.WindowCloseButtonHint)
-        
-            layout = QVBoxLayout(dialog)
-            layout.setSpacing(10)
-            layout.setContentsMargins(15, 15, 15, 15)
-        
-            # Информация о товаре
-            info_label = QLabel(f"Товар: {item_barcode}\nКороб: {box_barcode}")
-            info_label.setStyleSheet("""
-                QLabel {
-                    background-color: #f0f0f0;
-                    padding: 8px;
-                    border-radius: 4px;
-                    font-weight: bold;
-                    color: #2c3e50;
-                }
-            """)
-            info_label.setWordWrap(True)
-            layout.addWidget(info_label)
-        
-            # Поле для ввода комментария
-            comment_edit = QTextEdit()
-            comment_edit.setPlainText(current_comment)
-            comment_edit.setMinimumHeight(100)
-            comment_edit.setStyleSheet("""
-                QTextEdit {
-                    border: 2px solid #3498db;
-                    border-radius: 4px;
-                    padding: 5px;
-                    font-size: 10pt;
-                }
-                QTextEdit:focus {
-                    border-color: #e67e22;
-                }
-            """)
-            layout.addWidget(comment_edit)
-        
-            # Кнопки OK/Отмена
-            buttons_layout = QHBoxLayout()
-            buttons_layout.setSpacing(10)
-            
-            ok_button = QPushButton("✅ Применить")
-            ok_button.setFixedHeight(35)
-            ok_button.setStyleSheet("""
-                QPushButton {
-                    background-color: #2ecc71;
-                    color: white;
-                    border: none;
-                    border-radius: 4px;
-                    font-weight: bold;
-                    font-size: 10pt;
-                    padding: 0 15px;
-                }
-               QPushButton:hover {
-                    background-color: #27ae60;
-                }
-            """)
-            ok_button.clicked.connect(dialog.accept)
-            buttons_layout.addWidget(ok_button)
-        
-            cancel_button = QPushButton("✕ Отмена")
-            cancel_button.setFixedHeight(35)
-            cancel_button.setStyleSheet("""
-                QPushButton {
-                    background-color: #e74c3c;
-                    color: white;
-                    border: none;
-                    border-radius: 4px;
-                    font-weight: bold;
-                    font-size: 10pt;
-                    padding: 0 15px;
-                }
-                QPushButton:hover {
-                    background-color: #c0392b;
-                }
-            """)
-            cancel_button.clicked.connect(dialog.reject)
-            buttons_layout.addWidget(cancel_button)
-        
-            layout.addLayout(buttons_layout)
-        
-            # Настройки
-            comment_edit.setFocus()
-        
-            if dialog.exec_() == QDialog.Accepted:
-                new_comment = comment_edit.toPlainText().strip()
-                if new_comment != current_comment:
-                    self.comments[(box_barcode, item_barcode)] = new_comment
-                
-                    self.scan_history.append({
-                        'timestamp': datetime.now().isoformat(),
-                        'type': 'item',
-                        'barcode': item_barcode,
-                        'box_barcode': box_barcode,
-                        'action': 'edit_comment',
-                        'action_type': 'edit',
-                        'details': f'Комментарий: "{current_comment}" → "{new_comment}"'
-                    })
-                
-                    self.has_unsaved_changes = True
-                    self.refresh_treeview()
-
-    def on_double_click(self, item, column_index):
-        if column_index in [3]:
-            self.edit_item_count(item)
-    
     def save_with_format_dialog(self):
-        if not self.all_boxes:
+        if not self.session.box_count():
             self.show_warning("Нет данных для сохранения!")
             return
             
@@ -3444,7 +3656,7 @@ class QBarcodeApp(QMainWindow):
                 self.save_to_excel_single_sheet()
     
     def save_to_excel_multi_sheet(self):
-        if not self.all_boxes:
+        if not self.session.box_count():
             self.show_warning("Нет данных для сохранения!")
             return
 
@@ -3454,116 +3666,10 @@ class QBarcodeApp(QMainWindow):
         if not file_path.lower().endswith(('.xlsx')):
             file_path += '.xlsx'
 
-        try:
-            wb = openpyxl.Workbook()
-            wb.remove(wb.active)
-            
-            thin_border = Border(
-                left=Side(style='thin'),
-                right=Side(style='thin'),
-                top=Side(style='thin'),
-                bottom=Side(style='thin')
-            )
-            
-            header_fill = PatternFill(start_color="3498db", end_color="3498db", fill_type="solid")
-            header_font = Font(color="FFFFFF", bold=True)
-            
-            for box_barcode, items in self.all_boxes.items():
-                sheet = wb.create_sheet(title=f"Короб {box_barcode[:15]}")
-                
-                if self.packer_name:
-                    sheet['A1'] = "Сборщик:"
-                    sheet['B1'] = self.packer_name
-                    sheet['A1'].font = Font(bold=True)
-                    sheet['B1'].font = Font(bold=True)
-                
-                sheet['A3'] = "Штрихкод короба"
-                sheet['B3'] = box_barcode
-                sheet['C3'] = "Комментарий"
-                
-                sheet['A4'] = "Штрихкод товара"
-                sheet['B4'] = "Количество"
-                sheet['C4'] = "Комментарий"
-                if self.invoice_loaded:
-                    sheet['D4'] = "План"
-                    sheet['E4'] = "Статус"
-                
-                for cell in ['A3', 'B3', 'C3', 'A4', 'B4', 'C4']:
-                    if cell in sheet:
-                        sheet[cell].alignment = Alignment(horizontal='center')
-                        sheet[cell].font = header_font
-                        sheet[cell].fill = header_fill
-                        sheet[cell].border = thin_border
-                
-                if self.invoice_loaded:
-                    sheet['D4'].alignment = Alignment(horizontal='center')
-                    sheet['D4'].font = header_font
-                    sheet['D4'].fill = header_fill
-                    sheet['D4'].border = thin_border
-                    sheet['E4'].alignment = Alignment(horizontal='center')
-                    sheet['E4'].font = header_font
-                    sheet['E4'].fill = header_fill
-                    sheet['E4'].border = thin_border
-                
-                row = 5
-                sheet.cell(row=row, column=1, value="Комментарий к коробу:")
-                sheet.cell(row=row, column=3, value=self.comments.get((box_barcode, ""), ""))
-                sheet[f'A{row}'].font = Font(bold=True)
-                row += 1
-                
-                for item_barcode, count in items.items():
-                    sheet.cell(row=row, column=1, value=item_barcode)
-                    sheet.cell(row=row, column=2, value=count).alignment = Alignment(horizontal='center')
-                    sheet.cell(row=row, column=3, value=self.comments.get((box_barcode, item_barcode), ""))
-                    
-                    if self.invoice_loaded and item_barcode in self.invoice_data:
-                        planned = self.invoice_data[item_barcode]
-                        sheet.cell(row=row, column=4, value=planned).alignment = Alignment(horizontal='center')
-                        
-                        total_scanned = self.get_total_scanned_for_item(item_barcode)
-                        if total_scanned == planned:
-                            status = "✅ Совпадает"
-                        elif total_scanned < planned:
-                            status = f"⚠️ Недобор (план: {planned}, всего: {total_scanned}, не хватает: {planned - total_scanned})"
-                        else:
-                            status = f"❗ Перебор (план: {planned}, всего: {total_scanned}, лишних: {total_scanned - planned})"
-                        sheet.cell(row=row, column=5, value=status)
-                    elif self.invoice_loaded:
-                        sheet.cell(row=row, column=4, value="0")
-                        sheet.cell(row=row, column=5, value="❓ Лишний")
-                    
-                    for col in range(1, 6 if self.invoice_loaded else 4):
-                        cell = sheet.cell(row=row, column=col)
-                        if cell.value:
-                            cell.border = thin_border
-                    
-                    row += 1
-
-                for column in sheet.columns:
-                    max_length = 0
-                    col_letter = openpyxl.utils.get_column_letter(column[0].column)
-                    for cell in column:
-                        try:
-                            if cell.value and len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    sheet.column_dimensions[col_letter].width = min(max_length + 2, 50)
-        
-            wb.save(file_path)
-            
-            csv_path = self.save_csv_auto(file_path)
-            if csv_path:
-                self.has_unsaved_changes = False
-                self.show_info(f"✅ Excel сохранен: {os.path.basename(file_path)}\n✅ Лог CSV сохранен: {os.path.basename(csv_path)}")
-            else:
-                self.show_warning(f"⚠️ Excel сохранен, но не удалось сохранить лог CSV!\n{os.path.basename(file_path)}")
-        
-        except Exception as e:
-            self.show_error(f"Ошибка при сохранении: {e}")
+        self.run_export(self._export_excel_task, self.on_excel_saved, file_path, False)
 
     def save_to_excel_single_sheet(self):
-        if not self.all_boxes:
+        if not self.session.box_count():
             self.show_warning("Нет данных для сохранения!")
             return
 
@@ -3573,176 +3679,57 @@ class QBarcodeApp(QMainWindow):
         if not file_path.lower().endswith(('.xlsx')):
             file_path += '.xlsx'
 
-        try:
-            wb = openpyxl.Workbook()
-            sheet = wb.active
-            sheet.title = "Сборка"
-            
-            thin_border = Border(
-                left=Side(style='thin'),
-                right=Side(style='thin'),
-                top=Side(style='thin'),
-                bottom=Side(style='thin')
-            )
-            
-            header_fill = PatternFill(start_color="3498db", end_color="3498db", fill_type="solid")
-            header_font = Font(color="FFFFFF", bold=True)
-            
-            if self.packer_name:
-                sheet['A1'] = "Сборщик:"
-                sheet['B1'] = self.packer_name
-                sheet['A1'].font = Font(bold=True)
-                sheet['B1'].font = Font(bold=True)
-                sheet['A1'].fill = header_fill
-                sheet['B1'].fill = header_fill
-            
-            sheet['A3'] = "Штрихкод короба"
-            sheet['B3'] = "Комментарий короба"
-            sheet['C3'] = "Штрихкод товара"
-            sheet['D3'] = "Количество"
-            sheet['E3'] = "Комментарий товара"
-            
-            if self.invoice_loaded:
-                sheet['F3'] = "План"
-                sheet['G3'] = "Статус"
-            
-            for col in range(1, 8 if self.invoice_loaded else 6):
-                cell = sheet.cell(row=3, column=col)
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.border = thin_border
-                cell.alignment = Alignment(horizontal='center')
-            
-            row = 4
-            for box_barcode, items in self.all_boxes.items():
-                box_comment = self.comments.get((box_barcode, ""), "")
-                
-                first_in_box = True
-                for item_barcode, count in items.items():
-                    item_comment = self.comments.get((box_barcode, item_barcode), "")
-                    
-                    if first_in_box:
-                        sheet.cell(row=row, column=1, value=box_barcode)
-                        sheet.cell(row=row, column=2, value=box_comment)
-                        first_in_box = False
-                    
-                    sheet.cell(row=row, column=3, value=item_barcode)
-                    sheet.cell(row=row, column=4, value=count).alignment = Alignment(horizontal='center')
-                    sheet.cell(row=row, column=5, value=item_comment)
-                    
-                    if self.invoice_loaded and item_barcode in self.invoice_data:
-                        planned = self.invoice_data[item_barcode]
-                        sheet.cell(row=row, column=6, value=planned).alignment = Alignment(horizontal='center')
-                        
-                        total_scanned = self.get_total_scanned_for_item(item_barcode)
-                        if total_scanned == planned:
-                            status = "✅ Совпадает"
-                        elif total_scanned < planned:
-                            status = f"⚠️ Недобор (план: {planned}, всего: {total_scanned}, не хватает: {planned - total_scanned})"
-                        else:
-                            status = f"❗ Перебор (план: {planned}, всего: {total_scanned}, лишних: {total_scanned - planned})"
-                        sheet.cell(row=row, column=7, value=status)
-                    elif self.invoice_loaded:
-                        sheet.cell(row=row, column=6, value="0")
-                        sheet.cell(row=row, column=7, value="❓ Лишний")
-                    
-                    for col in range(1, 8 if self.invoice_loaded else 6):
-                        cell = sheet.cell(row=row, column=col)
-                        if cell.value:
-                            cell.border = thin_border
-                    
-                    row += 1
-                
-                if items:
-                    row += 1
-
-            for column in sheet.columns:
-                max_length = 0
-                col_letter = openpyxl.utils.get_column_letter(column[0].column)
-                for cell in column:
-                    try:
-                        if cell.value and len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                sheet.column_dimensions[col_letter].width = min(max_length + 2, 50)
-        
-            wb.save(file_path)
-            
-            csv_path = self.save_csv_auto(file_path)
-            if csv_path:
+        self.run_export(self._export_excel_task, self.on_excel_saved, file_path, True)
+
+    def run_export(self, task, on_finished, *args):
+        """Экспорт в фоновом потоке по снимку сессии: сборщик продолжает сканировать, пока файл пишется"""
+        history = self.session.scan_history
+        history_length = len(history)
+        thread = LoaderThread(task, self.session.snapshot(), *args)
+
+        def finished(result):
+            # Всё сохранено, только если после снимка в сессии ничего не менялось
+            up_to_date = self.session.scan_history is history and len(history) == history_length
+            on_finished(result, up_to_date)
+
+        thread.finished_loading.connect(finished)
+        thread.error_occurred.connect(self.on_export_error)
+        thread.finished.connect(lambda: self.export_threads.remove(thread))
+        self.export_threads.append(thread)
+        self.update_status("💾 Сохранение...")
+        thread.start()
+
+    def on_export_error(self, message):
+        self.update_status("")
+        self.show_error(f"Ошибка при сохранении: {message}")
+
+    def _export_excel_task(self, snapshot, file_path, single_sheet, progress_callback=None, status_callback=None):
+        if single_sheet:
+            snapshot.export_excel_single_sheet(file_path)
+        else:
+            snapshot.export_excel_multi_sheet(file_path)
+        return file_path, self.save_csv_auto(snapshot, file_path)
+
+    def on_excel_saved(self, result, up_to_date):
+        file_path, csv_path = result
+        self.update_status("")
+        if csv_path:
+            if up_to_date:
                 self.has_unsaved_changes = False
-                self.show_info(f"✅ Excel сохранен: {os.path.basename(file_path)}\n✅ Лог CSV сохранен: {os.path.basename(csv_path)}")
-            else:
-                self.show_warning(f"⚠️ Excel сохранен, но не удалось сохранить лог CSV!\n{os.path.basename(file_path)}")
-        
-        except Exception as e:
-            self.show_error(f"Ошибка при сохранении: {e}")
-    
-    def save_csv_auto(self, excel_path):
+            self.show_info(f"✅ Excel сохранен: {os.path.basename(file_path)}\n✅ Лог CSV сохранен: {os.path.basename(csv_path)}")
+        else:
+            self.show_warning(f"⚠️ Excel сохранен, но не удалось сохранить лог CSV!\n{os.path.basename(file_path)}")
+
+    def save_csv_auto(self, snapshot, excel_path):
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            base_name = os.path.splitext(os.path.basename(excel_path))[0]
-            csv_dir = os.path.dirname(excel_path)
-            csv_path = os.path.join(csv_dir, f"{base_name}_{timestamp}.csv")
-            
-            with open(csv_path, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(["Сборщик", "Штрихкод короба", "Комментарий короба", "Штрихкод товара", "Количество", "Комментарий товара", "Время сканирования короба", "Время сканирования товара", "Тип действия", "Детали"])
-                
-                for box_barcode, items in self.all_boxes.items():
-                    box_comment = self.comments.get((box_barcode, ""), "")
-                    
-                    box_timestamp = ""
-                    for entry in self.scan_history:
-                        if entry['type'] == 'box' and entry['barcode'] == box_barcode:
-                            try:
-                                dt = datetime.fromisoformat(entry['timestamp'])
-                                box_timestamp = dt.strftime("%d.%m.%Y %H:%M:%S")
-                            except:
-                                box_timestamp = entry['timestamp']
-                            break
-                    
-                    for item_barcode, count in items.items():
-                        item_comment = self.comments.get((box_barcode, item_barcode), "")
-                        
-                        item_entries = []
-                        for entry in self.scan_history:
-                            if (entry['type'] == 'item' and 
-                                entry['barcode'] == item_barcode and 
-                                entry.get('box_barcode') == box_barcode):
-                                try:
-                                    dt = datetime.fromisoformat(entry['timestamp'])
-                                    item_entries.append((
-                                        dt.strftime("%d.%m.%Y %H:%M:%S"), 
-                                        entry.get('action_type', 'scan'),
-                                        entry.get('action', 'scan'),
-                                        entry.get('details', '')
-                                    ))
-                                except:
-                                    item_entries.append((
-                                        entry['timestamp'],
-                                        entry.get('action_type', 'scan'),
-                                        entry.get('action', 'scan'),
-                                        entry.get('details', '')
-                                    ))
-                        
-                        # Записываем финальное количество одной строкой
-                        writer.writerow([self.packer_name, box_barcode, box_comment, item_barcode, count, item_comment, box_timestamp, "", "final", f"Итоговое количество: {count}"])
-                        
-                        # Записываем историю изменений отдельно
-                        for item_time, action_type, action, details in item_entries:
-                            if action_type != 'final':
-                                writer.writerow([self.packer_name, box_barcode, box_comment, item_barcode, 1, item_comment, box_timestamp, item_time, action_type, details])
-            
-            return csv_path
-                            
+            return snapshot.export_csv_log(excel_path)
         except Exception as e:
             print(f"Ошибка при сохранении CSV: {e}")
             return None
     
+
     def save_to_csv(self):
-        if not self.all_boxes:
+        if not self.session.box_count():
            self.show_warning("Нет данных для сохранения!")
            return
         file_path, _ = QFileDialog.getSaveFileName(self, "Сохранить в CSV", "", "CSV Files (*.csv);;All Files (*)")
@@ -3751,60 +3738,17 @@ class QBarcodeApp(QMainWindow):
         if not file_path.lower().endswith(('.csv')):
             file_path += '.csv'
 
-        try:
-            with open(file_path, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(["Сборщик", "Штрихкод короба", "Комментарий короба", "Штрихкод товара", "Количество", "Комментарий товара", "Время сканирования короба", "Время сканирования товара", "Тип действия", "Детали"])
+        self.run_export(self._export_csv_task, self.on_csv_saved, file_path)
 
-                for box_barcode, items in self.all_boxes.items():
-                    box_comment = self.comments.get((box_barcode, ""), "")
-                    
-                    box_timestamp = ""
-                    for entry in self.scan_history:
-                        if entry['type'] == 'box' and entry['barcode'] == box_barcode:
-                            try:
-                                dt = datetime.fromisoformat(entry['timestamp'])
-                                box_timestamp = dt.strftime("%d.%m.%Y %H:%M:%S")
-                            except:
-                                box_timestamp = entry['timestamp']
-                            break
-                    
-                    for item_barcode, count in items.items():
-                        item_comment = self.comments.get((box_barcode, item_barcode), "")
-                        
-                        item_entries = []
-                        for entry in self.scan_history:
-                            if (entry['type'] == 'item' and 
-                                entry['barcode'] == item_barcode and 
-                                entry.get('box_barcode') == box_barcode):
-                                try:
-                                    dt = datetime.fromisoformat(entry['timestamp'])
-                                    item_entries.append((
-                                        dt.strftime("%d.%m.%Y %H:%M:%S"), 
-                                        entry.get('action_type', 'scan'),
-                                        entry.get('action', 'scan'),
-                                        entry.get('details', '')
-                                    ))
-                                except:
-                                    item_entries.append((
-                                        entry['timestamp'],
-                                        entry.get('action_type', 'scan'),
-                                        entry.get('action', 'scan'),
-                                        entry.get('details', '')
-                                    ))
-                        
-                        # Записываем финальное количество одной строкой
-                        writer.writerow([self.packer_name, box_barcode, box_comment, item_barcode, count, item_comment, box_timestamp, "", "final", f"Итоговое количество: {count}"])
-                        
-                        # Записываем историю изменений отдельно
-                        for item_time, action_type, action, details in item_entries:
-                            if action_type != 'final':
-                                writer.writerow([self.packer_name, box_barcode, box_comment, item_barcode, 1, item_comment, box_timestamp, item_time, action_type, details])
+    def _export_csv_task(self, snapshot, file_path, progress_callback=None, status_callback=None):
+        snapshot.export_csv(file_path)
+        return file_path
 
+    def on_csv_saved(self, file_path, up_to_date):
+        self.update_status("")
+        if up_to_date:
             self.has_unsaved_changes = False
-            self.show_info(f"✅ Данные сохранены в {file_path}")
-        except Exception as e:
-            self.show_error(f"Ошибка при сохранении: {e}")
+        self.show_info(f"✅ Данные сохранены в {file_path}")
 
     def load_invoice_dialog(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Загрузить накладную Excel", "", "Excel Files (*.xlsx *.xls);;All Files (*)")
@@ -3812,74 +3756,29 @@ class QBarcodeApp(QMainWindow):
             self.show_loader(self._load_invoice_task, file_path)
     
     def _load_invoice_task(self, file_path, progress_callback=None, status_callback=None):
-        import time
-        start_time = time.time()
-        
-        if status_callback:
-            status_callback("📂 Чтение файла Excel...")
-    
-        wb = openpyxl.load_workbook(file_path)
-        sheet = wb.active
-    
-        total_rows = sheet.max_row - 1
-    
-        if total_rows > 0 and progress_callback:
-           progress_callback(0, total_rows)
-           time.sleep(0.1)  # Пауза чтобы увидеть 0%
-    
-        invoice_data = {}
-        total_items = 0
-        total_quantity = 0
-    
-        for i, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), 1):
-            if progress_callback:
-                progress_callback(i, total_rows)
-            
-            if i % 5 == 0 and status_callback:
-                percent = int((i / total_rows) * 100)
-                status_callback(f"📊 Загружено {percent}% ({i}/{total_rows})")
-                time.sleep(0.02)  # Маленькая задержка для плавности
-        
-            if row[0] and row[1]:
-                barcode = str(row[0]).strip()
-                try:
-                    count = int(float(row[1]))
-                    if count > 0:
-                        invoice_data[barcode] = count
-                        total_items += 1
-                        total_quantity += count
-                except:
-                    continue
-    
-        min_animation_time = 1.5
-        elapsed = time.time() - start_time
-        
-        if elapsed < min_animation_time and progress_callback:
-            remaining = min_animation_time - elapsed
-            steps = int(remaining * 10)
-            
-            for step in range(steps):
-                progress_callback(total_rows, total_rows)
-                if status_callback:
-                    status_callback(f"✅ Финальная обработка... {int((step/steps)*100)}%")
-                time.sleep(0.1)
-    
-        if progress_callback:
-            progress_callback(total_rows, total_rows)
-        if status_callback:
-            status_callback("✅ Загрузка завершена")
-    
-        return (invoice_data, total_items, total_quantity, os.path.basename(file_path), file_path)
-    
+        start_time = time()
+        result = self.session.read_invoice(file_path, progress_callback, status_callback)
+        self._finish_loading(start_time, progress_callback, status_callback)
+        return result
+
     def view_invoice(self):
-        if not self.invoice_loaded or not self.invoice_data:
+        if not self.session.invoice_loaded or not self.session.invoice_data:
             return
         
-        dialog = InvoiceViewDialog(self.invoice_data, self.invoice_file_name, self)
-        dialog.exec_()
+        if self.invoice_window:
+            self.invoice_window.raise_()
+            self.invoice_window.activateWindow()
+            return
+        # Окно не модальное: сборка продолжается, а таблица обновляется по сканам
+        self.invoice_window = InvoiceViewDialog(self.session, self)
+        self.invoice_window.finished.connect(self.on_invoice_closed)
+        self.invoice_window.show()
+
+    def on_invoice_closed(self):
+        self.invoice_window = None
     
     def clear_invoice(self):
-        if not self.invoice_loaded:
+        if not self.session.invoice_loaded:
             return
             
         dialog = ConfirmationDialog(
@@ -3892,10 +3791,7 @@ class QBarcodeApp(QMainWindow):
         dialog.no_button.setText("✕ Нет")
         
         if dialog.exec_() == QDialog.Accepted:
-            self.invoice_data = {}
-            self.invoice_loaded = False
-            self.invoice_file_name = ""
-            self.invoice_file_path = ""
+            self.session.clear_invoice()
             self.invoice_label.setText("")
             self.clear_invoice_button.setEnabled(False)
             self.view_invoice_button.setEnabled(False)
@@ -3921,235 +3817,30 @@ class QBarcodeApp(QMainWindow):
             self.show_loader(self._load_csv_task, file_path)
     
     def _load_csv_task(self, file_path, progress_callback=None, status_callback=None):
-        import time
-        start_time = time.time()
-        
-        if status_callback:
-            status_callback("📂 Чтение CSV файла...")
-    
-        with open(file_path, "r", encoding="utf-8") as f:
-            all_lines = f.readlines()
-    
-        total_rows = len(all_lines) - 1
-        if total_rows <= 0:
-            raise Exception("Файл пуст")
-    
-        if progress_callback:
-            progress_callback(0, total_rows)
-            time.sleep(0.1)
-    
-        with open(file_path, "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            header = next(reader, None)
-        
-            has_packer = len(header) >= 1 and header[0] == "Сборщик"
-            has_timestamps = len(header) >= 8 and header[6] == "Время сканирования короба" and header[7] == "Время сканирования товара"
-            has_action_types = len(header) >= 10 and header[8] == "Тип действия" and header[9] == "Детали"
-
-            if not (len(header) >= 4 and header[1] == "Штрихкод короба" and header[3] == "Штрихкод товара" and header[4] == "Количество"):
-                raise Exception("Некорректный формат файла CSV")
-
-            all_boxes = {}
-            comments = {}
-            scan_history = []
-            packer_name = ""
-            box_timestamps = {}
-            
-            # Сначала собираем все действия в хронологическом порядке
-            actions = []
-        
-            for row_idx, row in enumerate(reader, 1):
-                if progress_callback:
-                    progress_callback(row_idx, total_rows)
-                
-                if row_idx % 50 == 0 and status_callback:
-                    percent = int((row_idx / total_rows) * 100)
-                    status_callback(f"📊 Загружено {percent}% ({row_idx}/{total_rows})")
-                    time.sleep(0.02)
-            
-                if len(row) < 5:
-                    continue
+        start_time = time()
+        result = self.session.read_csv(file_path, progress_callback, status_callback)
+        self._finish_loading(start_time, progress_callback, status_callback)
+        return result
 
-                col_offset = 1 if has_packer else 0
-            
-                if has_packer and len(row) > 0 and row[0] and not packer_name:
-                    packer_name = row[0]
-            
-                box_barcode = row[col_offset].strip() if len(row) > col_offset else ""
-                box_comment = row[col_offset + 1].strip() if len(row) > col_offset + 1 else ""
-                item_barcode = row[col_offset + 2].strip() if len(row) > col_offset + 2 else ""
-                count_str = row[col_offset + 3].strip() if len(row) > col_offset + 3 else ""
-                item_comment = row[col_offset + 4].strip() if len(row) > col_offset + 4 else ""
-            
-                box_timestamp = row[col_offset + 5].strip() if has_timestamps and len(row) > col_offset + 5 else ""
-                item_timestamp = row[col_offset + 6].strip() if has_timestamps and len(row) > col_offset + 6 else ""
-                action_type = row[col_offset + 7].strip() if has_action_types and len(row) > col_offset + 7 else "scan"
-                details = row[col_offset + 8].strip() if has_action_types and len(row) > col_offset + 8 else ""
-
-                if not box_barcode or not item_barcode:
-                    continue
-
-                if not self.is_valid_barcode(box_barcode, barcode_type='box'):
-                    continue
-                if not self.is_valid_barcode(item_barcode, barcode_type='item'):
-                    continue
-                
-                try:
-                    count = int(count_str)
-                    if count <= 0:
-                        continue
-                except ValueError:
-                    continue
-
-                # Инициализация короба
-                if box_barcode not in all_boxes:
-                    all_boxes[box_barcode] = {}
-                
-                if box_timestamp and box_barcode not in box_timestamps:
-                    # Преобразуем время для сортировки
-                    try:
-                        dt = datetime.strptime(box_timestamp, "%d.%m.%Y %H:%M:%S")
-                        ts = dt.timestamp()
-                    except:
-                        ts = 0
-                    box_timestamps[box_barcode] = (box_timestamp, action_type, details, ts)
-
-                # Сохраняем комментарии
-                comments[(box_barcode, "")] = box_comment
-                comments[(box_barcode, item_barcode)] = item_comment
-            
-                # Сохраняем действие для последующего воспроизведения
-                if item_timestamp:
-                    try:
-                        dt = datetime.strptime(item_timestamp, "%d.%m.%Y %H:%M:%S")
-                        ts = dt.timestamp()
-                        iso_timestamp = dt.isoformat()
-                    except:
-                        ts = 0
-                        iso_timestamp = item_timestamp
-                    
-                    actions.append({
-                        'timestamp': iso_timestamp,
-                        'timestamp_float': ts,
-                        'type': 'item',
-                        'barcode': item_barcode,
-                        'box_barcode': box_barcode,
-                        'action_type': action_type,
-                        'details': details,
-                        'count': count,
-                        'original_count': count
-                    })
-
-            # Сортируем действия по времени
-            actions.sort(key=lambda x: x.get('timestamp_float', 0))
-
-            # Воспроизводим действия для получения финального состояния
-            final_counts = {}
-            
-            for action in actions:
-                key = (action['box_barcode'], action['barcode'])
-                
-                if key not in final_counts:
-                    final_counts[key] = 0
-                
-                if action['action_type'] == 'scan':
-                    final_counts[key] += 1
-                elif action['action_type'] == 'edit' and '→' in action['details']:
-                    # Изменение количества
-                    try:
-                        parts = action['details'].split('→')
-                        new_part = parts[1].split('(')[0].strip()
-                        new_val = int(new_part)
-                        final_counts[key] = new_val
-                    except:
-                        pass
-                elif action['action_type'] == 'undo':
-                    if 'Отмена сканирования' in action['details']:
-                        final_counts[key] = max(0, final_counts[key] - 1)
-                    elif 'Отмена изменения количества' in action['details']:
-                        # Парсим "10 → 5"
-                        try:
-                            parts = action['details'].split('→')
-                            old_val = int(parts[1].split('(')[0].strip())
-                            final_counts[key] = old_val
-                        except:
-                            pass
-                elif action['action_type'] == 'final':
-                    # Прямое указание финального количества
-                    final_counts[key] = action['count']
-
-            # Применяем финальные количества
-            for (box_barcode, item_barcode), final_count in final_counts.items():
-                if box_barcode in all_boxes:
-                    all_boxes[box_barcode][item_barcode] = final_count
-
-            # Добавляем записи о коробах в историю
-            for box_barcode, (timestamp, action_type, details, ts) in box_timestamps.items():
-                try:
-                    dt = datetime.strptime(timestamp, "%d.%m.%Y %H:%M:%S")
-                    iso_timestamp = dt.isoformat()
-                except:
-                    iso_timestamp = timestamp
-            
-                action = 'scan'
-                if action_type == 'edit':
-                    if 'изменение' in details.lower():
-                        action = 'edit_barcode'
-                    elif 'удаление' in details.lower():
-                        action = 'delete'
+    def _finish_loading(self, start_time, progress_callback=None, status_callback=None):
+        """Анимация завершения: лоадер не должен мелькать на быстрых файлах"""
+        min_animation_time = 1.5
+        elapsed = time() - start_time
         
-                scan_history.append({
-                    'timestamp': iso_timestamp,
-                    'type': 'box',
-                    'barcode': box_barcode,
-                    'action': action,
-                    'action_type': action_type,
-                    'details': details
-                })
-
-            # Добавляем все действия в историю
-            for action in actions:
-                action_copy = action.copy()
-                if 'timestamp_float' in action_copy:
-                    del action_copy['timestamp_float']
-                if 'original_count' in action_copy:
-                    del action_copy['original_count']
-                scan_history.append(action_copy)
-
-            # Сортируем историю по времени
-            scan_history.sort(key=lambda x: x.get('timestamp', ''))
-
-            start_time_val = None
-            first_scan_done = False
-            if scan_history:
-                try:
-                    first_scan = min(scan_history, key=lambda x: x.get('timestamp', ''))
-                    first_time = datetime.fromisoformat(first_scan['timestamp'])
-                    start_time_val = first_time.timestamp()
-                    first_scan_done = True
-                except:
-                    pass
-
-            # Анимация завершения
-            min_animation_time = 1.5
-            elapsed = time.time() - start_time
+        if elapsed < min_animation_time and progress_callback:
+            remaining = min_animation_time - elapsed
+            steps = int(remaining * 10)
             
-            if elapsed < min_animation_time and progress_callback:
-                remaining = min_animation_time - elapsed
-                steps = int(remaining * 10)
-                
-                for step in range(steps):
-                    progress_callback(total_rows, total_rows)
-                    if status_callback:
-                        status_callback(f"✅ Финальная обработка... {int((step/steps)*100)}%")
-                    time.sleep(0.1)
-
-            if progress_callback:
-                progress_callback(total_rows, total_rows)
-            if status_callback:
-                status_callback("✅ Загрузка завершена")
+            for step in range(steps):
+                progress_callback(1, 1)
+                if status_callback:
+                    status_callback(f"✅ Финальная обработка... {int((step/steps)*100)}%")
+                sleep(0.1)
     
-            return (all_boxes, comments, scan_history, packer_name, start_time_val, first_scan_done, os.path.basename(file_path))
+        if progress_callback:
+            progress_callback(1, 1)
+        if status_callback:
+            status_callback("✅ Загрузка завершена")
 
     def load_from_csv(self, progress_callback=None, status_callback=None):
         if hasattr(self, '_drag_import_file') and self._drag_import_file:
@@ -4158,14 +3849,14 @@ class QBarcodeApp(QMainWindow):
             self.show_loader(self._load_csv_task, file_path)
 
     def new_box(self):
-        self.current_box_barcode = ""
+        self.session.current_box_barcode = ""
         self.update_status("Введите штрихкод нового короба")
         self.box_entry.setEnabled(True)
         self.box_entry.clear()
         self.box_entry.setFocus()
         self.item_scan_entry.clear()
         self.item_scan_entry.setEnabled(False)
-        self.update_undo_button_state()
+        self.ui_refresh.mark('undo')
 
     def reset_application(self):
         dialog = ConfirmationDialog(
@@ -4178,18 +3869,9 @@ class QBarcodeApp(QMainWindow):
         dialog.no_button.setText("✕ Нет")
     
         if dialog.exec_() == QDialog.Accepted:
-            self.all_boxes = {}
-            self.current_box_barcode = ""
+            self.session.reset()
             self.search_query = ""
-            self.comments = {}
-            self.scan_history = []
-            self.undo_manager = UndoManager(max_size=10)
-            self.packer_name = ""
             self.packer_combo.setCurrentText("")
-            self.invoice_data = {}
-            self.invoice_loaded = False
-            self.invoice_file_name = ""
-            self.invoice_file_path = ""
             self.invoice_label.setText("")
             self.clear_invoice_button.setEnabled(False)
             self.view_invoice_button.setEnabled(False)
@@ -4215,9 +3897,8 @@ class QBarcodeApp(QMainWindow):
             self.update_status("")
             self.box_entry.setFocus()
             self.save_button.setEnabled(False)
-            self.update_undo_button_state()
+            self.ui_refresh.mark('undo', 'persist')
             self.status_bar.showMessage("💡 Перетащите CSV или Excel файл в окно для быстрого импорта")
-            self.save_state()
 
     def show_error(self, message):
         QMessageBox.critical(self, "❌ Ошибка", message)
@@ -4232,13 +3913,11 @@ class QBarcodeApp(QMainWindow):
         self.status_bar.showMessage(message)
 
     def update_summary(self):
-        num_boxes = len(self.all_boxes)
-        total_items = 0
-        for box, items in self.all_boxes.items():
-            total_items += sum(items.values())
+        num_boxes = self.session.box_count()
+        total_items = self.session.scan_index.grand_total
         
-        if self.invoice_loaded:
-            total_planned = sum(self.invoice_data.values())
+        if self.session.invoice_loaded:
+            total_planned = self.session.scan_index.reconciliation.planned_total
             summary_text = f"📊 Коробов: {num_boxes} | Собрано: {total_items} | План: {total_planned}"
         else:
             summary_text = f"📊 Коробов: {num_boxes} | Товаров: {total_items}"
@@ -4250,15 +3929,13 @@ class QBarcodeApp(QMainWindow):
             if os.path.exists(self.state_file):
                 with open(self.state_file, "r") as f:
                     data = json.load(f)
-                    if 'all_boxes' in data:
-                        self.all_boxes = {str(k): v for k, v in data['all_boxes'].items()}
-                    if 'current_box_barcode' in data:
-                        self.current_box_barcode = data['current_box_barcode']
+                    self.session.load_state(data)
                     if 'search_query' in data:
                         self.search_query = data['search_query']
+                        self.search_entry.setText(self.search_query)
+                        self.items_filter.apply()
                     if 'packer_name' in data:
-                        self.packer_name = data['packer_name']
-                        self.packer_combo.setCurrentText(self.packer_name)
+                        self.packer_combo.setCurrentText(self.session.packer_name)
                     if 'start_time' in data and data['start_time']:
                         self.start_time = data['start_time']
                         self.first_scan_done = True
@@ -4266,31 +3943,16 @@ class QBarcodeApp(QMainWindow):
                         self.is_paused = data['is_paused']
                     if 'total_scans' in data:
                         self.total_scans = data['total_scans']
-                        
-                    serializable_comments = data.get('comments', {})
-                    self.comments = {}
-                    for key_str, comment in serializable_comments.items():
-                        try:
-                            box_barcode, item_barcode_str = key_str.split(",", 1) if "," in key_str else (key_str, "")
-                            item_barcode = item_barcode_str if item_barcode_str else ""
-                            self.comments[(box_barcode, item_barcode)] = comment
-                        except ValueError:
-                            pass
-                    if 'strict_validation_enabled' in data:
-                        self.strict_validation_enabled = data['strict_validation_enabled']
-                        if hasattr(self, 'strict_validation_checkbox'):
-                            self.strict_validation_checkbox.setChecked(self.strict_validation_enabled)
-                    
-                    if 'scan_history' in data:
-                        self.scan_history = data['scan_history']
+                    if 'strict_validation_enabled' in data and hasattr(self, 'strict_validation_checkbox'):
+                        self.strict_validation_checkbox.setChecked(self.session.strict_validation_enabled)
                         
                 self.refresh_treeview()
-                if self.current_box_barcode:
+                if self.session.current_box_barcode:
                     self.box_entry.setEnabled(False)
                     self.item_scan_entry.setEnabled(True)
                     self.save_button.setEnabled(True)
                     
-                if self.invoice_loaded:
+                if self.session.invoice_loaded:
                     self.pause_button.show()
                     if self.is_paused:
                         self.pause_button.setText("▶️")
@@ -4300,45 +3962,34 @@ class QBarcodeApp(QMainWindow):
             pass
 
     def save_state(self):
-        serializable_comments = {}
-        for key, comment in self.comments.items():
-            if not isinstance(key, tuple) or len(key) != 2:
-                continue
-            box_barcode, item_barcode = key
-            key_str = f"{box_barcode},{item_barcode}"
-            serializable_comments[key_str] = comment
-            
-        data = {
-            "all_boxes": self.all_boxes,
-            "current_box_barcode": self.current_box_barcode,
+        data = self.session.to_state()
+        data.update({
             "search_query": self.search_query,
-            "comments": serializable_comments,
-            "strict_validation_enabled": self.strict_validation_enabled,
-            "scan_history": self.scan_history,
-            "packer_name": self.packer_name,
             "start_time": self.start_time,
             "is_paused": self.is_paused,
             "total_scans": self.total_scans,
-        }
+        })
         try:
             with open(self.state_file, "w") as f:
                 json.dump(data, f)
         except Exception as e:
             pass
-            
+
     def load_column_settings(self):
         for i in range(6):
             default_width = 60 if i == 0 else 180 if i < 3 else 80 if i in (3, 4) else 200
-            width = self.settings.value(f"column_width_{i}", default_width)
+            width = self.ui_settings.value(f"column_width_{i}", default_width)
             self.items_tree.setColumnWidth(i, int(width))
             
     def save_column_settings(self):
         for i in range(6):
-            self.settings.setValue(f"column_width_{i}", self.items_tree.columnWidth(i))
+            self.ui_settings.setValue(f"column_width_{i}", self.items_tree.columnWidth(i))
 
     def on_closing(self):
         self.save_column_settings()
-        self.save_state()
+        self.ui_refresh.mark('persist')
+        self.ui_refresh.flush()
+        self.ui_settings.flush()
         self.close()
 
     def show_paste_menu(self, event, entry_widget):
@@ -0,0 +1,1895 @@
+import os
+import re
+import csv
+import copy
+from datetime import datetime
+from time import time
+from collections import deque
+from array import array
+
+import openpyxl
+from openpyxl.styles import Alignment, Font, PatternFill, Border, Side
+
+
+class UndoManager:
+    def __init__(self, max_size=10):
+        self.undo_stack = deque(maxlen=max_size)
+        self.redo_stack = deque(maxlen=max_size)
+        
+    def add_action(self, action):
+        self.undo_stack.append(action)
+        self.redo_stack.clear()
+        
+    def can_undo(self):
+        return len(self.undo_stack) > 0
+        
+    def can_redo(self):
+        return len(self.redo_stack) > 0
+        
+    def undo(self):
+        if not self.undo_stack:
+            return None
+        action = self.undo_stack.pop()
+        self.redo_stack.append(action)
+        return action
+        
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        action = self.redo_stack.pop()
+        self.undo_stack.append(action)
+        return action
+
+
+class BarcodeTable:
+    """Таблица штрихкодов: каждая строка хранится один раз и получает небольшой номер.
+    Номера не переиспользуются и строки не удаляются: снимки сессии читают таблицу из другого потока"""
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, barcode):
+        barcode_id = self.ids.get(barcode)
+        if barcode_id is None:
+            barcode_id = len(self.names)
+            self.ids[barcode] = barcode_id
+            self.names.append(barcode)
+        return barcode_id
+
+    def get(self, barcode):
+        return self.ids.get(barcode)
+
+    def name(self, barcode_id):
+        return self.names[barcode_id]
+
+    def canonical(self, barcode):
+        return self.names[self.intern(barcode)]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class SubstringIndex:
+    """Поиск по подстроке без учёта регистра: триграмма -> множество ключей.
+    Запрос сужается пересечением множеств его триграмм, короткие запросы проверяются перебором"""
+    def __init__(self):
+        self.texts = {}
+        self.grams = {}
+
+    def add(self, key, text):
+        text = text.lower()
+        self.texts[key] = text
+        grams = self.grams
+        for i in range(len(text) - 2):
+            keys = grams.get(text[i:i + 3])
+            if keys is None:
+                grams[text[i:i + 3]] = {key}
+            else:
+                keys.add(key)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def search(self, query):
+        query = query.lower()
+        texts = self.texts
+        if len(query) < 3:
+            return {key for key, text in texts.items() if query in text}
+        buckets = []
+        for gram in {query[i:i + 3] for i in range(len(query) - 2)}:
+            keys = self.grams.get(gram)
+            if not keys:
+                return set()
+            buckets.append(keys)
+        buckets.sort(key=len)
+        candidates = set(buckets[0])
+        for keys in buckets[1:]:
+            candidates &= keys
+            if not candidates:
+                return candidates
+        if len(query) == 3:
+            return candidates
+        # Все триграммы на месте ещё не значат, что они идут подряд
+        return {key for key in candidates if query in texts[key]}
+
+
+class BoxContents:
+    """Строки короба: номера товаров и количества в массивах, порядок добавления сохраняется.
+    Снаружи выглядит как dict штрихкод -> количество"""
+    __slots__ = ('barcodes', 'item_ids', 'counts', 'positions')
+
+    def __init__(self, barcodes):
+        self.barcodes = barcodes
+        self.item_ids = array('l')
+        self.counts = array('l')
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def __contains__(self, item_barcode):
+        return self.barcodes.get(item_barcode) in self.positions
+
+    def __iter__(self):
+        names = self.barcodes.names
+        return (names[item_id] for item_id in self.item_ids)
+
+    def __getitem__(self, item_barcode):
+        return self.counts[self.positions[self.barcodes.get(item_barcode)]]
+
+    def get(self, item_barcode, default=None):
+        pos = self.positions.get(self.barcodes.get(item_barcode))
+        return default if pos is None else self.counts[pos]
+
+    def items(self):
+        names = self.barcodes.names
+        return ((names[item_id], count) for item_id, count in zip(self.item_ids, self.counts))
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return iter(self.counts)
+
+    def lines(self):
+        return zip(self.item_ids, self.counts)
+
+    def count(self, item_id):
+        pos = self.positions.get(item_id)
+        return 0 if pos is None else self.counts[pos]
+
+    def set(self, item_id, count):
+        pos = self.positions.get(item_id)
+        if pos is None:
+            self.positions[item_id] = len(self.item_ids)
+            self.item_ids.append(item_id)
+            self.counts.append(count)
+        else:
+            self.counts[pos] = count
+
+    def remove(self, item_id):
+        pos = self.positions.pop(item_id)
+        count = self.counts[pos]
+        del self.item_ids[pos]
+        del self.counts[pos]
+        for i in range(pos, len(self.item_ids)):
+            self.positions[self.item_ids[i]] = i
+        return count
+
+    def copy(self):
+        contents = BoxContents(self.barcodes)
+        contents.item_ids = self.item_ids[:]
+        contents.counts = self.counts[:]
+        contents.positions = dict(self.positions)
+        return contents
+
+
+class CommentStore:
+    """Комментарии, сгруппированные по коробам: короб -> {товар: текст}.
+    Комментарий самого короба хранится под пустым штрихкодом товара"""
+    def __init__(self, pairs=None):
+        self.by_box = {}
+        # Короба, чьи словари общие со снимком: перед изменением словарь копируется
+        self.shared = set()
+        if pairs:
+            for (box_barcode, item_barcode), comment in pairs.items():
+                self.set(box_barcode, item_barcode, comment)
+
+    def _bucket(self, box_barcode):
+        bucket = self.by_box.get(box_barcode)
+        if bucket is not None and box_barcode in self.shared:
+            bucket = self.by_box[box_barcode] = dict(bucket)
+            self.shared.discard(box_barcode)
+        return bucket
+
+    def get(self, box_barcode, item_barcode=""):
+        bucket = self.by_box.get(box_barcode)
+        return bucket.get(item_barcode, "") if bucket else ""
+
+    def set(self, box_barcode, item_barcode, comment):
+        bucket = self._bucket(box_barcode)
+        if bucket is None:
+            bucket = self.by_box[box_barcode] = {}
+        bucket[item_barcode] = comment
+
+    def remove(self, box_barcode, item_barcode):
+        bucket = self._bucket(box_barcode)
+        if bucket:
+            bucket.pop(item_barcode, None)
+
+    def rename_item(self, box_barcode, old_barcode, new_barcode):
+        bucket = self._bucket(box_barcode)
+        if bucket and old_barcode in bucket:
+            bucket[new_barcode] = bucket.pop(old_barcode)
+
+    def remove_box(self, box_barcode):
+        self.by_box.pop(box_barcode, None)
+        self.shared.discard(box_barcode)
+
+    def rename_box(self, old_barcode, new_barcode):
+        bucket = self.by_box.pop(old_barcode, None)
+        if bucket is None:
+            return
+        existing = self._bucket(new_barcode)
+        if existing:
+            existing.update(bucket)
+        else:
+            self.by_box[new_barcode] = bucket
+            if old_barcode in self.shared:
+                self.shared.add(new_barcode)
+            else:
+                self.shared.discard(new_barcode)
+        self.shared.discard(old_barcode)
+
+    def snapshot(self):
+        """Копия для чтения из другого потока; словари коробов общие до первого изменения"""
+        store = CommentStore()
+        store.by_box = dict(self.by_box)
+        self.shared = set(self.by_box)
+        return store
+
+    def items(self):
+        for box_barcode, bucket in self.by_box.items():
+            for item_barcode, comment in bucket.items():
+                yield (box_barcode, item_barcode), comment
+
+
+# Время везде хранится числом (секунды эпохи) и переводится в текст только для показа и записи в файл
+TIME_FORMAT = "%d.%m.%Y %H:%M:%S"
+_SECONDS_TEXT = tuple(f"{second:02d}" for second in range(62))
+# (минута, начало строки) — одним кортежем: его заменяют одним присваиванием,
+# поэтому поток экспорта и поток интерфейса не увидят минуту от одной записи, а текст от другой
+_format_cache = (None, "")
+_parse_cache = {}
+
+
+def format_time(seconds):
+    """Текст вида 31.12.2024 23:59:59; начало строки кешируется на минуту"""
+    global _format_cache
+    whole = int(round(seconds, 6))
+    minute = whole // 60
+    cached_minute, prefix = _format_cache
+    if cached_minute != minute:
+        prefix = datetime.fromtimestamp(minute * 60).strftime("%d.%m.%Y %H:%M:")
+        _format_cache = (minute, prefix)
+    return prefix + _SECONDS_TEXT[whole - minute * 60]
+
+
+def parse_time(text):
+    """Разбирает строку в формате TIME_FORMAT в секунды эпохи; ValueError, если формат другой.
+    Минута переводится через datetime один раз, секунды добавляются арифметикой"""
+    if len(text) != 19 or text[2] != '.' or text[5] != '.' or text[10] != ' ' or text[13] != ':' or text[16] != ':':
+        return datetime.strptime(text, TIME_FORMAT).timestamp()
+    minute_key = text[:16]
+    minute_start = _parse_cache.get(minute_key)
+    if minute_start is None:
+        minute_start = datetime(int(text[6:10]), int(text[3:5]), int(text[0:2]), int(text[11:13]), int(text[14:16])).timestamp()
+        if len(_parse_cache) > 4096:
+            _parse_cache.clear()
+        _parse_cache[minute_key] = minute_start
+    second = int(text[17:19])
+    if second > 59:
+        raise ValueError(f"time data {text!r} does not match format {TIME_FORMAT!r}")
+    return minute_start + second
+
+
+TYPE_BOX = 0
+TYPE_ITEM = 1
+ENTRY_TYPES = ('box', 'item')
+
+ACTIONS = ('scan', 'edit_count', 'edit_barcode', 'edit_comment', 'delete', 'undo')
+ACTION_TYPES = ('scan', 'edit', 'undo', 'final')
+# Названия действий в окне истории; неизвестные показываются как есть
+ACTION_TEXT = {
+    'scan': "Сканирование",
+    'edit_count': "Изменение количества",
+    'edit_barcode': "Изменение штрихкода",
+    'edit_comment': "Изменение комментария",
+    'delete': "Удаление",
+    'undo': "↩️ Отмена",
+}
+
+# Детали записи истории собираются из кода и аргументов только когда их показывают или пишут в файл
+DETAIL_TEXT = 0
+DETAIL_SCAN_ITEM = 1
+DETAIL_DELETE_BOX = 2
+DETAIL_DELETE_ITEM = 3
+DETAIL_DELETE_ITEM_COUNT = 4
+DETAIL_EDIT_COUNT = 5
+DETAIL_RENAME = 6
+DETAIL_COMMENT = 7
+DETAIL_UNDO_SCAN = 8
+DETAIL_UNDO_COUNT = 9
+DETAIL_UNDO_BARCODE = 10
+
+
+def _format_count_change(old_count, new_count):
+    change = new_count - old_count
+    change_sign = "+" if change > 0 else ""
+    return f'{old_count} → {new_count} ({change_sign}{change})'
+
+
+DETAIL_FORMATS = (
+    None,
+    '📷 Сканирование товара',
+    'Удаление короба',
+    'Удаление товара',
+    'Удаление товара (было {0})',
+    _format_count_change,
+    '{0} → {1}',
+    'Комментарий: "{0}" → "{1}"',
+    '↩️ Отмена сканирования (было {0} → {1})',
+    '↩️ Отмена изменения количества: {0} → {1}',
+    '↩️ Отмена изменения штрихкода: {0} → {1}',
+)
+
+
+class CodeTable:
+    """Небольшой словарь строковых значений с номерами; неизвестные значения дописываются в конец.
+    Только дополняется — снимки истории делят таблицу с живой историей"""
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.codes = {name: code for code, name in enumerate(self.names)}
+
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+        return code
+
+
+class HistoryEntry:
+    """Запись истории, читаемая из столбцов ScanHistory по номеру"""
+    __slots__ = ('history', 'index')
+
+    def __init__(self, history, index):
+        self.history = history
+        self.index = index
+
+    @property
+    def timestamp(self):
+        return self.history.times[self.index]
+
+    @property
+    def time_text(self):
+        return self.history.time_text(self.index)
+
+    @property
+    def type(self):
+        return ENTRY_TYPES[self.history.types[self.index]]
+
+    @property
+    def barcode(self):
+        return self.history.barcodes.names[self.history.barcode_ids[self.index]]
+
+    @property
+    def box_barcode(self):
+        box_id = self.history.box_ids[self.index]
+        return self.history.barcodes.names[box_id] if box_id >= 0 else None
+
+    @property
+    def action(self):
+        return self.history.action(self.index)
+
+    @property
+    def action_type(self):
+        return self.history.action_type(self.index)
+
+    @property
+    def details(self):
+        return self.history.details(self.index)
+
+
+class HistoryTextIndex:
+    """Инвертированный индекс записей истории по названию действия и деталям. Одинаковые тексты
+    (тип записи, код действия, код и аргументы деталей) хранятся один раз вместе с номерами записей,
+    подстрока ищется только среди различных текстов. Новые записи добавляются при поиске"""
+    def __init__(self, history):
+        self.history = history
+        self.text_ids = {}
+        self.texts = SubstringIndex()
+        self.postings = []
+        self.entry_types = []
+        self.size = 0
+
+    def update(self):
+        history = self.history
+        text_ids = self.text_ids
+        for index in range(self.size, len(history)):
+            key = (history.types[index], history.action_codes[index], history.detail_codes[index], history.detail_args.get(index))
+            text_id = text_ids.get(key)
+            if text_id is None:
+                text_id = text_ids[key] = len(self.postings)
+                self.entry_types.append(history.types[index])
+                # Действие и детали ищутся по отдельности, оба текста ведут к одному списку записей
+                self.texts.add(2 * text_id, history.action_text(index))
+                self.texts.add(2 * text_id + 1, history.details(index))
+                self.postings.append(array('l'))
+            self.postings[text_id].append(index)
+        self.size = len(history)
+
+    def search(self, query, entry_type=None):
+        self.update()
+        entries = set()
+        for text_id in {text_id // 2 for text_id in self.texts.search(query)}:
+            if entry_type is None or self.entry_types[text_id] == entry_type:
+                entries.update(self.postings[text_id])
+        return entries
+
+
+class ScanHistory:
+    """История сканирования по столбцам: время, тип, номера штрихкодов, коды действий и деталей.
+    Добавление записи — O(1), строки собираются только при чтении"""
+    def __init__(self, barcodes):
+        self.barcodes = barcodes
+        self.actions = CodeTable(ACTIONS)
+        self.action_types = CodeTable(ACTION_TYPES)
+        self.times = array('d')
+        self.types = array('b')
+        self.barcode_ids = array('l')
+        self.box_ids = array('l')
+        self.action_codes = array('h')
+        self.action_type_codes = array('h')
+        self.detail_codes = array('b')
+        # Редкие значения храним по номеру записи, чтобы не держать пустые ячейки
+        self.detail_args = {}
+        self.raw_times = {}
+        # Группировка по коробам и товарам: строится при первом groups() и дальше дополняется в append
+        self.group_index = None
+        self.text_index = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        return (HistoryEntry(self, index) for index in range(len(self)))
+
+    def __getitem__(self, index):
+        return HistoryEntry(self, index)
+
+    def append(self, entry_type, barcode_id, box_id, action, action_type, detail_code, detail_args=(), timestamp=None):
+        index = len(self.times)
+        self.times.append(time() if timestamp is None else timestamp)
+        self.types.append(entry_type)
+        self.barcode_ids.append(barcode_id)
+        self.box_ids.append(-1 if box_id is None else box_id)
+        self.action_codes.append(self.actions.code(action))
+        self.action_type_codes.append(self.action_types.code(action_type))
+        self.detail_codes.append(detail_code)
+        if detail_args:
+            self.detail_args[index] = detail_args
+        if self.group_index is not None:
+            self._group(index, entry_type, barcode_id, -1 if box_id is None else box_id)
+        return index
+
+    def action(self, index):
+        return self.actions.names[self.action_codes[index]]
+
+    def action_type(self, index):
+        return self.action_types.names[self.action_type_codes[index]]
+
+    def action_text(self, index):
+        action = self.action(index)
+        return ACTION_TEXT.get(action, action)
+
+    def search(self, query, entry_type=None):
+        """Номера записей, у которых название действия или детали содержат query без учёта регистра"""
+        if self.text_index is None:
+            self.text_index = HistoryTextIndex(self)
+        return self.text_index.search(query, entry_type)
+
+    def details(self, index):
+        code = self.detail_codes[index]
+        args = self.detail_args.get(index, ())
+        if code == DETAIL_TEXT:
+            return args[0] if args else ''
+        detail_format = DETAIL_FORMATS[code]
+        if callable(detail_format):
+            return detail_format(*args)
+        return detail_format.format(*args)
+
+    def time_text(self, index):
+        raw = self.raw_times.get(index)
+        if raw is not None:
+            return raw
+        return format_time(self.times[index])
+
+    def groups(self):
+        """Первая запись каждого короба и записи товаров по коробам.
+        Возвращает ({номер короба: индекс}, {номер короба: {номер товара: [индексы]}}).
+        Списки только дополняются, пока история не заменена целиком"""
+        if self.group_index is None:
+            self.group_index = ({}, {})
+            # range(len(self)) ограничивает проход: у снимка столбцы длиннее его размера
+            for index, entry_type, barcode_id, box_id in zip(range(len(self)), self.types, self.barcode_ids, self.box_ids):
+                self._group(index, entry_type, barcode_id, box_id)
+        return self.group_index
+
+    def _group(self, index, entry_type, barcode_id, box_id):
+        box_entries, item_entries = self.group_index
+        if entry_type == TYPE_BOX:
+            if barcode_id not in box_entries:
+                box_entries[barcode_id] = index
+        else:
+            item_entries.setdefault(box_id, {}).setdefault(barcode_id, []).append(index)
+
+    def append_entry(self, entry):
+        """Добавляет запись в виде dict: время — секунды из импорта CSV или ISO-строка из старого файла состояния"""
+        timestamp = entry.get('timestamp', '')
+        raw = None
+        if isinstance(timestamp, float):
+            seconds = timestamp
+        else:
+            try:
+                seconds = datetime.fromisoformat(timestamp).timestamp()
+            except (TypeError, ValueError):
+                seconds = float('nan')
+                raw = timestamp
+        box_barcode = entry.get('box_barcode')
+        details = entry.get('details', '')
+        index = self.append(
+            ENTRY_TYPES.index(entry['type']) if entry.get('type') in ENTRY_TYPES else TYPE_ITEM,
+            self.barcodes.intern(entry['barcode']),
+            self.barcodes.intern(box_barcode) if box_barcode else None,
+            entry.get('action', 'scan'),
+            entry.get('action_type', 'scan'),
+            DETAIL_TEXT,
+            (details,) if details else (),
+            seconds,
+        )
+        if raw is not None:
+            self.raw_times[index] = raw
+
+    def snapshot(self):
+        return HistorySnapshot(self)
+
+    def to_state(self):
+        # Всё ограничено len(self): у снимка столбцы и словари общие с живой историей.
+        # list(...items()) берёт словарь целиком за один шаг, пока его дополняет другой поток
+        size = len(self)
+        return {
+            "barcodes": self.barcodes.names,
+            "actions": self.actions.names,
+            "action_types": self.action_types.names,
+            "times": self.times[:size].tolist(),
+            "types": self.types[:size].tolist(),
+            "barcode_ids": self.barcode_ids[:size].tolist(),
+            "box_ids": self.box_ids[:size].tolist(),
+            "action_codes": self.action_codes[:size].tolist(),
+            "action_type_codes": self.action_type_codes[:size].tolist(),
+            "detail_codes": self.detail_codes[:size].tolist(),
+            "detail_args": {str(index): list(args) for index, args in list(self.detail_args.items()) if index < size},
+            "raw_times": {str(index): raw for index, raw in list(self.raw_times.items()) if index < size},
+        }
+
+    def load_state(self, data):
+        # Номера штрихкодов в файле могут не совпадать с текущей таблицей — переводим через имена
+        id_map = [self.barcodes.intern(name) for name in data["barcodes"]]
+        action_map = [self.actions.code(name) for name in data["actions"]]
+        action_type_map = [self.action_types.code(name) for name in data["action_types"]]
+        self.times = array('d', data["times"])
+        self.types = array('b', data["types"])
+        self.barcode_ids = array('l', (id_map[barcode_id] for barcode_id in data["barcode_ids"]))
+        self.box_ids = array('l', (id_map[box_id] if box_id >= 0 else -1 for box_id in data["box_ids"]))
+        self.action_codes = array('h', (action_map[code] for code in data["action_codes"]))
+        self.action_type_codes = array('h', (action_type_map[code] for code in data["action_type_codes"]))
+        self.detail_codes = array('b', data["detail_codes"])
+        self.detail_args = {int(index): tuple(args) for index, args in data.get("detail_args", {}).items()}
+        self.raw_times = {int(index): raw for index, raw in data.get("raw_times", {}).items()}
+        self.group_index = None
+        self.text_index = None
+
+
+class HistorySnapshot(ScanHistory):
+    """История на момент снимка без копирования. Столбцы и словари общие с живой историей:
+    та их только дополняет (загрузка заменяет их новыми объектами), а снимок читает первые size записей"""
+    def __init__(self, history):
+        super().__init__(history.barcodes)
+        self.size = len(history)
+        self.actions = history.actions
+        self.action_types = history.action_types
+        self.times = history.times
+        self.types = history.types
+        self.barcode_ids = history.barcode_ids
+        self.box_ids = history.box_ids
+        self.action_codes = history.action_codes
+        self.action_type_codes = history.action_type_codes
+        self.detail_codes = history.detail_codes
+        self.detail_args = history.detail_args
+        self.raw_times = history.raw_times
+
+    def __len__(self):
+        return self.size
+
+    def append(self, *args, **kwargs):
+        raise TypeError("Снимок истории только для чтения")
+
+
+class Reconciliation:
+    """Счётчики сверки с накладной, которые меняются по дельте при изменении суммы товара"""
+    def __init__(self):
+        self.planned = {}
+        self.reset()
+
+    def reset(self):
+        self.planned_total = sum(self.planned.values())
+        self.scanned_planned = 0
+        self.match_count = 0
+        self.shortage_count = 0
+        self.shortage_units = 0
+        self.excess_count = 0
+        self.excess_units = 0
+        self.extra_count = 0
+        self.extra_units = 0
+        # Позиции накладной, которые ещё не сканировались, сразу считаются недобором
+        for item_id in self.planned:
+            self._apply(item_id, 0, 0, 1)
+
+    def load(self, planned, item_totals, item_boxes):
+        self.planned = planned
+        self.reset()
+        for item_id, boxes in item_boxes.items():
+            self.update(item_id, 0, 0, item_totals[item_id], len(boxes))
+
+    def update(self, item_id, old_total, old_lines, new_total, new_lines):
+        self._apply(item_id, old_total, old_lines, -1)
+        self._apply(item_id, new_total, new_lines, 1)
+
+    def _apply(self, item_id, total, lines, sign):
+        planned = self.planned.get(item_id)
+        if planned is None:
+            # Лишние считаются по строкам в коробах, как и в таблице
+            self.extra_count += sign * lines
+            self.extra_units += sign * total
+            return
+
+        self.scanned_planned += sign * min(total, planned)
+        if total == planned:
+            self.match_count += sign
+        elif total < planned:
+            self.shortage_count += sign
+            self.shortage_units += sign * (planned - total)
+        else:
+            self.excess_count += sign
+            self.excess_units += sign * (total - planned)
+
+
+class ScanIndex:
+    """Индексы по содержимому коробов: суммы по товару, по коробу и общая, короба с товаром.
+    Работает с номерами из BarcodeTable, суммы лежат в массивах по номеру"""
+    def __init__(self):
+        self.item_totals = array('l')
+        self.box_totals = array('l')
+        self.item_boxes = {}
+        # Товары, чьи словари коробов общие со снимком: перед изменением словарь копируется
+        self.shared = set()
+        self.grand_total = 0
+        self.reconciliation = Reconciliation()
+
+    def _item_boxes(self, item_id):
+        boxes = self.item_boxes.get(item_id)
+        if boxes is None:
+            boxes = self.item_boxes[item_id] = {}
+        elif item_id in self.shared:
+            boxes = self.item_boxes[item_id] = dict(boxes)
+            self.shared.discard(item_id)
+        return boxes
+
+    def _grow(self, totals, barcode_id):
+        if barcode_id >= len(totals):
+            totals.extend([0] * (barcode_id + 1 - len(totals)))
+
+    def rebuild(self, boxes):
+        self.item_totals = array('l')
+        self.box_totals = array('l')
+        self.item_boxes = {}
+        self.shared = set()
+        self.grand_total = 0
+        self.reconciliation.reset()
+        for box_id, contents in boxes.items():
+            self._grow(self.box_totals, box_id)
+            for item_id, count in contents.lines():
+                self.add_line(box_id, item_id, count)
+
+    def set_invoice(self, planned):
+        self.reconciliation.load(planned, self.item_totals, self.item_boxes)
+
+    def add_line(self, box_id, item_id, count):
+        # dict вместо set: короба перечисляются в порядке появления в них товара
+        boxes = self._item_boxes(item_id)
+        old_lines = len(boxes)
+        boxes[box_id] = None
+        self._change_total(box_id, item_id, count, old_lines)
+
+    def remove_line(self, box_id, item_id, count):
+        boxes = self._item_boxes(item_id)
+        old_lines = len(boxes)
+        boxes.pop(box_id, None)
+        if not boxes:
+            self.item_boxes.pop(item_id, None)
+            self.shared.discard(item_id)
+        self._change_total(box_id, item_id, -count, old_lines)
+
+    def remove_box(self, box_id, contents):
+        for item_id, count in list(contents.lines()):
+            self.remove_line(box_id, item_id, count)
+        if box_id < len(self.box_totals):
+            self.box_totals[box_id] = 0
+
+    def rename_box(self, old_id, new_id, contents):
+        # Пустой короб мог ни разу не попасть в массив — растим под оба номера
+        self._grow(self.box_totals, max(old_id, new_id))
+        self.box_totals[new_id] = self.box_total(old_id)
+        self.box_totals[old_id] = 0
+        for item_id in contents.item_ids:
+            boxes = self._item_boxes(item_id)
+            del boxes[old_id]
+            boxes[new_id] = None
+
+    def add(self, box_id, item_id, delta):
+        self._change_total(box_id, item_id, delta, len(self.item_boxes.get(item_id, ())))
+
+    def _change_total(self, box_id, item_id, delta, old_lines):
+        self._grow(self.box_totals, box_id)
+        self._grow(self.item_totals, item_id)
+        self.box_totals[box_id] += delta
+        self.grand_total += delta
+        old_total = self.item_totals[item_id]
+        total = old_total + delta
+        self.item_totals[item_id] = total
+        lines = len(self.item_boxes.get(item_id, ()))
+        self.reconciliation.update(item_id, old_total, old_lines, total, lines)
+
+    def total(self, item_id):
+        return self.item_totals[item_id] if item_id is not None and item_id < len(self.item_totals) else 0
+
+    def box_total(self, box_id):
+        return self.box_totals[box_id] if box_id is not None and box_id < len(self.box_totals) else 0
+
+    def boxes_with(self, item_id):
+        return self.item_boxes.get(item_id, {}).keys()
+
+    def snapshot(self):
+        """Копия для чтения из другого потока: массивы сумм копируются, словари коробов по товарам общие до первого изменения"""
+        index = ScanIndex()
+        index.item_totals = self.item_totals[:]
+        index.box_totals = self.box_totals[:]
+        index.item_boxes = dict(self.item_boxes)
+        self.shared = set(self.item_boxes)
+        index.grand_total = self.grand_total
+        index.reconciliation = copy.copy(self.reconciliation)
+        return index
+
+
+class ScanError(Exception):
+    pass
+
+
+class SessionObserver:
+    """Получатель изменений сессии (например, модель для Qt). Вызывается после изменения данных;
+    номера — из BarcodeTable. Методы по умолчанию ничего не делают"""
+    def box_added(self, box_id):
+        pass
+
+    def box_removed(self, box_id):
+        pass
+
+    def box_renamed(self, old_id, new_id):
+        pass
+
+    def line_added(self, box_id, item_id):
+        pass
+
+    def line_changed(self, box_id, item_id):
+        pass
+
+    def line_removed(self, box_id, item_id):
+        pass
+
+    def item_total_changed(self, item_id, old_total):
+        pass
+
+    def comment_changed(self, box_barcode, item_barcode):
+        pass
+
+    def invoice_changed(self):
+        pass
+
+    def boxes_reset(self):
+        pass
+
+    def history_appended(self, index):
+        pass
+
+
+def _history_sort_key(entry):
+    timestamp = entry.get('timestamp', '')
+    if isinstance(timestamp, float):
+        return (0, timestamp, '')
+    return (1, 0.0, timestamp)
+
+
+CSV_HEADER = ["Сборщик", "Штрихкод короба", "Комментарий короба", "Штрихкод товара", "Количество", "Комментарий товара", "Время сканирования короба", "Время сканирования товара", "Тип действия", "Детали"]
+
+
+class ScanSession:
+    """Состояние сборки без привязки к Qt: короба, комментарии, история, накладная и отмена"""
+    def __init__(self, undo_size=10):
+        self.undo_size = undo_size
+        self.strict_validation_enabled = True
+        self.observers = []
+        self.reset()
+
+    def reset(self):
+        self.barcodes = BarcodeTable()
+        # Индекс для фильтра по штрихкодам, догоняет таблицу при поиске
+        self.barcode_index = SubstringIndex()
+        # Короба хранятся по номеру штрихкода; порядок dict — порядок коробов в таблице
+        self.boxes = {}
+        # Короба, общие с последним снимком: перед изменением BoxContents копируется
+        self.shared_boxes = set()
+        self.scan_index = ScanIndex()
+        self.comments = CommentStore()
+        self.scan_history = ScanHistory(self.barcodes)
+        self.undo_manager = UndoManager(max_size=self.undo_size)
+        self.current_box_barcode = ""
+        self.packer_name = ""
+        self.invoice_data = {}
+        self.invoice_loaded = False
+        self.invoice_file_name = ""
+        self.invoice_file_path = ""
+        self._notify('boxes_reset')
+
+    def _notify(self, event, *args):
+        for observer in self.observers:
+            getattr(observer, event)(*args)
+
+    # --- Штрихкоды ---
+
+    def convert_ru_to_en_layout_box(self, barcode):
+        if len(barcode) >= 3 and barcode.lower().startswith('ца'):
+            barcode = 'wb' + barcode[2:]
+        elif len(barcode) >= 4 and barcode.lower().startswith('ци_'):
+            barcode = 'WB_' + barcode[3:]
+        return barcode
+
+    def convert_ru_to_en_layout_item(self, barcode):
+        if len(barcode) >= 4 and barcode.lower().startswith('щят'):
+            barcode = 'OZN' + barcode[3:]
+        return barcode
+
+    def is_valid_barcode(self, barcode, barcode_type):
+        if not self.strict_validation_enabled:
+            return bool(re.match(r"^[\w\-\./]+$", barcode)) and 4 <= len(barcode) <= 50
+        
+        patterns = {
+            'box': [
+                r'^WB_[\w\-]+$',
+                r'^\d{8,}$',
+                r'^[A-Z]{2}\d{6,}$',
+                r'^[A-Z0-9]{10,}$'
+            ],
+            'item': [
+                r'^\d{8}$',
+                r'^\d{12}$',
+                r'^\d{13}$',
+                r'^OZN\d+$',
+                r'^ozn\d+$',
+                r'^[A-Z]{2}\d{9}[A-Z]{2}$',
+                r'^[0-9]{8,14}$'
+            ]
+        }
+        
+        for pattern in patterns.get(barcode_type, patterns['item']):
+            if re.match(pattern, barcode, re.IGNORECASE):
+                return 4 <= len(barcode) <= 50
+        return False
+
+    # --- Чтение состояния ---
+
+    def _box(self, box_barcode):
+        return self.boxes.get(self.barcodes.get(box_barcode))
+
+    def iter_boxes(self):
+        names = self.barcodes.names
+        return ((names[box_id], contents) for box_id, contents in self.boxes.items())
+
+    def box_items(self, box_barcode):
+        return self._box(box_barcode) or {}
+
+    def has_box(self, box_barcode):
+        return self.barcodes.get(box_barcode) in self.boxes
+
+    def box_count(self):
+        return len(self.boxes)
+
+    def get_count(self, box_barcode, item_barcode):
+        contents = self._box(box_barcode)
+        return contents.get(item_barcode, 0) if contents is not None else 0
+
+    def box_total(self, box_barcode):
+        return self.scan_index.box_total(self.barcodes.get(box_barcode))
+
+    def item_total(self, item_barcode):
+        return self.scan_index.total(self.barcodes.get(item_barcode))
+
+    def get_comment(self, box_barcode, item_barcode=""):
+        return self.comments.get(box_barcode, item_barcode)
+
+    def search_barcodes(self, query):
+        """Номера штрихкодов, содержащих query без учёта регистра"""
+        index = self.barcode_index
+        names = self.barcodes.names
+        for barcode_id in range(len(index), len(names)):
+            index.add(barcode_id, names[barcode_id])
+        return index.search(query)
+
+    def get_total_scanned_for_item(self, item_barcode, exclude_box=None):
+        total = self.item_total(item_barcode)
+        if exclude_box:
+            total -= self.get_count(exclude_box, item_barcode)
+        return total
+
+    def get_item_status(self, item_barcode):
+        """Иконка статуса и план для товара; без накладной — пустые строки"""
+        if not self.invoice_loaded:
+            return "", ""
+        if item_barcode not in self.invoice_data:
+            return "❓", "0"
+        planned = self.invoice_data[item_barcode]
+        total_scanned = self.item_total(item_barcode)
+        if total_scanned == planned:
+            return "✅", str(planned)
+        elif total_scanned < planned:
+            return "⚠️", str(planned)
+        return "❗", str(planned)
+
+    def check_duplicate_item(self, barcode, current_box):
+        """Проверка дубликатов с учетом плана"""
+        if not self.invoice_loaded:
+            return []  # Без накладной не предупреждаем
+            
+        total_scanned = self.get_total_scanned_for_item(barcode)
+        planned = self.invoice_data.get(barcode, 0)
+        
+        # Если план есть и общее количество не превышает план - ок
+        if planned > 0 and total_scanned < planned:
+            return []
+            
+        # Ищем в каких коробах уже есть этот товар
+        names = self.barcodes.names
+        return [names[box_id] for box_id in self.scan_index.boxes_with(self.barcodes.get(barcode)) if names[box_id] != current_box]
+
+    # --- Изменение содержимого коробов ---
+    # Все изменения идут через эти методы, чтобы индекс не расходился с данными
+
+    def _add_box(self, box_barcode):
+        box_id = self.barcodes.intern(box_barcode)
+        if box_id not in self.boxes:
+            self.boxes[box_id] = BoxContents(self.barcodes)
+            self._notify('box_added', box_id)
+        return box_id
+
+    def _writable_box(self, box_id):
+        contents = self.boxes[box_id]
+        if box_id in self.shared_boxes:
+            contents = self.boxes[box_id] = contents.copy()
+            self.shared_boxes.discard(box_id)
+        return contents
+
+    def _set_item_count(self, box_barcode, item_barcode, count):
+        box_id = self.barcodes.get(box_barcode)
+        item_id = self.barcodes.intern(item_barcode)
+        contents = self._writable_box(box_id)
+        old_total = self.scan_index.total(item_id)
+        if item_id in contents.positions:
+            self.scan_index.add(box_id, item_id, count - contents.count(item_id))
+            contents.set(item_id, count)
+            self._notify('line_changed', box_id, item_id)
+        else:
+            self.scan_index.add_line(box_id, item_id, count)
+            contents.set(item_id, count)
+            self._notify('line_added', box_id, item_id)
+        self._notify('item_total_changed', item_id, old_total)
+
+    def _remove_item(self, box_barcode, item_barcode):
+        box_id = self.barcodes.get(box_barcode)
+        item_id = self.barcodes.get(item_barcode)
+        count = self._writable_box(box_id).remove(item_id)
+        self.scan_index.remove_line(box_id, item_id, count)
+        self._notify('line_removed', box_id, item_id)
+        self._notify('item_total_changed', item_id, self.scan_index.total(item_id) + count)
+
+    def _remove_box(self, box_barcode):
+        box_id = self.barcodes.get(box_barcode)
+        contents = self.boxes.pop(box_id)
+        self.shared_boxes.discard(box_id)
+        self.scan_index.remove_box(box_id, contents)
+        self._notify('box_removed', box_id)
+        for item_id, count in contents.lines():
+            self._notify('item_total_changed', item_id, self.scan_index.total(item_id) + count)
+
+    def _rename_box(self, old_barcode, new_barcode):
+        old_id = self.barcodes.get(old_barcode)
+        new_id = self.barcodes.intern(new_barcode)
+        contents = self.boxes[old_id]
+        self.scan_index.rename_box(old_id, new_id, contents)
+        del self.boxes[old_id]
+        self.boxes[new_id] = contents
+        if old_id in self.shared_boxes:
+            self.shared_boxes.discard(old_id)
+            self.shared_boxes.add(new_id)
+        self._notify('box_renamed', old_id, new_id)
+
+    def _replace_boxes(self, all_boxes):
+        """Загружает короба из вида {короб: {товар: количество}} (состояние, CSV)"""
+        self.boxes = {}
+        self.shared_boxes = set()
+        for box_barcode, items in all_boxes.items():
+            box_id = self.barcodes.intern(box_barcode)
+            contents = self.boxes.get(box_id)
+            if contents is None:
+                contents = self.boxes[box_id] = BoxContents(self.barcodes)
+            for item_barcode, count in items.items():
+                contents.set(self.barcodes.intern(item_barcode), count)
+        self.scan_index.rebuild(self.boxes)
+
+    def _history_from_entries(self, entries):
+        history = ScanHistory(self.barcodes)
+        for entry in entries:
+            history.append_entry(entry)
+        return history
+
+    def _log(self, entry_type, barcode, action, action_type, detail_code, detail_args=(), box_barcode=None):
+        box_id = self.barcodes.intern(box_barcode) if box_barcode is not None else None
+        index = self.scan_history.append(entry_type, self.barcodes.intern(barcode), box_id, action, action_type, detail_code, detail_args)
+        self._notify('history_appended', index)
+
+    # --- Операции сборки ---
+
+    def scan_box(self, barcode):
+        if not self.is_valid_barcode(barcode, barcode_type='box'):
+            raise ScanError("Неверный штрихкод короба!")
+
+        self._add_box(barcode)
+        self.current_box_barcode = barcode
+        self._log(TYPE_BOX, barcode, 'scan', 'scan', DETAIL_TEXT)
+
+    def close_box(self):
+        self.current_box_barcode = ""
+
+    def scan_item(self, barcode):
+        if not self.current_box_barcode:
+            raise ScanError("Сначала отсканируйте штрихкод короба!")
+        if not self.is_valid_barcode(barcode, barcode_type='item'):
+            raise ScanError("Неверный штрихкод товара!")
+        if not self.has_box(self.current_box_barcode):
+            raise ScanError("Текущий короб не найден!")
+
+        box_barcode = self.current_box_barcode
+        self._set_item_count(box_barcode, barcode, self.get_count(box_barcode, barcode) + 1)
+
+        # Добавляем действие в стек отмены
+        self.undo_manager.add_action({
+            'type': 'scan',
+            'barcode': barcode,
+            'box_barcode': box_barcode
+        })
+        self._log(TYPE_ITEM, barcode, 'scan', 'scan', DETAIL_SCAN_ITEM, box_barcode=box_barcode)
+        return self.get_count(box_barcode, barcode)
+
+    def set_item_count(self, box_barcode, barcode, new_count):
+        if not self.has_box(box_barcode):
+            return
+        old_count = self.get_count(box_barcode, barcode)
+
+        if new_count == 0:
+            if barcode in self.box_items(box_barcode):
+                # Добавляем в стек отмены
+                self.undo_manager.add_action({
+                    'type': 'edit_count',
+                    'barcode': barcode,
+                    'box_barcode': box_barcode,
+                    'old_value': old_count,
+                    'new_value': 0
+                })
+                
+                self._remove_item(box_barcode, barcode)
+                if not self.box_items(box_barcode):
+                    self._remove_box(box_barcode)
+                
+                self._log(TYPE_ITEM, barcode, 'delete', 'edit', DETAIL_DELETE_ITEM_COUNT, (old_count,), box_barcode)
+        else:
+            # Добавляем в стек отмены
+            self.undo_manager.add_action({
+                'type': 'edit_count',
+                'barcode': barcode,
+                'box_barcode': box_barcode,
+                'old_value': old_count,
+                'new_value': new_count
+            })
+            
+            self._set_item_count(box_barcode, barcode, new_count)
+            
+            self._log(TYPE_ITEM, barcode, 'edit_count', 'edit', DETAIL_EDIT_COUNT, (old_count, new_count), box_barcode)
+
+    def rename_box(self, old_barcode, new_barcode):
+        if not self.is_valid_barcode(new_barcode, barcode_type='box'):
+            raise ScanError("Неверный штрихкод короба!")
+        if self.has_box(new_barcode):
+            raise ScanError("Короб с таким штрихкодом уже существует!")
+        if not self.has_box(old_barcode):
+            raise ScanError("Короб не найден!")
+
+        # Все проверки выше: дальше переименование не прерывается на полпути.
+        # Комментарии переносим раньше коробов, чтобы наблюдатели сразу видели их на новом месте
+        self.comments.rename_box(old_barcode, new_barcode)
+        self._rename_box(old_barcode, new_barcode)
+
+        if self.current_box_barcode == old_barcode:
+            self.current_box_barcode = new_barcode
+        
+        self._log(TYPE_BOX, new_barcode, 'edit_barcode', 'edit', DETAIL_RENAME, (old_barcode, new_barcode))
+
+    def rename_item(self, box_barcode, old_barcode, new_barcode):
+        if not self.is_valid_barcode(new_barcode, barcode_type='item'):
+            raise ScanError("Неверный штрихкод товара!")
+        if new_barcode in self.box_items(box_barcode):
+            raise ScanError("Товар с таким штрихкодом уже есть в этом коробе!")
+
+        count = self.get_count(box_barcode, old_barcode)
+        self.undo_manager.add_action({
+            'type': 'edit_barcode',
+            'barcode': new_barcode,
+            'box_barcode': box_barcode,
+            'old_value': old_barcode,
+            'new_value': new_barcode,
+            'count': count
+        })
+        
+        self._remove_item(box_barcode, old_barcode)
+        self._set_item_count(box_barcode, new_barcode, count)
+        
+        self.comments.rename_item(box_barcode, old_barcode, new_barcode)
+        self._notify('comment_changed', box_barcode, new_barcode)
+        
+        self._log(TYPE_ITEM, new_barcode, 'edit_barcode', 'edit', DETAIL_RENAME, (old_barcode, new_barcode), box_barcode)
+
+    def delete_box(self, box_barcode):
+        self._log(TYPE_BOX, box_barcode, 'delete', 'edit', DETAIL_DELETE_BOX)
+        
+        self._remove_box(box_barcode)
+        self.comments.remove_box(box_barcode)
+        if self.current_box_barcode == box_barcode:
+            self.current_box_barcode = ""
+
+    def delete_item(self, box_barcode, item_barcode):
+        self._log(TYPE_ITEM, item_barcode, 'delete', 'edit', DETAIL_DELETE_ITEM, box_barcode=box_barcode)
+        
+        self._remove_item(box_barcode, item_barcode)
+        self.comments.remove(box_barcode, item_barcode)
+        if not self.box_items(box_barcode):
+            self._remove_box(box_barcode)
+        self.comments.remove(box_barcode, "")
+        self._notify('comment_changed', box_barcode, "")
+        if self.current_box_barcode == box_barcode:
+            self.current_box_barcode = ""
+
+    def set_comment(self, box_barcode, item_barcode, comment):
+        current_comment = self.get_comment(box_barcode, item_barcode)
+        if comment == current_comment:
+            return False
+
+        self.comments.set(box_barcode, item_barcode, comment)
+        self._notify('comment_changed', box_barcode, item_barcode)
+        if item_barcode:
+            self._log(TYPE_ITEM, item_barcode, 'edit_comment', 'edit', DETAIL_COMMENT, (current_comment, comment), box_barcode)
+        else:
+            self._log(TYPE_BOX, box_barcode, 'edit_comment', 'edit', DETAIL_COMMENT, (current_comment, comment))
+        return True
+
+    def undo(self):
+        """Отменяет последнее действие; возвращает его или None, если отменять было нечего"""
+        action = self.undo_manager.undo()
+        if not action:
+            return None
+            
+        action_type = action.get('type')
+        
+        if action_type == 'scan':
+            box = action['box_barcode']
+            item = action['barcode']
+            
+            if item not in self.box_items(box):
+                return None
+
+            old_count = self.get_count(box, item)
+            if old_count <= 1:
+                self._remove_item(box, item)
+                if not self.box_items(box):
+                    self._remove_box(box)
+                    if self.current_box_barcode == box:
+                        self.current_box_barcode = ""
+            else:
+                self._set_item_count(box, item, old_count - 1)
+            
+            self._log(TYPE_ITEM, item, 'undo', 'undo', DETAIL_UNDO_SCAN, (old_count, old_count - 1), box)
+                
+        elif action_type == 'edit_count':
+            box = action['box_barcode']
+            item = action['barcode']
+            old_count = action['old_value']
+            new_count = action['new_value']
+            
+            if self.has_box(box):
+                if old_count == 0:
+                    # Было удаление - восстанавливаем
+                    self._set_item_count(box, item, new_count)
+                else:
+                    self._set_item_count(box, item, old_count)
+                    
+            self._log(TYPE_ITEM, item, 'undo', 'undo', DETAIL_UNDO_COUNT, (new_count, old_count), box)
+            
+        elif action_type == 'edit_barcode':
+            box = action['box_barcode']
+            old_barcode = action['old_value']
+            new_barcode = action['new_value']
+            count = action['count']
+            
+            if new_barcode in self.box_items(box):
+                self._remove_item(box, new_barcode)
+                self._set_item_count(box, old_barcode, count)
+                
+            self._log(TYPE_ITEM, old_barcode, 'undo', 'undo', DETAIL_UNDO_BARCODE, (new_barcode, old_barcode), box)
+
+        return action
+
+    # --- Накладная ---
+
+    def load_invoice(self, invoice_data, file_name="", file_path=""):
+        self.invoice_data = invoice_data
+        self.scan_index.set_invoice({self.barcodes.intern(barcode): count for barcode, count in invoice_data.items()})
+        self.invoice_loaded = True
+        self.invoice_file_name = file_name
+        self.invoice_file_path = file_path
+        self._notify('invoice_changed')
+
+    def clear_invoice(self):
+        self.invoice_data = {}
+        self.scan_index.set_invoice({})
+        self.invoice_loaded = False
+        self.invoice_file_name = ""
+        self.invoice_file_path = ""
+        self._notify('invoice_changed')
+
+    def read_invoice(self, file_path, progress_callback=None, status_callback=None):
+        if status_callback:
+            status_callback("📂 Чтение файла Excel...")
+    
+        wb = openpyxl.load_workbook(file_path)
+        sheet = wb.active
+    
+        total_rows = sheet.max_row - 1
+        if total_rows > 0 and progress_callback:
+            progress_callback(0, total_rows)
+    
+        invoice_data = {}
+        total_items = 0
+        total_quantity = 0
+    
+        for i, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), 1):
+            if progress_callback:
+                progress_callback(i, total_rows)
+            
+            if i % 5 == 0 and status_callback:
+                percent = int((i / total_rows) * 100)
+                status_callback(f"📊 Загружено {percent}% ({i}/{total_rows})")
+        
+            if row[0] and row[1]:
+                barcode = str(row[0]).strip()
+                try:
+                    count = int(float(row[1]))
+                    if count > 0:
+                        invoice_data[barcode] = count
+                        total_items += 1
+                        total_quantity += count
+                except:
+                    continue
+    
+        return (invoice_data, total_items, total_quantity, os.path.basename(file_path), file_path)
+
+    # --- Импорт CSV ---
+
+    def read_csv(self, file_path, progress_callback=None, status_callback=None):
+        if status_callback:
+            status_callback("📂 Чтение CSV файла...")
+    
+        with open(file_path, "r", encoding="utf-8") as f:
+            all_lines = f.readlines()
+    
+        total_rows = len(all_lines) - 1
+        if total_rows <= 0:
+            raise ScanError("Файл пуст")
+    
+        if progress_callback:
+            progress_callback(0, total_rows)
+    
+        with open(file_path, "r", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+        
+            has_packer = len(header) >= 1 and header[0] == "Сборщик"
+            has_timestamps = len(header) >= 8 and header[6] == "Время сканирования короба" and header[7] == "Время сканирования товара"
+            has_action_types = len(header) >= 10 and header[8] == "Тип действия" and header[9] == "Детали"
+
+            if not (len(header) >= 4 and header[1] == "Штрихкод короба" and header[3] == "Штрихкод товара" and header[4] == "Количество"):
+                raise ScanError("Некорректный формат файла CSV")
+
+            all_boxes = {}
+            comments = {}
+            scan_history = []
+            packer_name = ""
+            box_timestamps = {}
+            
+            # Сначала собираем все действия в хронологическом порядке
+            actions = []
+        
+            for row_idx, row in enumerate(reader, 1):
+                if progress_callback:
+                    progress_callback(row_idx, total_rows)
+                
+                if row_idx % 50 == 0 and status_callback:
+                    percent = int((row_idx / total_rows) * 100)
+                    status_callback(f"📊 Загружено {percent}% ({row_idx}/{total_rows})")
+            
+                if len(row) < 5:
+                    continue
+
+                col_offset = 1 if has_packer else 0
+            
+                if has_packer and len(row) > 0 and row[0] and not packer_name:
+                    packer_name = row[0]
+            
+                box_barcode = row[col_offset].strip() if len(row) > col_offset else ""
+                box_comment = row[col_offset + 1].strip() if len(row) > col_offset + 1 else ""
+                item_barcode = row[col_offset + 2].strip() if len(row) > col_offset + 2 else ""
+                count_str = row[col_offset + 3].strip() if len(row) > col_offset + 3 else ""
+                item_comment = row[col_offset + 4].strip() if len(row) > col_offset + 4 else ""
+            
+                box_timestamp = row[col_offset + 5].strip() if has_timestamps and len(row) > col_offset + 5 else ""
+                item_timestamp = row[col_offset + 6].strip() if has_timestamps and len(row) > col_offset + 6 else ""
+                action_type = row[col_offset + 7].strip() if has_action_types and len(row) > col_offset + 7 else "scan"
+                details = row[col_offset + 8].strip() if has_action_types and len(row) > col_offset + 8 else ""
+
+                if not box_barcode or not item_barcode:
+                    continue
+
+                if not self.is_valid_barcode(box_barcode, barcode_type='box'):
+                    continue
+                if not self.is_valid_barcode(item_barcode, barcode_type='item'):
+                    continue
+                
+                try:
+                    count = int(count_str)
+                    if count <= 0:
+                        continue
+                except ValueError:
+                    continue
+
+                # Инициализация короба
+                if box_barcode not in all_boxes:
+                    all_boxes[box_barcode] = {}
+                
+                if box_timestamp and box_barcode not in box_timestamps:
+                    box_timestamps[box_barcode] = (box_timestamp, action_type, details)
+
+                # Сохраняем комментарии
+                comments[(box_barcode, "")] = box_comment
+                comments[(box_barcode, item_barcode)] = item_comment
+            
+                # Сохраняем действие для последующего воспроизведения
+                if item_timestamp:
+                    # Время остаётся числом; нераспознанный текст сохраняем как есть
+                    try:
+                        timestamp = parse_time(item_timestamp)
+                        ts = timestamp
+                    except:
+                        timestamp = item_timestamp
+                        ts = 0
+                    
+                    actions.append({
+                        'timestamp': timestamp,
+                        'timestamp_float': ts,
+                        'type': 'item',
+                        'barcode': item_barcode,
+                        'box_barcode': box_barcode,
+                        'action_type': action_type,
+                        'details': details,
+                        'count': count,
+                        'original_count': count
+                    })
+
+            # Сортируем действия по времени
+            actions.sort(key=lambda x: x.get('timestamp_float', 0))
+
+            # Воспроизводим действия для получения финального состояния
+            final_counts = {}
+            
+            for action in actions:
+                key = (action['box_barcode'], action['barcode'])
+                
+                if key not in final_counts:
+                    final_counts[key] = 0
+                
+                if action['action_type'] == 'scan':
+                    final_counts[key] += 1
+                elif action['action_type'] == 'edit' and '→' in action['details']:
+                    # Изменение количества
+                    try:
+                        parts = action['details'].split('→')
+                        new_part = parts[1].split('(')[0].strip()
+                        new_val = int(new_part)
+                        final_counts[key] = new_val
+                    except:
+                        pass
+                elif action['action_type'] == 'undo':
+                    if 'Отмена сканирования' in action['details']:
+                        final_counts[key] = max(0, final_counts[key] - 1)
+                    elif 'Отмена изменения количества' in action['details']:
+                        # Парсим "10 → 5"
+                        try:
+                            parts = action['details'].split('→')
+                            old_val = int(parts[1].split('(')[0].strip())
+                            final_counts[key] = old_val
+                        except:
+                            pass
+                elif action['action_type'] == 'final':
+                    # Прямое указание финального количества
+                    final_counts[key] = action['count']
+
+            # Применяем финальные количества
+            for (box_barcode, item_barcode), final_count in final_counts.items():
+                if box_barcode in all_boxes:
+                    all_boxes[box_barcode][item_barcode] = final_count
+
+            # Добавляем записи о коробах в историю
+            for box_barcode, (timestamp, action_type, details) in box_timestamps.items():
+                try:
+                    timestamp = parse_time(timestamp)
+                except:
+                    pass
+            
+                action = 'scan'
+                if action_type == 'edit':
+                    if 'изменение' in details.lower():
+                        action = 'edit_barcode'
+                    elif 'удаление' in details.lower():
+                        action = 'delete'
+        
+                scan_history.append({
+                    'timestamp': timestamp,
+                    'type': 'box',
+                    'barcode': box_barcode,
+                    'action': action,
+                    'action_type': action_type,
+                    'details': details
+                })
+
+            # Добавляем все действия в историю
+            for action in actions:
+                action_copy = action.copy()
+                if 'timestamp_float' in action_copy:
+                    del action_copy['timestamp_float']
+                if 'original_count' in action_copy:
+                    del action_copy['original_count']
+                scan_history.append(action_copy)
+
+            # Сортируем историю по времени; записи с нераспознанным временем — в конце
+            scan_history.sort(key=_history_sort_key)
+
+            start_time_val = None
+            first_scan_done = False
+            if scan_history and isinstance(scan_history[0]['timestamp'], float):
+                start_time_val = scan_history[0]['timestamp']
+                first_scan_done = True
+    
+            return (all_boxes, comments, scan_history, packer_name, start_time_val, first_scan_done, os.path.basename(file_path))
+
+    def apply_csv(self, all_boxes, comments, scan_history, packer_name=""):
+        """Заменяет содержимое сессии данными, прочитанными read_csv"""
+        self._replace_boxes(all_boxes)
+        self.comments = CommentStore(comments)
+        self.scan_history = self._history_from_entries(scan_history)
+        self.undo_manager = UndoManager(max_size=self.undo_size)
+        if packer_name:
+            self.packer_name = packer_name
+        self._notify('boxes_reset')
+
+    # --- Снимок для фонового экспорта ---
+
+    def snapshot(self):
+        """Неизменяемый срез сессии для экспорта в другом потоке, пока сборка продолжается.
+        Короба, комментарии и списки коробов по товарам общие со срезом: живая сессия
+        копирует их только при первом изменении после снимка. Таблица штрихкодов, таблицы кодов
+        и столбцы истории общие без копирования — они только дополняются (см. HistorySnapshot)"""
+        snapshot = ScanSession(undo_size=self.undo_size)
+        snapshot.strict_validation_enabled = self.strict_validation_enabled
+        snapshot.barcodes = self.barcodes
+        snapshot.boxes = dict(self.boxes)
+        self.shared_boxes = set(self.boxes)
+        snapshot.scan_index = self.scan_index.snapshot()
+        snapshot.comments = self.comments.snapshot()
+        snapshot.scan_history = self.scan_history.snapshot()
+        snapshot.current_box_barcode = self.current_box_barcode
+        snapshot.packer_name = self.packer_name
+        # Накладная при загрузке заменяется целиком, поэтому словарь можно не копировать
+        snapshot.invoice_data = self.invoice_data
+        snapshot.invoice_loaded = self.invoice_loaded
+        snapshot.invoice_file_name = self.invoice_file_name
+        snapshot.invoice_file_path = self.invoice_file_path
+        return snapshot
+
+    # --- Экспорт ---
+
+    def export_csv(self, file_path):
+        history = self.scan_history
+        box_entries, item_entries = history.groups()
+        names = self.barcodes.names
+
+        with open(file_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+
+            for box_id, contents in self.boxes.items():
+                box_barcode = names[box_id]
+                box_comment = self.get_comment(box_barcode)
+                box_index = box_entries.get(box_id)
+                box_timestamp = history.time_text(box_index) if box_index is not None else ""
+                box_items = item_entries.get(box_id, {})
+                
+                for item_id, count in contents.lines():
+                    item_barcode = names[item_id]
+                    item_comment = self.get_comment(box_barcode, item_barcode)
+                    
+                    # Записываем финальное количество одной строкой
+                    writer.writerow([self.packer_name, box_barcode, box_comment, item_barcode, count, item_comment, box_timestamp, "", "final", f"Итоговое количество: {count}"])
+                    
+                    # Записываем историю изменений отдельно
+                    for index in box_items.get(item_id, ()):
+                        action_type = history.action_types.names[history.action_type_codes[index]]
+                        if action_type != 'final':
+                            writer.writerow([self.packer_name, box_barcode, box_comment, item_barcode, 1, item_comment, box_timestamp, history.time_text(index), action_type, history.details(index)])
+
+    def export_csv_log(self, excel_path):
+        """Лог CSV рядом с файлом Excel; возвращает путь к нему"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        base_name = os.path.splitext(os.path.basename(excel_path))[0]
+        csv_dir = os.path.dirname(excel_path)
+        csv_path = os.path.join(csv_dir, f"{base_name}_{timestamp}.csv")
+        self.export_csv(csv_path)
+        return csv_path
+
+    def _item_status_text(self, item_barcode):
+        planned = self.invoice_data[item_barcode]
+        total_scanned = self.item_total(item_barcode)
+        if total_scanned == planned:
+            return "✅ Совпадает"
+        elif total_scanned < planned:
+            return f"⚠️ Недобор (план: {planned}, всего: {total_scanned}, не хватает: {planned - total_scanned})"
+        return f"❗ Перебор (план: {planned}, всего: {total_scanned}, лишних: {total_scanned - planned})"
+
+    def _autofit_columns(self, sheet):
+        for column in sheet.columns:
+            max_length = 0
+            col_letter = openpyxl.utils.get_column_letter(column[0].column)
+            for cell in column:
+                try:
+                    if cell.value and len(str(cell.value)) > max_length:
+                        max_length = len(str(cell.value))
+                except:
+                    pass
+            sheet.column_dimensions[col_letter].width = min(max_length + 2, 50)
+
+    def export_excel_multi_sheet(self, file_path):
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)
+        
+        thin_border = Border(
+            left=Side(style='thin'),
+            right=Side(style='thin'),
+            top=Side(style='thin'),
+            bottom=Side(style='thin')
+        )
+        
+        header_fill = PatternFill(start_color="3498db", end_color="3498db", fill_type="solid")
+        header_font = Font(color="FFFFFF", bold=True)
+        
+        for box_barcode, items in self.iter_boxes():
+            sheet = wb.create_sheet(title=f"Короб {box_barcode[:15]}")
+            
+            if self.packer_name:
+                sheet['A1'] = "Сборщик:"
+                sheet['B1'] = self.packer_name
+                sheet['A1'].font = Font(bold=True)
+                sheet['B1'].font = Font(bold=True)
+            
+            sheet['A3'] = "Штрихкод короба"
+            sheet['B3'] = box_barcode
+            sheet['C3'] = "Комментарий"
+            
+            sheet['A4'] = "Штрихкод товара"
+            sheet['B4'] = "Количество"
+            sheet['C4'] = "Комментарий"
+            if self.invoice_loaded:
+                sheet['D4'] = "План"
+                sheet['E4'] = "Статус"
+            
+            for cell in ['A3', 'B3', 'C3', 'A4', 'B4', 'C4']:
+                if cell in sheet:
+                    sheet[cell].alignment = Alignment(horizontal='center')
+                    sheet[cell].font = header_font
+                    sheet[cell].fill = header_fill
+                    sheet[cell].border = thin_border
+            
+            if self.invoice_loaded:
+                sheet['D4'].alignment = Alignment(horizontal='center')
+                sheet['D4'].font = header_font
+                sheet['D4'].fill = header_fill
+                sheet['D4'].border = thin_border
+                sheet['E4'].alignment = Alignment(horizontal='center')
+                sheet['E4'].font = header_font
+                sheet['E4'].fill = header_fill
+                sheet['E4'].border = thin_border
+            
+            row = 5
+            sheet.cell(row=row, column=1, value="Комментарий к коробу:")
+            sheet.cell(row=row, column=3, value=self.get_comment(box_barcode))
+            sheet[f'A{row}'].font = Font(bold=True)
+            row += 1
+            
+            for item_barcode, count in items.items():
+                sheet.cell(row=row, column=1, value=item_barcode)
+                sheet.cell(row=row, column=2, value=count).alignment = Alignment(horizontal='center')
+                sheet.cell(row=row, column=3, value=self.get_comment(box_barcode, item_barcode))
+                
+                if self.invoice_loaded and item_barcode in self.invoice_data:
+                    planned = self.invoice_data[item_barcode]
+                    sheet.cell(row=row, column=4, value=planned).alignment = Alignment(horizontal='center')
+                    sheet.cell(row=row, column=5, value=self._item_status_text(item_barcode))
+                elif self.invoice_loaded:
+                    sheet.cell(row=row, column=4, value="0")
+                    sheet.cell(row=row, column=5, value="❓ Лишний")
+                
+                for col in range(1, 6 if self.invoice_loaded else 4):
+                    cell = sheet.cell(row=row, column=col)
+                    if cell.value:
+                        cell.border = thin_border
+                
+                row += 1
+            
+            self._autofit_columns(sheet)
+    
+        wb.save(file_path)
+
+    def export_excel_single_sheet(self, file_path):
+        wb = openpyxl.Workbook()
+        sheet = wb.active
+        sheet.title = "Сборка"
+        
+        thin_border = Border(
+            left=Side(style='thin'),
+            right=Side(style='thin'),
+            top=Side(style='thin'),
+            bottom=Side(style='thin')
+        )
+        
+        header_fill = PatternFill(start_color="3498db", end_color="3498db", fill_type="solid")
+        header_font = Font(color="FFFFFF", bold=True)
+        
+        if self.packer_name:
+            sheet['A1'] = "Сборщик:"
+            sheet['B1'] = self.packer_name
+            sheet['A1'].font = Font(bold=True)
+            sheet['B1'].font = Font(bold=True)
+            sheet['A1'].fill = header_fill
+            sheet['B1'].fill = header_fill
+        
+        sheet['A3'] = "Штрихкод короба"
+        sheet['B3'] = "Комментарий короба"
+        sheet['C3'] = "Штрихкод товара"
+        sheet['D3'] = "Количество"
+        sheet['E3'] = "Комментарий товара"
+        
+        if self.invoice_loaded:
+            sheet['F3'] = "План"
+            sheet['G3'] = "Статус"
+        
+        for col in range(1, 8 if self.invoice_loaded else 6):
+            cell = sheet.cell(row=3, column=col)
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.border = thin_border
+            cell.alignment = Alignment(horizontal='center')
+        
+        row = 4
+        for box_barcode, items in self.iter_boxes():
+            box_comment = self.get_comment(box_barcode)
+            
+            first_in_box = True
+            for item_barcode, count in items.items():
+                item_comment = self.get_comment(box_barcode, item_barcode)
+                
+                if first_in_box:
+                    sheet.cell(row=row, column=1, value=box_barcode)
+                    sheet.cell(row=row, column=2, value=box_comment)
+                    first_in_box = False
+                
+                sheet.cell(row=row, column=3, value=item_barcode)
+                sheet.cell(row=row, column=4, value=count).alignment = Alignment(horizontal='center')
+                sheet.cell(row=row, column=5, value=item_comment)
+                
+                if self.invoice_loaded and item_barcode in self.invoice_data:
+                    planned = self.invoice_data[item_barcode]
+                    sheet.cell(row=row, column=6, value=planned).alignment = Alignment(horizontal='center')
+                    sheet.cell(row=row, column=7, value=self._item_status_text(item_barcode))
+                elif self.invoice_loaded:
+                    sheet.cell(row=row, column=6, value="0")
+                    sheet.cell(row=row, column=7, value="❓ Лишний")
+                
+                for col in range(1, 8 if self.invoice_loaded else 6):
+                    cell = sheet.cell(row=row, column=col)
+                    if cell.value:
+                        cell.border = thin_border
+                
+                row += 1
+            
+            if items:
+                row += 1
+        
+        self._autofit_columns(sheet)
+    
+        wb.save(file_path)
+
+    def build_report(self):
+        report_lines = []
+        report_lines.append("=" * 80)
+        report_lines.append("ОТЧЁТ О СБОРКЕ".center(80))
+        report_lines.append("=" * 80)
+        report_lines.append(f"Дата: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}")
+        report_lines.append(f"Сборщик: {self.packer_name if self.packer_name else 'не указан'}")
+        total_planned = self.scan_index.reconciliation.planned_total
+        if self.invoice_loaded:
+            report_lines.append(f"Накладная: {self.invoice_file_name} (позиций: {len(self.invoice_data)}, всего: {total_planned} шт)")
+        report_lines.append("")
+        
+        match_count = 0
+        shortage_count = 0
+        excess_count = 0
+        extra_count = 0
+        
+        shortage_units = 0
+        excess_units = 0
+        extra_units = 0
+        
+        for box_barcode, items in self.iter_boxes():
+            box_comment = self.get_comment(box_barcode)
+            report_lines.append(f"\n📦 КОРОБ: {box_barcode}")
+            if box_comment:
+                report_lines.append(f"   Комментарий: {box_comment}")
+            
+            for item_barcode, count in items.items():
+                item_comment = self.get_comment(box_barcode, item_barcode)
+                
+                status = ""
+                if self.invoice_loaded:
+                    if item_barcode in self.invoice_data:
+                        planned = self.invoice_data[item_barcode]
+                        total_for_item = self.item_total(item_barcode)
+                        if total_for_item == planned:
+                            status = "✅ СОВПАДАЕТ"
+                            match_count += 1
+                        elif total_for_item < planned:
+                            diff = planned - total_for_item
+                            status = f"⚠️ НЕДОБОР (план: {planned}, всего: {total_for_item}, не хватает: {diff})"
+                            shortage_count += 1
+                            shortage_units += diff
+                        else:
+                            diff = total_for_item - planned
+                            status = f"❗ ПЕРЕБОР (план: {planned}, всего: {total_for_item}, лишних: {diff})"
+                            excess_count += 1
+                            excess_units += diff
+                    else:
+                        status = "❓ ЛИШНИЙ"
+                        extra_count += 1
+                        extra_units += count
+                
+                line = f"   • {item_barcode} - {count} шт."
+                if status:
+                    line += f" [{status}]"
+                if item_comment:
+                    line += f" ({item_comment})"
+                report_lines.append(line)
+        
+        report_lines.append("")
+        report_lines.append("-" * 80)
+        report_lines.append("ИТОГИ:")
+        report_lines.append(f"📦 Коробов: {self.box_count()}")
+        report_lines.append(f"📦 Всего товаров: {self.scan_index.grand_total} шт.")
+        
+        if self.invoice_loaded:
+            report_lines.append(f"📋 План: {total_planned} шт.")
+            report_lines.append(f"✅ Совпадает: {match_count} позиций")
+            report_lines.append(f"⚠️ Недобор: {shortage_count} позиций (всего -{shortage_units} шт)")
+            report_lines.append(f"❗ Перебор: {excess_count} позиций (всего +{excess_units} шт)")
+            report_lines.append(f"❓ Лишние: {extra_count} позиций (всего +{extra_units} шт)")
+        
+        report_lines.append("=" * 80)
+        
+        return "\n".join(report_lines)
+
+    # --- Сохранение состояния ---
+
+    def to_state(self):
+        serializable_comments = {}
+        for (box_barcode, item_barcode), comment in self.comments.items():
+            key_str = f"{box_barcode},{item_barcode}"
+            serializable_comments[key_str] = comment
+            
+        return {
+            "all_boxes": {box_barcode: dict(items.items()) for box_barcode, items in self.iter_boxes()},
+            "current_box_barcode": self.current_box_barcode,
+            "comments": serializable_comments,
+            "strict_validation_enabled": self.strict_validation_enabled,
+            "history": self.scan_history.to_state(),
+            "packer_name": self.packer_name,
+        }
+
+    def load_state(self, data):
+        if 'all_boxes' in data:
+            self._replace_boxes({str(k): v for k, v in data['all_boxes'].items()})
+        if 'current_box_barcode' in data:
+            self.current_box_barcode = data['current_box_barcode']
+        if 'packer_name' in data:
+            self.packer_name = data['packer_name']
+            
+        serializable_comments = data.get('comments', {})
+        self.comments = CommentStore()
+        for key_str, comment in serializable_comments.items():
+            try:
+                box_barcode, item_barcode_str = key_str.split(",", 1) if "," in key_str else (key_str, "")
+                item_barcode = item_barcode_str if item_barcode_str else ""
+                self.comments.set(box_barcode, item_barcode, comment)
+            except ValueError:
+                pass
+        if 'strict_validation_enabled' in data:
+            self.strict_validation_enabled = data['strict_validation_enabled']
+        
+        if 'history' in data:
+            self.scan_history = ScanHistory(self.barcodes)
+            self.scan_history.load_state(data['history'])
+        elif 'scan_history' in data:
+            # Файл состояния старых версий: список словарей
+            self.scan_history = self._history_from_entries(data['scan_history'])
+        self._notify('boxes_reset')
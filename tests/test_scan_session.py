@@ -0,0 +1,452 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+from collections import defaultdict
+from datetime import datetime
+
+import openpyxl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scan_session
+from scan_session import ScanSession, ScanError, Reconciliation, format_time, TIME_FORMAT
+
+ITEM = "4600000000011"
+ITEM_2 = "4600000000028"
+ITEM_3 = "4600000000035"
+EXTRA_ITEM = "4600000000042"
+
+
+class SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def assertConsistent(self, session):
+        """Суммы ScanIndex и счётчики сверки совпадают с полным пересчётом коробов"""
+        index = session.scan_index
+        barcodes = session.barcodes
+        totals = defaultdict(int)
+        item_boxes = defaultdict(set)
+        grand_total = 0
+        for box_barcode, contents in session.iter_boxes():
+            box_id = barcodes.get(box_barcode)
+            items = dict(contents.items())
+            self.assertEqual(index.box_total(box_id), sum(items.values()), box_barcode)
+            for item_barcode, count in items.items():
+                item_id = barcodes.get(item_barcode)
+                totals[item_id] += count
+                item_boxes[item_id].add(box_id)
+                grand_total += count
+
+        self.assertEqual(index.grand_total, grand_total)
+        for item_id in range(len(barcodes.names)):
+            self.assertEqual(index.total(item_id), totals.get(item_id, 0), barcodes.names[item_id])
+            self.assertEqual(set(index.boxes_with(item_id)), item_boxes.get(item_id, set()), barcodes.names[item_id])
+
+        expected = Reconciliation()
+        planned = {barcodes.get(barcode): count for barcode, count in session.invoice_data.items()}
+        expected.load(planned, totals, item_boxes)
+        actual = vars(index.reconciliation)
+        for name, value in vars(expected).items():
+            self.assertEqual(actual[name], value, name)
+
+
+class ScanTest(SessionTestCase):
+    def test_scan_box_and_items(self):
+        session = ScanSession()
+        with self.assertRaises(ScanError):
+            session.scan_item(ITEM)
+        with self.assertRaises(ScanError):
+            session.scan_box("коробка")
+
+        session.scan_box("WB_A")
+        self.assertEqual(session.scan_item(ITEM), 1)
+        self.assertEqual(session.scan_item(ITEM), 2)
+        self.assertEqual(session.scan_item(ITEM_2), 1)
+        with self.assertRaises(ScanError):
+            session.scan_item("abc")
+
+        self.assertEqual(session.current_box_barcode, "WB_A")
+        self.assertEqual(list(session.box_items("WB_A")), [ITEM, ITEM_2])
+        self.assertEqual(session.get_count("WB_A", ITEM), 2)
+        self.assertEqual(session.box_total("WB_A"), 3)
+        self.assertEqual(session.item_total(ITEM), 2)
+        self.assertEqual(len(session.scan_history), 4)
+        self.assertEqual([entry.action for entry in session.scan_history], ['scan'] * 4)
+        self.assertConsistent(session)
+
+    def test_undo_scan_removes_empty_box(self):
+        session = ScanSession()
+        session.scan_box("WB_A")
+        session.scan_item(ITEM)
+        session.scan_item(ITEM)
+        session.undo()
+        self.assertEqual(session.get_count("WB_A", ITEM), 1)
+        self.assertConsistent(session)
+        session.undo()
+        self.assertFalse(session.has_box("WB_A"))
+        self.assertEqual(session.current_box_barcode, "")
+        self.assertIsNone(session.undo())
+        self.assertConsistent(session)
+
+
+class EditTest(SessionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session = ScanSession()
+        self.session.scan_box("WB_A")
+        self.session.scan_item(ITEM)
+        self.session.scan_item(ITEM_2)
+        self.session.scan_box("WB_B")
+        self.session.scan_item(ITEM)
+
+    def test_set_item_count_and_undo(self):
+        session = self.session
+        session.set_item_count("WB_A", ITEM, 5)
+        self.assertEqual(session.get_count("WB_A", ITEM), 5)
+        self.assertEqual(session.item_total(ITEM), 6)
+        self.assertConsistent(session)
+        session.undo()
+        self.assertEqual(session.get_count("WB_A", ITEM), 1)
+        self.assertConsistent(session)
+
+    def test_zero_count_deletes_line_and_box_and_undo_restores(self):
+        session = self.session
+        session.set_item_count("WB_B", ITEM, 0)
+        self.assertFalse(session.has_box("WB_B"))
+        self.assertConsistent(session)
+        session.undo()
+        self.assertFalse(session.has_box("WB_B"))
+        session.set_item_count("WB_A", ITEM_2, 0)
+        self.assertEqual(session.get_count("WB_A", ITEM_2), 0)
+        self.assertConsistent(session)
+        session.undo()
+        self.assertEqual(session.get_count("WB_A", ITEM_2), 1)
+        self.assertConsistent(session)
+
+    def test_rename_item_and_undo(self):
+        session = self.session
+        with self.assertRaises(ScanError):
+            session.rename_item("WB_A", ITEM, ITEM_2)
+        with self.assertRaises(ScanError):
+            session.rename_item("WB_A", ITEM, "abc")
+        session.rename_item("WB_A", ITEM, ITEM_3)
+        self.assertEqual(session.get_count("WB_A", ITEM_3), 1)
+        self.assertEqual(session.get_count("WB_A", ITEM), 0)
+        self.assertEqual(session.item_total(ITEM), 1)
+        self.assertConsistent(session)
+        session.undo()
+        self.assertEqual(session.get_count("WB_A", ITEM), 1)
+        self.assertEqual(session.get_count("WB_A", ITEM_3), 0)
+        self.assertConsistent(session)
+
+    def test_rename_box_moves_comments(self):
+        session = self.session
+        session.set_comment("WB_A", "", "короб")
+        session.set_comment("WB_A", ITEM, "товар")
+        with self.assertRaises(ScanError):
+            session.rename_box("WB_A", "WB_B")
+        session.rename_box("WB_A", "WB_C")
+        self.assertEqual(session.get_comment("WB_C"), "короб")
+        self.assertEqual(session.get_comment("WB_C", ITEM), "товар")
+        self.assertEqual(session.get_count("WB_C", ITEM_2), 1)
+        self.assertConsistent(session)
+
+    def test_comments(self):
+        session = self.session
+        self.assertTrue(session.set_comment("WB_A", ITEM, "первая\nвторая"))
+        self.assertFalse(session.set_comment("WB_A", ITEM, "первая\nвторая"))
+        self.assertEqual(session.get_comment("WB_A", ITEM), "первая\nвторая")
+        self.assertEqual(session.get_comment("WB_A"), "")
+
+    def test_delete_item_and_box(self):
+        session = self.session
+        session.set_comment("WB_A", ITEM_2, "удалится")
+        session.delete_item("WB_A", ITEM_2)
+        self.assertEqual(session.get_count("WB_A", ITEM_2), 0)
+        self.assertEqual(session.get_comment("WB_A", ITEM_2), "")
+        self.assertConsistent(session)
+        session.delete_box("WB_B")
+        self.assertFalse(session.has_box("WB_B"))
+        self.assertEqual(session.item_total(ITEM), 1)
+        self.assertConsistent(session)
+
+
+class InvoiceTest(SessionTestCase):
+    def write_invoice(self, rows):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["Штрихкод", "Количество"])
+        for row in rows:
+            sheet.append(row)
+        path = self.path("invoice.xlsx")
+        workbook.save(path)
+        return path
+
+    def test_read_and_load_invoice(self):
+        session = ScanSession()
+        path = self.write_invoice([(ITEM, 2), (ITEM_2, 1), (ITEM_3, 3), ("", 5), ("4600000000059", "нет")])
+        invoice_data, total_items, total_quantity, file_name, file_path = session.read_invoice(path)
+        self.assertEqual(invoice_data, {ITEM: 2, ITEM_2: 1, ITEM_3: 3})
+        self.assertEqual((total_items, total_quantity, file_name), (3, 6, "invoice.xlsx"))
+
+        session.scan_box("WB_A")
+        session.scan_item(ITEM)
+        session.scan_item(ITEM_2)
+        session.scan_item(ITEM_2)
+        session.scan_item(EXTRA_ITEM)
+        session.load_invoice(invoice_data, file_name, file_path)
+        self.assertConsistent(session)
+
+        reconciliation = session.scan_index.reconciliation
+        self.assertEqual(reconciliation.planned_total, 6)
+        self.assertEqual(reconciliation.scanned_planned, 2)
+        self.assertEqual((reconciliation.match_count, reconciliation.shortage_count, reconciliation.excess_count), (0, 2, 1))
+        self.assertEqual((reconciliation.extra_count, reconciliation.extra_units), (1, 1))
+        self.assertEqual(session.get_item_status(ITEM), ("⚠️", "2"))
+        self.assertEqual(session.get_item_status(ITEM_2), ("❗", "1"))
+        self.assertEqual(session.get_item_status(EXTRA_ITEM), ("❓", "0"))
+
+        session.scan_item(ITEM)
+        self.assertEqual(session.get_item_status(ITEM), ("✅", "2"))
+        self.assertConsistent(session)
+
+        session.clear_invoice()
+        self.assertEqual(session.get_item_status(ITEM), ("", ""))
+        self.assertConsistent(session)
+
+
+class RandomOperationsTest(SessionTestCase):
+    def test_index_matches_recount_after_every_operation(self):
+        rng = random.Random(7)
+        session = ScanSession()
+        session.load_invoice({ITEM: 3, ITEM_2: 2, ITEM_3: 1})
+        boxes = ["WB_%d" % number for number in range(4)]
+        items = [ITEM, ITEM_2, ITEM_3, EXTRA_ITEM]
+        for step in range(600):
+            lines = [(box, item) for box, contents in session.iter_boxes() for item in dict(contents.items())]
+            operation = rng.random()
+            if operation < 0.1 or not session.has_box(session.current_box_barcode):
+                session.scan_box(rng.choice(boxes))
+            elif operation < 0.55:
+                session.scan_item(rng.choice(items))
+            elif operation < 0.65:
+                session.undo()
+            elif lines and operation < 0.75:
+                box, item = rng.choice(lines)
+                session.set_item_count(box, item, rng.randint(0, 4))
+            elif lines and operation < 0.8:
+                session.delete_item(*rng.choice(lines))
+            elif lines and operation < 0.85:
+                box, item = rng.choice(lines)
+                try:
+                    session.rename_item(box, item, rng.choice(items))
+                except ScanError:
+                    pass
+            elif lines and operation < 0.9:
+                session.delete_box(rng.choice(lines)[0])
+            elif lines and operation < 0.95:
+                try:
+                    session.rename_box(rng.choice(lines)[0], rng.choice(boxes))
+                except ScanError:
+                    pass
+            elif operation < 0.97:
+                session.clear_invoice()
+            else:
+                session.load_invoice({ITEM: rng.randint(1, 4), ITEM_3: rng.randint(1, 4)})
+            self.assertConsistent(session)
+
+
+class PersistenceTest(SessionTestCase):
+    def make_session(self):
+        session = ScanSession()
+        session.packer_name = "Иванов"
+        session.scan_box("WB_A")
+        session.scan_item(ITEM)
+        session.scan_item(ITEM)
+        session.scan_item(ITEM_2)
+        session.set_comment("WB_A", "", "короб, с запятой")
+        session.set_comment("WB_A", ITEM, "товар")
+        session.scan_box("WB_B")
+        session.scan_item(ITEM_3)
+        session.set_item_count("WB_B", ITEM_3, 3)
+        return session
+
+    def contents(self, session):
+        return {box: dict(items.items()) for box, items in session.iter_boxes()}
+
+    def test_csv_round_trip(self):
+        session = self.make_session()
+        path = self.path("export.csv")
+        session.export_csv(path)
+
+        loaded = ScanSession()
+        all_boxes, comments, scan_history, packer_name = loaded.read_csv(path)[:4]
+        loaded.apply_csv(all_boxes, comments, scan_history, packer_name)
+
+        self.assertEqual(self.contents(loaded), self.contents(session))
+        self.assertEqual(loaded.packer_name, "Иванов")
+        self.assertEqual(loaded.get_comment("WB_A"), "короб, с запятой")
+        self.assertEqual(loaded.get_comment("WB_A", ITEM), "товар")
+        self.assertConsistent(loaded)
+
+        again = self.path("again.csv")
+        loaded.export_csv(again)
+        with open(path, encoding="utf-8") as first, open(again, encoding="utf-8") as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_state_round_trip(self):
+        session = self.make_session()
+        state = json.loads(json.dumps(session.to_state()))
+
+        loaded = ScanSession()
+        loaded.load_state(state)
+        self.assertEqual(self.contents(loaded), self.contents(session))
+        self.assertEqual(loaded.current_box_barcode, "WB_B")
+        self.assertEqual(loaded.get_comment("WB_A"), "короб, с запятой")
+        self.assertEqual(len(loaded.scan_history), len(session.scan_history))
+        self.assertEqual(
+            [(entry.action, loaded.scan_history.details(number)) for number, entry in enumerate(loaded.scan_history)],
+            [(entry.action, session.scan_history.details(number)) for number, entry in enumerate(session.scan_history)])
+        self.assertConsistent(loaded)
+
+    def test_excel_exports_and_report(self):
+        session = self.make_session()
+        session.load_invoice({ITEM: 2, ITEM_3: 1})
+        multi = self.path("multi.xlsx")
+        single = self.path("single.xlsx")
+        session.export_excel_multi_sheet(multi)
+        session.export_excel_single_sheet(single)
+
+        self.assertEqual(openpyxl.load_workbook(multi).sheetnames, ["Короб WB_A", "Короб WB_B"])
+        rows = list(openpyxl.load_workbook(single).active.iter_rows(min_row=4, values_only=True))
+        lines = [(row[0], row[2], row[3]) for row in rows if row[2]]
+        self.assertEqual(lines, [("WB_A", ITEM, 2), (None, ITEM_2, 1), ("WB_B", ITEM_3, 3)])
+
+        report = session.build_report()
+        self.assertIn("Сборщик: Иванов", report)
+        self.assertIn("📦 КОРОБ: WB_A", report)
+
+
+class RenameBoxTest(unittest.TestCase):
+    def test_rename_empty_box_beyond_totals(self):
+        session = ScanSession()
+        session.scan_box("WB_A")
+        session.scan_item(ITEM)
+        session.delete_box("WB_A")
+        session.scan_box("WB_B")
+        session.set_comment("WB_B", "", "комментарий")
+
+        session.rename_box("WB_B", "WB_A")
+
+        self.assertTrue(session.has_box("WB_A"))
+        self.assertFalse(session.has_box("WB_B"))
+        self.assertEqual(session.get_comment("WB_A"), "комментарий")
+        self.assertEqual(session.get_comment("WB_B"), "")
+        self.assertEqual(session.current_box_barcode, "WB_A")
+
+        session.scan_item(ITEM)
+        self.assertEqual(session.get_count("WB_A", ITEM), 1)
+        box_id = session.barcodes.get("WB_A")
+        self.assertEqual(session.scan_index.box_total(box_id), 1)
+        self.assertEqual(session.scan_index.total(session.barcodes.get(ITEM)), 1)
+
+    def test_rename_missing_box_changes_nothing(self):
+        session = ScanSession()
+        session.scan_box("WB_A")
+        session.scan_item(ITEM)
+        session.set_comment("WB_X", "", "комментарий")
+
+        with self.assertRaises(ScanError):
+            session.rename_box("WB_X", "WB_Y")
+
+        self.assertEqual(session.get_comment("WB_X"), "комментарий")
+        self.assertFalse(session.has_box("WB_Y"))
+
+
+
+class FormatTimeTest(unittest.TestCase):
+    def test_call_while_prefix_is_built_sees_consistent_cache(self):
+        # Пока один поток строит начало строки для новой минуты, другой форматирует время:
+        # подменяем datetime так, чтобы второй вызов случился ровно в этот момент
+        first, other = 1700000000, 1700003630
+        format_time(other)
+        seen = []
+
+        class InterruptedDatetime(datetime):
+            @classmethod
+            def fromtimestamp(cls, timestamp, *args):
+                if not seen:
+                    seen.append(format_time(other))
+                return datetime.fromtimestamp(timestamp, *args)
+
+        original = scan_session.datetime
+        scan_session.datetime = InterruptedDatetime
+        try:
+            text = format_time(first)
+        finally:
+            scan_session.datetime = original
+        self.assertEqual(text, datetime.fromtimestamp(first).strftime(TIME_FORMAT))
+        self.assertEqual(seen, [datetime.fromtimestamp(other).strftime(TIME_FORMAT)])
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def export_csv(self, session, name):
+        path = os.path.join(self.directory.name, name)
+        session.export_csv(path)
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def test_snapshot_export_ignores_later_changes(self):
+        session = ScanSession()
+        session.scan_box("WB_A")
+        session.scan_item(ITEM)
+        session.scan_item(ITEM)
+        session.scan_item(ITEM_2)
+        session.set_comment("WB_A", ITEM, "до снимка")
+        session.scan_box("WB_B")
+        session.scan_item(ITEM_2)
+
+        snapshot = session.snapshot()
+        before = self.export_csv(snapshot, "before.csv")
+        history_length = len(snapshot.scan_history)
+
+        session.scan_box("WB_A")
+        session.scan_item(ITEM)
+        session.rename_box("WB_B", "WB_C")
+        session.set_comment("WB_A", ITEM, "после снимка")
+        session.set_comment("WB_C", "", "короб")
+        session.delete_item("WB_A", ITEM_2)
+        session.set_item_count("WB_A", ITEM, 5)
+        session.undo()
+        session.scan_box("WB_D")
+        session.scan_item(ITEM)
+
+        self.assertEqual(self.export_csv(snapshot, "after.csv"), before)
+        self.assertEqual(len(snapshot.scan_history), history_length)
+        self.assertEqual(len(snapshot.scan_history.to_state()["times"]), history_length)
+        self.assertTrue(snapshot.has_box("WB_B"))
+        self.assertFalse(snapshot.has_box("WB_D"))
+        self.assertEqual(snapshot.get_count("WB_A", ITEM), 2)
+        self.assertNotEqual(self.export_csv(session, "live.csv"), before)
+
+    def test_snapshot_history_is_read_only(self):
+        session = ScanSession()
+        session.scan_box("WB_A")
+        with self.assertRaises(TypeError):
+            session.snapshot().scan_history.append(0, 0, None, 'scan', 'scan', 0)
+
+
+if __name__ == "__main__":
+    unittest.main()